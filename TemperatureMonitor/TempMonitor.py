@@ -1,23 +1,40 @@
+import os
+import sys
 import time
 import glob
 import atexit
 # Once we get a DB set up, we'll activate this
 # import mysql.connector  # To save data locally in the event we can't post or need to recover/reset data
 import logging
-import requests
 import json
 import threading
 import datetime
-import RPi.GPIO as GPIO
 # from socketIO_client import SocketIO, LoggingNamespace 	# To stream pouring data to the client page
 
 # this holds configuration information for the services to connect to.
 import settings
 
+# Modules shared with the flowmeter live at the root of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from api_client import get_client
+from delivery import DeliveryQueue
+from gpio_backend import get_gpio
+from w1bus import CRC_FAILURES, W1BusScanner, parse_w1_slave
+
 # When False, temp probe will connect to live site for api authentication, data posting, and web socket streaming
 DEBUG = settings.DEBUG
 
 
+def target_host(endpoint=None):
+    """
+    Base URL of the API: the host and port of the keg server's `endpoint` config, or `settings.TARGET_HOST`
+    without one.
+    """
+    if endpoint and 'host' in endpoint:
+        return '%s:%s' % (endpoint['host'], endpoint['port']) if 'port' in endpoint else endpoint['host']
+    return settings.TARGET_HOST
+
+
 class TempMonitor(threading.Thread):
     """
     This class provides methods to post, stream, and log temperature data read from a GPIO pin of a raspberry pi.
@@ -30,8 +47,26 @@ class TempMonitor(threading.Thread):
         Time in seconds in which the probe will be read and reported.
     debug<optional>: Boolean
         A boolean designating whether or not the data is emitting to local or remote web services.
+    post_data<optional>: Boolean
+        Whether readings are posted to the API. Posting happens on a background delivery queue.
+    delivery<optional>: DeliveryQueue
+        Queue the readings are posted from. Defaults to a queue of its own.
+    journal<optional>: Journal
+        Local journal every reading is recorded in.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API the fan relay is switched with. Defaults to
+        `gpio_backend.get_gpio()`.
+    stream<optional>: PourStream
+        On-device event stream every reading is also published to.
+    timeseries<optional>: TimeSeriesStore
+        Local store every reading is recorded in, under the name of the probe.
+    endpoint<optional>: Dictionary
+        The API to post to, with `host`, `port`, `user` and `password`, as in the keg server config. Defaults
+        to `TARGET_HOST`, `USER` and `PASSWORD` from the settings.
     """
-    def __init__(self, device_file_id, gpio_pin, read_interval=10, debug=True):
+    def __init__(self, device_file_id, gpio_pin, read_interval=10, debug=True, post_data=False, delivery=None,
+                 journal=None, gpio=None, stream=None,
+                 timeseries=None, endpoint=None):
         """
             Some properties are declared as 0.0 so they are set to be floating point numbers instead of integers
             as they need finer precision for some calculations.
@@ -44,14 +79,19 @@ class TempMonitor(threading.Thread):
         self.device_file = device_file_id + '/w1_slave'
         self.read_interval = read_interval
 
-        self.user = settings.USER
-        self.password = settings.PASSWORD
+        endpoint = endpoint or {}
+        self.user = endpoint.get('user', settings.USER)
+        self.password = endpoint.get('password', settings.PASSWORD)
         self.token = None
 
-        self.target_host = settings.TARGET_HOST
+        self.target_host = target_host(endpoint)
         self.AuthenticationUrl = '%s/api-auth-token/' % self.target_host
         self.PostTemperatureUrl = '%s/temperatures/' % self.target_host
 
+        # Every probe shares one pooled session and one cached token
+        self.client = get_client(self.AuthenticationUrl, self.user, self.password,
+                                 auth_format='json', token_location='header')
+
         self.max_temp_f = settings.MAX_TEMP_F if hasattr(settings, 'MAX_TEMP_F') else 72  # default to a max of 72 degrees F
         self.min_temp_f = settings.MIN_TEMP_F if hasattr(settings, 'MIN_TEMP_F') else 60  # default to a min of 72 degrees F
 
@@ -61,62 +101,50 @@ class TempMonitor(threading.Thread):
         self.fan_pin = gpio_pin
         self.plate_pin = 23
         self.fan_is_on = False
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.fan_pin, GPIO.OUT)
+
+        self.post_data = post_data
+        self.journal = journal
+        self.stream = stream
+        self.timeseries = timeseries
+        # Readings are journaled and posted from a background worker so reading the probe never waits on the API
+        if delivery is None:
+            delivery = DeliveryQueue(self.deliver_temperatures, name='temperatures-%s' % self.deviceId,
+                                     journal=journal, kind='temperature-%s' % self.deviceId)
+        self.delivery = delivery
+
+        self.gpio = gpio if gpio is not None else get_gpio()
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(self.fan_pin, self.gpio.OUT)
 
 
-        #atexit.register(self.gpio_cleanup)
+        atexit.register(self.gpio_cleanup)
 
     def run(self):
         self.startup()
 
     def get_token(self):
         """
-        Gets a JSON Web Token used to authenticate our POSTs to the API
+        Gets a JSON Web Token used to authenticate our POSTs to the API. The token is cached by the shared
+        client and refreshed in the background before it expires.
         """
-        logging.info("\n\tauth url: %s" % self.AuthenticationUrl)
+        import requests
 
-        login_data = {"username": self.user, "password": self.password}
-        response = None
         try:
-            response = requests.post(self.AuthenticationUrl, json=login_data)
-
-            data = json.loads(response.text)
-
-            if 'token' in data:
-                logging.info("\n\tSuccessfully retrieved token!")
-                return data['token']
-            else:
-
-                # TODO: log to a local db instead of just erroring out.
-                raise Exception("Unauthorized! Please check the username and password.")
-
+            return self.client.token()
         except requests.exceptions.ConnectionError as e:
             print "No response\n\n", e
 
-            if response is not None:
-                try:
-                    response.close()
-                except:
-                    pass
-
     def post_temperature_data(self, temp_data):
         """
         Posts the pour data to the server.
 
         :param temp_data: Object containing the temperature data
+        :return: True if the API accepted the reading
         """
         logging.info("\n\tposturl: %s" % self.PostTemperatureUrl)
 
-        if self.token is None:
-
-            # TODO: log to a local db instead of just erroring out.
-            raise Exception("Unauthorized! Cannot post temperature data. Please check the username and password.")
-
-        # Must mixin the auth token in order to post the data
-        headers = {'Authorization': 'Token %s' % self.token}
-
-        response = requests.post(self.PostTemperatureUrl, headers=headers, data=temp_data)
+        # The client adds the auth header and re-authenticates if the token was rejected
+        response = self.client.post(self.PostTemperatureUrl, data=temp_data)
         data = json.loads(response.text)
         success = False
         # No need to keep the latest pour if it posted successfully
@@ -128,8 +156,28 @@ class TempMonitor(threading.Thread):
             logging.warning("\n\tThe post was not successful.")
 
             logging.error("\n\tSomething went wrong.")
-            # TODO: log temperature data to local database
-            pass
+            # The reading stays unacknowledged in the journal and is replayed later
+
+        return success
+
+    def deliver_temperatures(self, readings):
+        """
+        Sends a batch of readings from the delivery queue to the API.
+
+        :param readings: List of temperature data objects
+        :return: The readings that could not be posted
+        """
+        failed = []
+        for index, temp_data in enumerate(readings):
+            try:
+                if not self.post_temperature_data(temp_data):
+                    failed.append(temp_data)
+            except Exception as e:
+                logging.error(e)
+                # The API is unreachable, no point trying the rest of the batch right now
+                failed.extend(readings[index:])
+                break
+        return failed
 
     def startup(self):
         """
@@ -139,6 +187,8 @@ class TempMonitor(threading.Thread):
         logging.info("\n\n\n")  # pad the log a bit so we can see where the program restarted
 
         self.token = self.get_token()
+        if self.post_data:
+            self.delivery.start()
 
         logging.info("\n\twe're monitoring temperature!")
 
@@ -161,18 +211,17 @@ class TempMonitor(threading.Thread):
             # Only turn on if it is not already on
             if not self.fan_is_on:
                 # Turn on the Relay
-                GPIO.output(self.fan_pin, GPIO.LOW)
+                self.gpio.output(self.fan_pin, self.gpio.LOW)
                 self.fan_is_on = True
 
         else:
             # Turn off the Relay
-            GPIO.output(self.fan_pin, GPIO.HIGH)
+            self.gpio.output(self.fan_pin, self.gpio.HIGH)
             self.fan_is_on = False
 
-    @atexit.register
     def gpio_cleanup(self):
-        GPIO.output(self.fan_pin, GPIO.HIGH)
-        GPIO.cleanup()
+        self.gpio.output(self.fan_pin, self.gpio.HIGH)
+        self.gpio.cleanup()
 
     def main(self):
         """
@@ -182,57 +231,115 @@ class TempMonitor(threading.Thread):
         # We want this to constantly monitor the temperature files, so start an infinite loop
         while True:
             if not self.initial_read:
-                self.initial_read = False
-                # This pauses the program for 5 minutes in order to reduce network traffic for data collection
+                # This pauses the program in order to reduce network traffic for data collection
                 time.sleep(self.read_interval)
-            lines = self.read_temp_raw()
-            yes = lines[0].strip()[-3:]
-
-            while yes != 'YES':
-                time.sleep(0.2)
-                lines = self.read_temp_raw()
-
-            equals_pos = lines[1].find('t=')
-
-            if equals_pos != -1:
-                temp_string = lines[1][equals_pos + 2:]
-                temp_c = float(temp_string) / 1000.0
-                temp_f = temp_c * 9.0 / 5.0 + 32.0
+            self.initial_read = False
 
-                if temp_f > self.max_temp_f or temp_f < self.min_temp_f:
-                    self.toggle_fan(on=True)
-                else:
-                    self.toggle_fan(on=False)
+            temp_c = parse_w1_slave(self.read_temp_raw())
 
-                print self.deviceId + " is reading at " + str(temp_f) + " deg F"
-                #self.post_temperature_data({"name": self.deviceId, "temperature": temp_f, "created_on": str(datetime.datetime.now())})
-
-GPIO_PIN = 21
+            while temp_c is None:
+                CRC_FAILURES.labels(os.path.basename(os.path.dirname(self.device_file))).inc()
+                time.sleep(0.2)
+                temp_c = parse_w1_slave(self.read_temp_raw())
 
-try:
-    basepath = '/sys/bus/w1/devices/'
+            self.handle_reading(temp_c)
 
-    # The concatenated string will ensure to only list the device folders
-    # and exclude the `w1_bus_master` directory
-    device_dirs = glob.glob(basepath + '28*')
+    def handle_reading(self, temp_c):
+        """
+        Toggles the fan for a new reading of the probe and records/posts it.
 
-    if len(device_dirs) == 0:
-        raise Exception("No devices found")
+        :param temp_c: Temperature in degrees Celsius
+        """
+        temp_f = temp_c * 9.0 / 5.0 + 32.0
 
-    GPIO_PIN = raw_input('Please enter the GPIO pin the Temp Probes are linked to: ')
+        if temp_f > self.max_temp_f or temp_f < self.min_temp_f:
+            self.toggle_fan(on=True)
+        else:
+            self.toggle_fan(on=False)
+
+        print self.deviceId + " is reading at " + str(temp_f) + " deg F"
+        temp_data = {"name": self.deviceId, "temperature": temp_f, "created_on": str(datetime.datetime.now())}
+        if self.stream is not None:
+            self.stream.publish('temperature', {'name': self.deviceId, 'temperature': temp_f, 'time': time.time()})
+        if self.timeseries is not None:
+            self.timeseries.append(self.deviceId, temp_f)
+        if self.post_data:
+            self.delivery.put(temp_data)
+        elif self.journal is not None:
+            # Nothing will ever acknowledge it, so record it as delivered right away
+            self.journal.append('temperature', temp_data, acknowledged=True)
+
+
+def scan_bus(monitors, scanner, read_interval=10):
+    """
+    Reads every probe of the bus from a single thread with one bulk conversion per sweep, and hands each
+    reading to the monitor of its probe.
 
-    for device_file in device_dirs:
-        tm = TempMonitor(device_file)
-        # Since the TempMonitor class utilizes an endless loop, it's important we start each main method
-        # in its own thread, otherwise only the first device will ever be setup and read.
-        thread = threading.Thread(target=tm.startup)
+    :param monitors: Dictionary of probe directory name (i.e. `28-0000075a8b2c`) to TempMonitor
+    :param scanner: W1BusScanner of the bus
+    :param read_interval: Seconds between the start of two sweeps
+    """
+    scanner.configure()
+    for monitor in monitors.values():
+        monitor.get_token()
+        if monitor.post_data:
+            monitor.delivery.start()
+
+    while True:
+        started = time.time()
+        for device_id, temp_c in scanner.scan().items():
+            if temp_c is None:
+                logging.warning("\n\tCRC check failed for %s" % device_id)
+            elif device_id in monitors:
+                monitors[device_id].handle_reading(temp_c)
+        time.sleep(max(read_interval - (time.time() - started), 0))
+
+
+if __name__ == '__main__':
+    GPIO = get_gpio()
+    GPIO_PIN = 21
+
+    try:
+        basepath = getattr(settings, 'W1_BASEPATH', '/sys/bus/w1/devices/')
+
+        # The concatenated string will ensure to only list the device folders
+        # and exclude the `w1_bus_master` directory
+        device_dirs = glob.glob(basepath + '28*')
+
+        if len(device_dirs) == 0:
+            raise Exception("No devices found")
+
+        GPIO_PIN = int(raw_input('Please enter the GPIO pin the Temp Probes are linked to: '))
+
+        post_data = getattr(settings, 'POST_DATA', False)
+        delivery = None
+        if getattr(settings, 'BULK_UPLOAD', False):
+            from batch import TemperatureBatcher
+
+            # One upload per window for all the probes instead of one request per reading
+            batcher = TemperatureBatcher(get_client('%s/api-auth-token/' % settings.TARGET_HOST, settings.USER,
+                                                    settings.PASSWORD),
+                                         settings.BULK_URL, window=settings.BULK_WINDOW,
+                                         max_readings=settings.BULK_MAX_READINGS, compress=settings.BULK_COMPRESS,
+                                         wire_format=getattr(settings, 'BULK_WIRE', 'auto'))
+            delivery = batcher.delivery
+            post_data = True
+
+        monitors = {}
+        for device_file in device_dirs:
+            monitors[os.path.basename(device_file)] = TempMonitor(device_file, GPIO_PIN, post_data=post_data,
+                                                                  delivery=delivery, gpio=GPIO)
+
+        # A single thread converts all the probes at once rather than one thread and one conversion per probe
+        scanner = W1BusScanner(basepath, resolution=getattr(settings, 'RESOLUTION', None))
+        thread = threading.Thread(target=scan_bus, args=(monitors, scanner, getattr(settings, 'READ_INTERVAL', 10)))
         thread.start()
 
-except Exception as e:
-    print e
+    except Exception as e:
+        print e
 
-finally:
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(GPIO_PIN, GPIO.OUT)
-    GPIO.output(GPIO_PIN, GPIO.HIGH)
-    GPIO.cleanup()
+    finally:
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(GPIO_PIN, GPIO.OUT)
+        GPIO.output(GPIO_PIN, GPIO.HIGH)
+        GPIO.cleanup()
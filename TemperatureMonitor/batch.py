@@ -0,0 +1,106 @@
+import gzip
+import json
+import logging
+from io import BytesIO
+
+import wire
+from delivery import DeliveryQueue
+
+
+class TemperatureBatcher(object):
+    """
+    Gathers the readings of every probe over a time window and uploads them as one JSON array, optionally
+    gzip compressed, so the number of requests depends on the window and not on the number of probes.
+
+    All the probes share the `delivery` queue of the batcher. Its workers wait up to `window` seconds
+    for readings to accumulate, and payloads larger than `max_bytes` are split before being sent.
+
+    Parameters
+    ----------
+    client: ApiClient
+        Client used to post the payloads.
+    url: String
+        Url accepting a JSON array of temperature readings.
+    window<optional>: Float
+        Seconds readings are gathered for before being uploaded.
+    max_readings<optional>: Integer
+        Maximum number of readings in one upload.
+    max_bytes<optional>: Integer
+        Maximum size in bytes of one (compressed) payload.
+    compress<optional>: Boolean
+        Whether payloads are gzip compressed, sent with a `Content-Encoding: gzip` header.
+    journal<optional>: Journal
+        Local journal the readings are recorded in until acknowledged.
+    wire_format<optional>: String
+        `auto` posts delta encoded `wire` payloads once the API advertises them, `compact` always does,
+        `json` keeps posting JSON.
+    """
+    def __init__(self, client, url, window=60.0, max_readings=500, max_bytes=64 * 1024, compress=True,
+                 journal=None, wire_format='auto'):
+        self.client = client
+        self.url = url
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.requests = 0
+        self.bytes_sent = 0
+        self.negotiation = wire.Negotiation(wire_format)
+
+        self.delivery = DeliveryQueue(self.post_batch, name='temperature-batches', maxsize=max(max_readings * 10, 1000),
+                                      batch_size=max_readings, linger_time=window, journal=journal,
+                                      kind='temperature')
+
+    def encode(self, readings, compact=False):
+        """
+        Serializes readings into a compact JSON array or a `wire` batch, gzipped when compression is on. Small
+        `wire` batches are left as they are, gzip only shrinks the long runs of equal deltas of large ones.
+
+        :return: The payload and the headers to send it with
+        """
+        if compact:
+            payload = wire.encode_temperatures(readings)
+            headers = {'Content-Type': wire.MEDIA_TYPE}
+        else:
+            payload = json.dumps(readings, separators=(',', ':'), default=str).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+
+        if self.compress:
+            buf = BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(payload)
+            if not compact or len(buf.getvalue()) < len(payload):
+                payload = buf.getvalue()
+                headers['Content-Encoding'] = 'gzip'
+
+        return payload, headers
+
+    def post_batch(self, readings):
+        """
+        Uploads readings from the delivery queue, splitting them over several requests if the payload
+        would be larger than `max_bytes`.
+
+        :return: The readings that could not be posted
+        """
+        compact = self.negotiation.compact()
+        payload, headers = self.encode(readings, compact)
+
+        if len(payload) > self.max_bytes and len(readings) > 1:
+            half = len(readings) // 2
+            failed = self.post_batch(readings[:half])
+            if failed:
+                return failed + readings[half:]
+            return self.post_batch(readings[half:])
+
+        response = self.client.post(self.url, data=payload, headers=headers)
+        self.requests += 1
+        self.bytes_sent += len(payload)
+
+        if not self.negotiation.observe(response, 'temperature', 'compact' if compact else 'json', len(readings)):
+            logging.warning("\n\tThe API doesn't take compact temperature batches, posting JSON")
+            return self.post_batch(readings)
+
+        if response.status_code >= 300:
+            logging.warning("\n\tBulk temperature upload was not successful: %s" % response.status_code)
+            return readings
+
+        logging.info("\n\tSuccessfully posted %s temperature readings!" % len(readings))
+        return []
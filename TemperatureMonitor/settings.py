@@ -7,6 +7,22 @@ TARGET_HOST = 'https://www.ipa-api.com'
 
 MAX_TEMP_F = 68  # Degrees Fahrenheit
 
+W1_BASEPATH = '/sys/bus/w1/devices/'  # Point at a fake one-wire tree to run without probes
+
+READ_INTERVAL = 10  # Seconds between two reads of the probes
+RESOLUTION = None  # Bits of conversion resolution (9-12) set on every probe, None keeps what the probes have
+
+POST_DATA = False
+
+# When True, the readings of every probe are gathered for BULK_WINDOW seconds and uploaded in one request
+BULK_UPLOAD = False
+BULK_URL = TARGET_HOST + '/temperatures/'
+BULK_WINDOW = 60  # Seconds
+BULK_MAX_READINGS = 500
+BULK_COMPRESS = True
+# `auto` switches the uploads to the compact binary format once the API advertises it, `json` never does
+BULK_WIRE = 'auto'
+
 try:
     from local_settings import *
 except ImportError:
@@ -0,0 +1,165 @@
+import os
+import glob
+import time
+import logging
+
+import metrics
+
+CONVERSION_SECONDS = metrics.histogram('keg_w1_conversion_seconds', 'Time to convert the temperatures of the '
+                                       'one-wire bus, for one bulk conversion or one w1_slave read', ['mode'])
+CRC_FAILURES = metrics.counter('keg_w1_crc_failures_total', 'Probe readings that failed their CRC check', ['probe'])
+PROBES = metrics.gauge('keg_w1_probes', 'Probes found on the one-wire bus by the last scan')
+
+BASEPATH = '/sys/bus/w1/devices/'
+
+# DS18B20 conversion time at 12 bit resolution, halving with every bit less
+MAX_CONVERSION_TIME = 0.75
+
+
+def conversion_time(resolution):
+    """
+    Seconds a DS18B20 takes to convert a temperature at `resolution` bits (9 to 12).
+    """
+    return MAX_CONVERSION_TIME / (2 ** (12 - resolution))
+
+
+def parse_w1_slave(lines):
+    """
+    Parses the content of a `w1_slave` file.
+
+    :param lines: The lines of the file
+    :return: The temperature in degrees Celsius, or None if the CRC check failed
+    """
+    if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+        return None
+
+    equals_pos = lines[1].find('t=')
+    if equals_pos == -1:
+        return None
+
+    return float(lines[1][equals_pos + 2:]) / 1000.0
+
+
+class W1BusScanner(object):
+    """
+    Reads every DS18B20 probe on the one-wire bus in a single pass.
+
+    Instead of reading each probe's `w1_slave` file, which starts a separate conversion per probe one
+    after the other, the scanner writes `trigger` to the `therm_bulk_read` attribute of each bus master.
+    That starts the conversion on all the probes at once, so a sweep takes one conversion time whatever
+    the number of probes. The results are then read from each probe's `temperature` attribute. Kernels
+    without `therm_bulk_read` fall back to reading the `w1_slave` files.
+
+    Parameters
+    ----------
+    basepath<optional>: String
+        Directory holding the one-wire devices, point it at a fake sysfs tree for testing.
+    resolution<optional>: Integer
+        Conversion resolution in bits (9 to 12) set on every probe. Lower resolutions convert faster.
+    resolutions<optional>: Dictionary
+        Resolution per probe id, overriding `resolution`.
+    """
+    def __init__(self, basepath=BASEPATH, resolution=None, resolutions=None):
+        self.basepath = basepath
+        self.resolution = resolution
+        self.resolutions = resolutions or {}
+        self.crc_failures = 0
+        self.last_scan_time = 0.0
+
+    def devices(self):
+        """
+        Paths of the probe directories. Listing only `28*` excludes the `w1_bus_master` directories.
+        """
+        return sorted(glob.glob(os.path.join(self.basepath, '28*')))
+
+    def masters(self):
+        return sorted(glob.glob(os.path.join(self.basepath, 'w1_bus_master*')))
+
+    def configure(self):
+        """
+        Writes the configured resolution to every probe supporting it.
+        """
+        for device in self.devices():
+            device_id = os.path.basename(device)
+            resolution = self.resolutions.get(device_id, self.resolution)
+            if resolution is None:
+                continue
+            if resolution < 9 or resolution > 12:
+                raise ValueError("Resolution must be between 9 and 12 bits, got %s" % resolution)
+
+            path = os.path.join(device, 'resolution')
+            if not os.path.exists(path):
+                logging.warning("\n\t%s does not support setting the resolution" % device_id)
+                continue
+            with open(path, 'w') as f:
+                f.write(str(resolution))
+
+    def max_conversion_time(self, devices):
+        resolutions = [self.resolutions.get(os.path.basename(device), self.resolution) for device in devices]
+        return max([conversion_time(r or 12) for r in resolutions] or [MAX_CONVERSION_TIME])
+
+    def scan(self):
+        """
+        Converts and reads every probe on the bus.
+
+        :return: Dictionary of probe id to temperature in degrees Celsius, None for failed reads
+        """
+        started = time.time()
+        devices = self.devices()
+        bulk_files = [os.path.join(master, 'therm_bulk_read') for master in self.masters()]
+        bulk_files = [path for path in bulk_files if os.path.exists(path)]
+
+        if bulk_files:
+            for path in bulk_files:
+                with open(path, 'w') as f:
+                    f.write('trigger')
+            with CONVERSION_SECONDS.labels('bulk').time():
+                self.wait_for_conversion(bulk_files, self.max_conversion_time(devices))
+            readings = dict((os.path.basename(device), self.read_converted(device)) for device in devices)
+        else:
+            readings = dict((os.path.basename(device), self.read_w1_slave(device)) for device in devices)
+
+        for device_id, value in readings.items():
+            if value is None:
+                self.crc_failures += 1
+                CRC_FAILURES.labels(device_id).inc()
+        PROBES.set(len(devices))
+        self.last_scan_time = time.time() - started
+        return readings
+
+    def wait_for_conversion(self, bulk_files, expected):
+        """
+        Sleeps for the expected conversion time, then polls until no master reports a conversion in
+        progress (-1).
+        """
+        time.sleep(expected)
+        deadline = time.time() + expected
+        while time.time() < deadline:
+            pending = False
+            for path in bulk_files:
+                with open(path) as f:
+                    if f.read().strip() == '-1':
+                        pending = True
+            if not pending:
+                return
+            time.sleep(0.01)
+
+    def read_converted(self, device):
+        """
+        Reads the result of the bulk conversion of a probe, which doesn't start a new conversion.
+        """
+        path = os.path.join(device, 'temperature')
+        if not os.path.exists(path):
+            return self.read_w1_slave(device)
+
+        with open(path) as f:
+            value = f.read().strip()
+        if not value:
+            return None
+        return float(value) / 1000.0
+
+    def read_w1_slave(self, device):
+        # Reading w1_slave converts the probe's temperature on the spot
+        with CONVERSION_SECONDS.labels('w1_slave').time():
+            with open(os.path.join(device, 'w1_slave')) as f:
+                return parse_w1_slave(f.readlines())
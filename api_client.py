@@ -0,0 +1,210 @@
+import json
+import time
+import base64
+import logging
+import threading
+
+import metrics
+
+REQUEST_SECONDS = metrics.histogram('keg_http_request_seconds', 'Round trip time of the requests to the API',
+                                    ['url'])
+RESPONSES = metrics.counter('keg_http_responses_total', 'Responses from the API by status code, `error` when '
+                            'no response came back', ['url', 'code'])
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(auth_url, username, password, **kwargs):
+    """
+    Returns the client shared by every sensor authenticating against `auth_url` as `username`, so they all
+    reuse one connection pool and one token.
+    """
+    key = (auth_url, username)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ApiClient(auth_url, username, password, **kwargs)
+        return client
+
+
+class ApiClient(object):
+    """
+    HTTP client keeping keep-alive connections to the API in a pooled `requests.Session` and caching the
+    auth token until it expires. `requests` is only imported once the first request is made.
+
+    The token is refreshed by a background timer shortly before it expires, so posts from the delivery
+    workers don't pay for authenticating. A post that is rejected with a 401 gets a fresh token and is
+    retried once.
+
+    Parameters
+    ----------
+    auth_url: String
+        Url the token is requested from.
+    username: String
+    password: String
+    auth_format<optional>: String
+        `form` posts the credentials form encoded and expects `{"success": true, "token": ...}` back (the
+        flowmeter API), `json` posts them as JSON and expects `{"token": ...}` (the temperature API).
+    token_location<optional>: String
+        `form` adds the token to the posted data as a `token` field, `header` sends it in an
+        `Authorization: Token ...` header. Raw bodies always get the header.
+    token_ttl<optional>: Integer
+        Seconds a token is assumed to be valid when it doesn't carry its own `exp` claim.
+    refresh_margin<optional>: Integer
+        Seconds before expiry at which the token is refreshed in the background.
+    pool_size<optional>: Integer
+        Maximum number of connections kept alive per host.
+    timeout<optional>: Float
+        Seconds to wait for the API before giving up on a request.
+    """
+    def __init__(self, auth_url, username, password, auth_format='json', token_location='header',
+                 token_ttl=24 * 3600, refresh_margin=3600, pool_size=4, timeout=10.0):
+        self.auth_url = auth_url
+        self.username = username
+        self.password = password
+        self.auth_format = auth_format
+        self.token_location = token_location
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+
+        self.lock = threading.Lock()
+        self.cached_token = None
+        self.expires = 0
+        self.refresh_timer = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def token(self):
+        """
+        Returns a valid token, only authenticating when there is no cached one or it has expired.
+        """
+        with self.lock:
+            if self.cached_token is None or time.time() >= self.expires:
+                self.authenticate()
+            return self.cached_token
+
+    def invalidate(self):
+        with self.lock:
+            self.cached_token = None
+
+    def authenticate(self):
+        """
+        Requests a new token and schedules its background refresh. Must be called holding `lock`.
+        """
+        logging.info("\n\tauth url: %s" % self.auth_url)
+        login_data = {'username': self.username, 'password': self.password}
+
+        if self.auth_format == 'form':
+            response = self.request(self.auth_url, data=login_data, timeout=self.timeout)
+        else:
+            response = self.request(self.auth_url, json=login_data, timeout=self.timeout)
+        data = json.loads(response.text)
+
+        if 'token' not in data or data.get('success') is False:
+            raise Exception("Unauthorized! Please check the username and password.")
+
+        logging.info("\n\tSuccessfully retrieved token!")
+        self.cached_token = data['token']
+        self.expires = token_expiry(self.cached_token, time.time() + self.token_ttl)
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+
+        delay = max(self.expires - self.refresh_margin - time.time(), 1)
+        self.refresh_timer = threading.Timer(delay, self.refresh)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def refresh(self):
+        try:
+            with self.lock:
+                self.authenticate()
+        except Exception as e:
+            logging.error("\n\tCould not refresh the auth token")
+            logging.error(e)
+            # Try again in a minute, the cached token is still good until it expires
+            self.refresh_timer = threading.Timer(60, self.refresh)
+            self.refresh_timer.daemon = True
+            self.refresh_timer.start()
+
+    def post(self, url, data=None, **kwargs):
+        """
+        Posts to the API with the auth token, retrying once with a new token on a 401.
+
+        :return: The `requests` response
+        """
+        response = self.request(url, **self.authorize(data, kwargs))
+        if response.status_code == 401:
+            logging.warning("\n\tToken was rejected, authenticating again")
+            self.invalidate()
+            response = self.request(url, **self.authorize(data, kwargs))
+        return response
+
+    def request(self, url, **kwargs):
+        """
+        Posts with the pooled session, recording the round trip time and the status code.
+        """
+        started = time.time()
+        try:
+            response = self.session.post(url, **kwargs)
+        except Exception:
+            RESPONSES.labels(url, 'error').inc()
+            raise
+        finally:
+            REQUEST_SECONDS.labels(url).observe(time.time() - started)
+        RESPONSES.labels(url, response.status_code).inc()
+        return response
+
+    def authorize(self, data, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        token = self.token()
+
+        # A raw body (a compact `wire` batch) has no fields to add the token to
+        if self.token_location == 'form' and not isinstance(data, bytes):
+            data = dict(data or {})
+            data['token'] = token
+        else:
+            headers = dict(kwargs.get('headers') or {})
+            headers['Authorization'] = 'Token %s' % token
+            kwargs['headers'] = headers
+
+        if data is not None:
+            kwargs['data'] = data
+        return kwargs
+
+    def close(self):
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+        if self._session is not None:
+            self._session.close()
+
+
+def token_expiry(token, default):
+    """
+    Reads the `exp` claim of a JSON Web Token, falling back to `default` for any other kind of token.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))
+        return float(claims['exp'])
+    except Exception:
+        return default
@@ -0,0 +1,169 @@
+"""
+Compares the pulse capture jitter of the threaded model, where the GPIO callbacks share the interpreter with the
+rest of the keg server, against a SamplerProcess writing the pulses to shared memory, with and without load
+(JSON encoding of large payloads and logging, like the delivery and streaming threads) in the main process.
+
+    python benchmarks/bench_sampler.py [seconds] [frequency]
+
+The pulse train is driven in real time by a thread of the process capturing the pulses, standing in for the
+interrupt: like the RPi.GPIO callback thread, it has to get the interpreter to timestamp an edge. Jitter is how
+far the interval between two captured pulses is from the period of the train.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gpio_backend import SimulatedGPIO
+from flowmeter import FlowMeter
+from tap_manager import TapManager
+from sampler import SamplerProcess, SampledGPIO
+
+PIN = 17
+LOAD_THREADS = 2
+
+
+class DrivenSampler(SamplerProcess):
+    """
+    A sampling process that also drives the pulse train onto its simulated pin.
+    """
+    def __init__(self, gpio, frequency, count):
+        super(DrivenSampler, self).__init__([PIN], gpio=gpio)
+        self.frequency = frequency
+        self.count = count
+
+    def run(self):
+        driver = threading.Thread(target=drive, args=(self.gpio, self.frequency, self.count))
+        driver.daemon = True
+        driver.start()
+        super(DrivenSampler, self).run()
+
+
+def drive(gpio, frequency, count):
+    # Give the pins time to be set up
+    time.sleep(0.2)
+    gpio.play(PIN, frequency, count)
+
+
+def load(stop):
+    """
+    What the delivery, stream and logging threads do to the interpreter: long stretches in C holding it.
+    """
+    payload = [{'kegid': i, 'volume': i * 0.1, 'duration': 3.2, 'flowRate': 1.7, 'time': time.time()}
+               for i in range(20000)]
+    logger = logging.getLogger('bench-load')
+    while not stop.is_set():
+        logger.info(json.dumps(payload))
+        time.sleep(0.001)
+
+
+def capture(meter):
+    """
+    Records the timestamp of every pulse fed to `meter`.
+    """
+    timestamps = []
+    record = meter.recordPulse
+
+    def recordPulse(currentTime):
+        timestamps.append(currentTime)
+        record(currentTime)
+    meter.recordPulse = recordPulse
+    return timestamps
+
+
+def run_threads(seconds, frequency, loaded):
+    gpio = SimulatedGPIO()
+    gpio.drive(PIN, 0)
+    meter = FlowMeter(1, PIN, gpio=gpio)
+    timestamps = capture(meter)
+    manager = TapManager([meter], gpio=gpio, connect=False)
+    manager.daemon = True
+    manager.start()
+
+    stop, loaders = start_load(loaded)
+    time.sleep(0.2)
+    gpio.play(PIN, frequency, int(seconds * frequency))
+    time.sleep(0.1)
+    stop_load(stop, loaders)
+    manager.stop()
+    manager.join()
+    return timestamps
+
+
+def run_process(seconds, frequency, loaded):
+    gpio = SimulatedGPIO()
+    gpio.drive(PIN, 0)
+    count = int(seconds * frequency)
+    # Forked before any other thread of this run exists
+    sampler = DrivenSampler(gpio, frequency, count)
+    sampler.start()
+
+    sampled = SampledGPIO(gpio, sampler)
+    meter = FlowMeter(1, PIN, gpio=sampled)
+    timestamps = capture(meter)
+    manager = TapManager([meter], gpio=sampled, connect=False)
+    manager.daemon = True
+    manager.start()
+
+    stop, loaders = start_load(loaded)
+    started = time.time()
+    while len(timestamps) < count and time.time() - started < seconds * 3 + 1:
+        time.sleep(0.05)
+    stop_load(stop, loaders)
+    manager.stop()
+    manager.join()
+    sampled.cleanup()
+    sampler.stop()
+    return timestamps
+
+
+def start_load(loaded):
+    stop = threading.Event()
+    loaders = [threading.Thread(target=load, args=(stop,)) for _ in range(LOAD_THREADS if loaded else 0)]
+    for loader in loaders:
+        loader.start()
+    return stop, loaders
+
+
+def stop_load(stop, loaders):
+    stop.set()
+    for loader in loaders:
+        loader.join()
+
+
+def jitter(timestamps, frequency):
+    """
+    :return: (median, 99th percentile, max) distance of the pulse intervals from the period, in milliseconds
+    """
+    period = 1000.0 / frequency
+    deviations = sorted(abs(b - a - period) for a, b in zip(timestamps, timestamps[1:]))
+    if not deviations:
+        return 0.0, 0.0, 0.0
+    return (deviations[len(deviations) // 2], deviations[int(len(deviations) * 0.99)], deviations[-1])
+
+
+def main(seconds=3.0, frequency=200.0):
+    # Nothing to connect to, and the load threads log to nowhere
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger('bench-load').propagate = False
+    logging.getLogger('bench-load').addHandler(logging.FileHandler(os.devnull))
+
+    count = int(seconds * frequency)
+    print('%d pulses at %d Hz, jitter of the captured pulse intervals' % (count, frequency))
+    print('%-10s %-8s %10s %10s %10s %10s' % ('model', 'load', 'captured', 'p50 ms', 'p99 ms', 'max ms'))
+    for loaded in (False, True):
+        for name, run in (('process', run_process), ('threads', run_threads)):
+            timestamps = run(seconds, frequency, loaded)
+            median, p99, worst = jitter(timestamps, frequency)
+            print('%-10s %-8s %10s %10.3f %10.3f %10.3f' % (name, 'loaded' if loaded else 'idle',
+                                                             '%d/%d' % (len(timestamps), count), median, p99,
+                                                             worst))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,377 @@
+"""
+Throughput benchmarks of the flowmeter, hx711, one-wire, GPIO character device and I2C expander code against the
+simulated backends, no Pi needed:
+
+    python benchmarks/bench_sensors.py [--seconds 2] [--save results.json] [--baseline results.json]
+
+For every subsystem it reports the highest rate it keeps up with, the CPU time per pulse, sample or probe
+read, and how many events it missed. Save a run on a known good commit with `--save`, then compare later runs
+to it with `--baseline`: the script exits with status 1 when a result is more than `--tolerance` worse.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TemperatureMonitor'))
+
+from gpio_backend import SimulatedGPIO, monotonic_ns
+from gpio_cdev import CdevGPIO
+from gpio_mcp23017 import ExpanderGPIO, LATENCY
+from simulation import PulseTrain, SimulatedHX711, FakeW1Bus, FakeChip, FakeI2CBus
+from flowmeter import FlowMeter
+from tap_manager import TapManager
+from hx711 import HX711
+from hx711_multi import MultiHX711
+from w1bus import W1BusScanner
+
+PULSE_RATES = (250, 500, 1000, 2000, 4000, 8000)
+CELL_COUNTS = (1, 4, 8)
+PROBE_COUNTS = (1, 8, 32)
+EXPANDER_TAPS = (16, 32)
+# Pulses per second of a YF-S201 at 4 and 13 L/min, a fast beer tap and far more than any tap pours
+EXPANDER_RATES = (30, 100)
+
+# A rate is sustained when no more than this share of the pulses is missed
+MAX_MISSED = 0.01
+
+
+def cpu_time():
+    """
+    CPU seconds used by the process so far, every thread included.
+    """
+    return time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+
+class Results(object):
+    """
+    Named measurements, each knowing whether higher or lower is better.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, value, better='higher'):
+        self.values[name] = {'value': value, 'better': better}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.values, f, indent=2, sort_keys=True)
+
+    def compare(self, path, tolerance):
+        """
+        Prints the change of every measurement against a saved baseline.
+
+        :return: The names of the measurements that regressed by more than `tolerance`
+        """
+        with open(path) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for name in sorted(self.values):
+            if name not in baseline or not baseline[name]['value']:
+                continue
+            current = self.values[name]['value']
+            previous = baseline[name]['value']
+            change = (current - previous) / float(previous)
+            worse = -change if self.values[name]['better'] == 'higher' else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print('%-40s %12.2f -> %12.2f  %+7.1f%%%s' % (name, previous, current, change * 100, flag))
+        return regressions
+
+
+def play(gpio, capture, frequency, count):
+    """
+    Puts `count` pulses on pin 17 in real time. Edge capture needs real edges, driven from this thread,
+    while a polling sampler reads a level computed from the clock so no driver thread competes with it.
+
+    :return: Seconds the train took
+    """
+    if capture == 'edge':
+        return gpio.play(17, frequency, count)
+
+    train = PulseTrain(frequency, count)
+    gpio.feed(17, train)
+    # A single long sleep, waking up to check would steal the interpreter from the sampler
+    time.sleep(float(count) / frequency)
+    while not train.done():
+        time.sleep(0.01)
+    return float(count) / frequency
+
+
+def start_tap(capture):
+    gpio = SimulatedGPIO()
+    # Idle low, so the first pulse of a train is a rising edge
+    gpio.drive(17, 0)
+    meter = FlowMeter(1, 17, capture=capture, gpio=gpio)
+    manager = TapManager([meter], capture=capture, gpio=gpio, connect=False)
+    manager.start()
+    time.sleep(0.1)
+    return gpio, meter, manager
+
+
+def edge_cpu_per_pulse(count):
+    """
+    CPU seconds per pulse of the edge callback and the sampler, from a train driven as fast as possible,
+    minus the cost of driving the same train onto a pin nobody listens to.
+    """
+    driver = cpu_time()
+    SimulatedGPIO().pulse(17, count)
+    driver = cpu_time() - driver
+
+    gpio, meter, manager = start_tap('edge')
+    cpu = cpu_time()
+    gpio.pulse(17, count)
+    while meter.pour.pulses < count:
+        time.sleep(0.001)
+    cpu = cpu_time() - cpu - driver
+    manager.stop()
+    manager.join()
+    return max(cpu, 0.0) / count
+
+
+def bench_flowmeter(results, seconds):
+    print('\nFlowmeter: one tap fed a pulse train')
+    for capture in ('edge', 'poll'):
+        sustained = 0
+        for frequency in PULSE_RATES:
+            count = int(frequency * seconds)
+            gpio, meter, manager = start_tap(capture)
+
+            cpu = cpu_time()
+            elapsed = play(gpio, capture, frequency, count)
+            time.sleep(0.1)
+            manager.stop()
+            manager.join()
+            cpu = cpu_time() - cpu
+
+            recorded = meter.pour.pulses
+            missed = count - recorded
+            achieved = count / elapsed
+            # The driver falling behind the train means the callbacks are too slow for this rate
+            kept_up = missed <= count * MAX_MISSED and achieved >= frequency * (1 - MAX_MISSED)
+            if kept_up:
+                sustained = frequency
+            print('  %-5s %6d Hz  achieved=%8.0f Hz  missed=%6d  passes=%d' % (
+                capture, frequency, achieved, missed, manager.passes))
+
+            if capture == 'poll' and frequency == PULSE_RATES[0]:
+                # The polling loop never sleeps, all of its time is spent sampling
+                results.add('flowmeter.poll.cpu_per_pulse_us', cpu / max(recorded, 1) * 1e6, 'lower')
+            if not kept_up:
+                break
+
+        print('  %-5s max sustained pulse rate: %d Hz' % (capture, sustained))
+        results.add('flowmeter.%s.max_pulse_rate' % capture, sustained)
+
+    per_pulse = edge_cpu_per_pulse(int(PULSE_RATES[-1] * seconds))
+    print('  edge  cpu/pulse=%7.1f us (%d pulses/s per core)' % (per_pulse * 1e6, 1 / max(per_pulse, 1e-9)))
+    results.add('flowmeter.edge.cpu_per_pulse_us', per_pulse * 1e6, 'lower')
+
+
+def bench_hx711(results, seconds):
+    print('\nHX711: read_raw with conversions always ready')
+    gpio = SimulatedGPIO()
+    SimulatedHX711(gpio, 5, 6, values=-123456, rate=None)
+    hx = HX711(5, 6, gpio=gpio)
+    reads = 0
+    cpu = cpu_time()
+    started = time.time()
+    while time.time() - started < seconds:
+        hx.read_raw()
+        reads += 1
+    elapsed = time.time() - started
+    cpu = cpu_time() - cpu
+    print('  %8.0f samples/s  cpu/sample=%7.1f us' % (reads / elapsed, cpu / reads * 1e6))
+    results.add('hx711.max_sample_rate', reads / elapsed)
+    results.add('hx711.cpu_per_sample_us', cpu / reads * 1e6, 'lower')
+
+    print('\nHX711: streaming at 80 SPS')
+    gpio = SimulatedGPIO()
+    chip = SimulatedHX711(gpio, 5, 6, values=4242, rate=80)
+    hx = HX711(5, 6, gpio=gpio)
+    chip.overwritten = 0
+    conversions = chip.conversions
+    cpu = cpu_time()
+    hx.start_stream(rate=80)
+    time.sleep(seconds)
+    hx.stop_stream()
+    chip.stop()
+    cpu = cpu_time() - cpu
+    produced = chip.conversions - conversions
+    print('  conversions=%d  streamed=%d  missed=%d  cpu/sample=%7.1f us  timeouts=%d' % (
+        produced, hx.count, chip.overwritten, cpu / max(hx.count, 1) * 1e6, hx.timeouts))
+    results.add('hx711.stream_missed', chip.overwritten, 'lower')
+
+    print('\nMultiHX711: cells on one clock, conversions always ready')
+    for count in CELL_COUNTS:
+        gpio = SimulatedGPIO()
+        douts = range(10, 10 + count)
+        for dout in douts:
+            SimulatedHX711(gpio, dout, 6, values=dout * 1000, rate=None)
+        multi = MultiHX711(douts, 6, gpio=gpio)
+        sweeps = 0
+        cpu = cpu_time()
+        started = time.time()
+        while time.time() - started < seconds:
+            multi.read()
+            sweeps += 1
+        elapsed = time.time() - started
+        cpu = cpu_time() - cpu
+        print('  cells=%-2d %8.0f sweeps/s  cpu/cell sample=%7.1f us' % (
+            count, sweeps / elapsed, cpu / (sweeps * count) * 1e6))
+        results.add('hx711_multi.%d.cell_sample_rate' % count, sweeps * count / elapsed)
+
+
+def bench_w1(results, seconds):
+    print('\nOne-wire: full bus sweeps at 9 bit resolution')
+    for bulk in (True, False):
+        for count in PROBE_COUNTS:
+            bus = FakeW1Bus(bulk=bulk)
+            for i in range(count):
+                bus.add_probe(temperature=4.0 + i / 10.0)
+            scanner = W1BusScanner(bus.basepath, resolution=9)
+            scanner.configure()
+
+            sweeps = 0
+            failed = 0
+            cpu = cpu_time()
+            started = time.time()
+            while time.time() - started < seconds:
+                readings = scanner.scan()
+                failed += sum(1 for value in readings.values() if value is None)
+                sweeps += 1
+            elapsed = time.time() - started
+            cpu = cpu_time() - cpu
+            bus.cleanup()
+
+            name = 'bulk' if bulk else 'w1_slave'
+            print('  %-8s probes=%-3d sweep=%7.1f ms  cpu/probe read=%7.1f us  failed reads=%d' % (
+                name, count, elapsed / sweeps * 1000, cpu / (sweeps * count) * 1e6, failed))
+            results.add('w1.%s.%d.cpu_per_probe_us' % (name, count), cpu / (sweeps * count) * 1e6, 'lower')
+
+
+def bench_cdev(results, seconds):
+    print('\nGPIO character device: kernel timestamped edges read in batches')
+    # `seconds` worth of pulses at the highest rate, queued at once and dispatched as fast as possible
+    count = int(PULSE_RATES[-1] * seconds)
+    chip = FakeChip()
+    gpio = CdevGPIO(chip)
+    meter = FlowMeter(1, 17, gpio=gpio)
+    manager = TapManager([meter], gpio=gpio, connect=False)
+    manager.daemon = True
+    manager.start()
+    time.sleep(0.1)
+
+    cpu = cpu_time()
+    started = time.time()
+    chip.pulses(17, count, PULSE_RATES[-1])
+    while meter.pour.pulses < count and time.time() - started < seconds * 10:
+        time.sleep(0.001)
+    elapsed = time.time() - started
+    cpu = cpu_time() - cpu
+    print('  %8.0f edges/s  cpu/edge=%7.1f us  recorded=%d/%d' % (
+        meter.pour.pulses / elapsed, cpu / max(meter.pour.pulses, 1) * 1e6, meter.pour.pulses, count))
+    results.add('cdev.edge_rate', meter.pour.pulses / elapsed)
+    results.add('cdev.cpu_per_edge_us', cpu / max(meter.pour.pulses, 1) * 1e6, 'lower')
+
+    manager.stop()
+    manager.join()
+    gpio.cleanup()
+
+    # A pour the process only gets to read after a stall of the same length, all of its edges at once
+    chip = FakeChip()
+    gpio = CdevGPIO(chip)
+    meter = FlowMeter(1, 17, gpio=gpio)
+    manager = TapManager([meter], gpio=gpio, connect=False)
+    manager.start()
+    time.sleep(0.1)
+
+    pours = []
+    meter.emitTotalPour = pours.append
+    duration = 1.8
+    chip.pulses(17, int(500 * duration), 500, started=monotonic_ns() - int(duration * 2 * 1e9))
+    time.sleep(meter.POUR_TIMEOUT / 1000.0 * 2)
+    manager.stop()
+    manager.join()
+    if pours:
+        error = abs(pours[-1]['duration'] - duration) / duration
+        print('  pour read after a %.1f s stall: duration=%.3f s (%.2f%% off), %d pour(s)' % (
+            duration, pours[-1]['duration'], error * 100, len(pours)))
+        results.add('cdev.stalled_pour_duration_error', error, 'lower')
+    gpio.cleanup()
+
+
+def bench_expander(results, seconds):
+    print('\nI2C expanders: taps on MCP23017 pins at 400 kHz, one shared interrupt line')
+    for taps, rate in [(taps, rate) for taps in EXPANDER_TAPS for rate in EXPANDER_RATES]:
+        native = SimulatedGPIO()
+        bus = FakeI2CBus()
+        addresses = [0x20 + i for i in range((taps + 15) // 16)]
+        for address in addresses:
+            bus.add_mcp23017(address)
+        bus.interrupt(native, 17)
+        gpio = ExpanderGPIO(native, bus, addresses, interrupt=17)
+        meters = [FlowMeter(i + 1, gpio.base + i, gpio=gpio) for i in range(taps)]
+        manager = TapManager(meters, gpio=gpio, connect=False)
+        manager.daemon = True
+        manager.start()
+        time.sleep(0.1)
+
+        # Every tap pouring at once, slightly different rates so the edges drift across each other
+        frequencies = dict(((addresses[i // 16], i % 16), rate * (1 + 0.01 * i)) for i in range(taps))
+        reads, latency, observed = bus.transactions, LATENCY.default.sum, LATENCY.default.count
+        cpu = cpu_time()
+        counts = bus.play(frequencies, seconds)
+        time.sleep(0.1)
+        cpu = cpu_time() - cpu
+        reads = bus.transactions - reads
+        latency = (LATENCY.default.sum - latency) / max(LATENCY.default.count - observed, 1)
+
+        played = sum(counts.values())
+        recorded = sum(meter.pour.pulses for meter in meters)
+        missed = max(played - recorded, 0) / float(played)
+        print('  %2d taps at %3d Hz  pulses=%6d/%-6d missed=%5.2f%%  reads/s=%5.0f  interrupt to dispatch=%5.2f '
+              'ms  cpu=%3.0f%%' % (taps, rate, recorded, played, missed * 100, reads / seconds, latency * 1000,
+                               cpu / seconds * 100))
+        results.add('expander.taps_%d_%dhz.missed' % (taps, rate), missed, 'lower')
+        results.add('expander.taps_%d_%dhz.latency_ms' % (taps, rate), latency * 1000, 'lower')
+
+        manager.stop()
+        manager.join()
+        gpio.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=2.0, help='duration of every measurement')
+    parser.add_argument('--only', choices=('flowmeter', 'hx711', 'w1', 'cdev', 'expander'), help='run a single subsystem')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    # The flowmeters have no socket connection or API to talk to
+    logging.disable(logging.CRITICAL)
+
+    results = Results()
+    for name, bench in (('flowmeter', bench_flowmeter), ('hx711', bench_hx711), ('w1', bench_w1),
+                        ('cdev', bench_cdev), ('expander', bench_expander)):
+        if args.only in (None, name):
+            bench(results, args.seconds)
+
+    if args.save:
+        results.save(args.save)
+    if args.baseline:
+        print('\nCompared to %s' % args.baseline)
+        if results.compare(args.baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
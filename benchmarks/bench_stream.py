@@ -0,0 +1,104 @@
+"""
+Measures the latency from `PourStream.publish` to a display receiving the event, and the cost of a publish
+for the sampling loop, with one display that never reads to check it doesn't hold anyone up.
+
+    python benchmarks/bench_stream.py [clients] [events] [rate]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stream_server import PourStream, DROPPED
+
+
+def connect(port, receive_buffer=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if receive_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sock.connect(('127.0.0.1', port))
+    sock.sendall(b'GET /events HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n')
+    return sock
+
+
+def receive(sock, count, latencies):
+    """
+    Reads events until `count` pour intervals came in, recording the latency of each.
+    """
+    data = b''
+    received = 0
+    while received < count:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        now = time.time()
+        data += chunk
+        while b'\n\n' in data:
+            message, data = data.split(b'\n\n', 1)
+            for line in message.split(b'\n'):
+                if line.startswith(b'data: '):
+                    event = json.loads(line[6:].decode('utf-8'))
+                    latencies.append(now - event['time'])
+                    received += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 200.0
+
+    logging.disable(logging.CRITICAL)
+    stream = PourStream(port=0, host='127.0.0.1', buffer_size=64)
+    stream.start()
+
+    # Never reads, its socket buffers and then its event buffer fill up
+    stalled = connect(stream.port, receive_buffer=4096)
+    readers = []
+    for i in range(clients):
+        latencies = []
+        thread = threading.Thread(target=receive, args=(connect(stream.port), events, latencies))
+        thread.daemon = True
+        thread.start()
+        readers.append((thread, latencies))
+
+    while len(stream.clients) < clients + 1:
+        time.sleep(0.01)
+
+    publish_time = 0.0
+    started = time.time()
+    for i in range(events):
+        target = started + i / rate
+        delay = target - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        before = time.time()
+        stream.publish('pourInterval', {'kegid': 1, 'volume': i / 10.0, 'time': before})
+        publish_time += time.time() - before
+
+    for thread, latencies in readers:
+        thread.join(10)
+
+    latencies = [latency for thread, latencies in readers for latency in latencies]
+    print('clients=%d events=%d rate=%.0f/s' % (clients, events, rate))
+    print('publish: %.1f us per event' % (publish_time / events * 1e6))
+    print('latency: p50=%.2f ms  p99=%.2f ms  max=%.2f ms  received=%d/%d' % (
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+        len(latencies), events * clients))
+    print('events dropped for the stalled client: %d' % DROPPED.default.get())
+
+    stalled.close()
+    stream.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Compares the per-tap sampling accuracy of one polling thread per FlowMeter against a single TapManager
+sampling every tap, using simulated pins that carry a square wave. Each tap's pulse count is reported as its
+signed error from the pulses sent, negative for missed pulses and positive for double counted ones.
+
+    python benchmarks/bench_taps.py [seconds] [frequency]
+"""
+import os
+import sys
+import time
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gpio_backend import SimulatedGPIO
+from flowmeter import FlowMeter
+from tap_manager import TapManager
+
+TAP_COUNTS = (1, 2, 4, 8, 16)
+
+
+class SquareWaveGPIO(SimulatedGPIO):
+    """
+    Simulated pins whose level is a square wave of `frequency` Hz, counting every read of each pin.
+    """
+    def __init__(self, frequency):
+        super(SquareWaveGPIO, self).__init__()
+        self.frequency = frequency
+        self.start = time.time()
+        self.reads = {}
+
+    def input(self, channel):
+        self.reads[channel] = self.reads.get(channel, 0) + 1
+        return int((time.time() - self.start) * self.frequency * 2) & 1
+
+
+def make_meters(count, gpio):
+    return [FlowMeter(kegId, 100 + kegId, capture='poll', gpio=gpio) for kegId in range(count)]
+
+
+def run_threads(count, seconds, frequency):
+    gpio = SquareWaveGPIO(frequency)
+    meters = make_meters(count, gpio)
+    for meter in meters:
+        meter.setupPin()
+    threads = [threading.Thread(target=meter.pollLoop) for meter in meters]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    for meter in meters:
+        meter.stop()
+    for thread in threads:
+        thread.join()
+    return gpio, meters
+
+
+def run_manager(count, seconds, frequency):
+    gpio = SquareWaveGPIO(frequency)
+    meters = make_meters(count, gpio)
+    manager = TapManager(meters, capture='poll', gpio=gpio, connect=False)
+    manager.start()
+    time.sleep(seconds)
+    manager.stop()
+    manager.join()
+    return gpio, meters
+
+
+def report(name, count, seconds, frequency, gpio, meters):
+    expected = seconds * frequency
+    # Signed, so double counted pulses show up as well as missed ones
+    errors = [(meter.pour.pulses - expected) / float(expected) for meter in meters]
+    worst = max(errors, key=abs)
+    rate = sum(gpio.reads.values()) / float(count) / seconds
+    print('%-8s taps=%-3d samples/s per tap=%10.0f  worst error=%+7.1f%%  mean abs error=%6.1f%%' % (
+        name, count, rate, worst * 100, sum(abs(error) for error in errors) / len(errors) * 100))
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    frequency = float(sys.argv[2]) if len(sys.argv) > 2 else 200.0
+
+    # The flowmeters have no socket connection, so silence the emit errors
+    logging.disable(logging.CRITICAL)
+
+    for count in TAP_COUNTS:
+        report('threads', count, seconds, frequency, *run_threads(count, seconds, frequency))
+        report('manager', count, seconds, frequency, *run_manager(count, seconds, frequency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Measures what recording sensor traces costs and what replaying them gives back:
+
+    python benchmarks/bench_trace.py [pulses]
+
+* the time `TraceRecorder` adds to every edge, hx711 conversion and probe reading, and the bytes it writes
+* how long finding a one minute window in a long trace takes through the time index, against a full scan
+* a live pour session captured by the `TapManager` through `RecordingGPIO`, replayed with `replay_pours` as fast
+  as it goes and with `ReplayGPIO` in real time, and how far the replayed pours are from the live ones
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gpio_backend import SimulatedGPIO, monotonic_ns
+from flowmeter import FlowMeter
+from tap_manager import TapManager
+import sensor_trace
+from sensor_trace import TraceRecorder, TraceReader, RecordingGPIO, ReplayGPIO, PourCollector, replay_pours
+
+POUR_TIMEOUT = 300
+# (pin, frequency, pulses) of the pours of the live session, one tap after the other
+POURS = [(17, 200, 600), (27, 120, 240), (17, 300, 150), (22, 80, 400), (27, 250, 500)]
+
+
+def bench_recorder(directory, count):
+    recorder = TraceRecorder(os.path.join(directory, 'recorder.bin'))
+    timestamp = monotonic_ns()
+    started = time.time()
+    for i in range(count):
+        recorder.edge(17, 1, timestamp + i * 5000000)
+    edge = (time.time() - started) / count * 1e6
+
+    started = time.time()
+    for i in range(count):
+        recorder.hx711(5, i)
+    hx711 = (time.time() - started) / count * 1e6
+
+    started = time.time()
+    for i in range(count // 10):
+        recorder.w1('28-%012x' % (i % 8), 3.5 + i % 3)
+    w1 = (time.time() - started) / (count // 10) * 1e6
+    recorder.close()
+
+    size = os.path.getsize(recorder.path) + os.path.getsize(recorder.path + '.idx')
+    print('recording %d edges, %d hx711 conversions, %d probe readings' % (count, count, count // 10))
+    print('  %-28s %10.2f us' % ('edge', edge))
+    print('  %-28s %10.2f us' % ('hx711 conversion', hx711))
+    print('  %-28s %10.2f us' % ('probe reading', w1))
+    print('  %-28s %10.2f bytes' % ('per record, index included', float(size - sensor_trace.HEADER_SIZE) /
+                                    (count * 2 + count // 10)))
+    print('')
+
+
+def bench_window(directory, hours):
+    """
+    A trace of a tap pouring at 100 Hz for `hours`, of which a minute is read.
+    """
+    path = os.path.join(directory, 'window.bin')
+    recorder = TraceRecorder(path)
+    origin = recorder.origin
+    count = int(hours * 3600 * 100)
+    for i in range(count):
+        recorder.edge(17, 1, origin + i * 10000000)
+    recorder.close()
+
+    reader = TraceReader(path)
+    middle = hours * 1800.0
+    started = time.time()
+    window = reader.range(middle, middle + 60, kind=sensor_trace.EDGE)
+    indexed = time.time() - started
+
+    index, reader.index = reader.index, reader.index[:0]
+    started = time.time()
+    scanned = reader.range(middle, middle + 60, kind=sensor_trace.EDGE)
+    full = time.time() - started
+    reader.index = index
+    assert len(window) == len(scanned) == 6000
+
+    print('one minute out of a %.1f hour trace (%d records, %.1f MB)' % (hours, count,
+                                                                        os.path.getsize(path) / 1e6))
+    print('  %-28s %10.2f ms' % ('through the index', indexed * 1000))
+    print('  %-28s %10.2f ms' % ('full scan', full * 1000))
+    print('')
+
+
+def meters(gpio):
+    return [FlowMeter(keg, pin, gpio=gpio, delivery=PourCollector())
+            for keg, pin in ((1, 17), (2, 27), (3, 22))]
+
+
+def pours(taps):
+    return [(meter.kegId, pour['volume'], pour['duration']) for meter in taps for pour in meter.delivery.pours]
+
+
+def run_live(path, scale):
+    gpio = SimulatedGPIO()
+    recorder = TraceRecorder(path, info={'taps': [{'keg': 1, 'pin': 17}, {'keg': 2, 'pin': 27},
+                                                   {'keg': 3, 'pin': 22}]})
+    recording = RecordingGPIO(gpio, recorder)
+    taps = meters(recording)
+    manager = TapManager(taps, gpio=recording, connect=False)
+    manager.daemon = True
+    manager.start()
+    time.sleep(0.2)
+    for pin, frequency, count in POURS:
+        gpio.play(pin, frequency, int(count * scale))
+        time.sleep(POUR_TIMEOUT / 1000.0 * 2)
+    manager.stop()
+    manager.join()
+    recorder.close()
+    return pours(taps)
+
+
+def run_replayed(path, speed):
+    reader = TraceReader(path)
+    if speed is None:
+        taps = meters(SimulatedGPIO())
+        started = time.time()
+        pulses = replay_pours(reader, taps)
+        return pours(taps), time.time() - started, pulses
+
+    gpio = ReplayGPIO()
+    taps = meters(gpio)
+    manager = TapManager(taps, gpio=gpio, connect=False)
+    manager.daemon = True
+    manager.start()
+    time.sleep(0.2)
+    started = time.time()
+    fired = gpio.replay(reader, speed)
+    elapsed = time.time() - started
+    time.sleep(POUR_TIMEOUT / 1000.0 * 3)
+    manager.stop()
+    manager.join()
+    return pours(taps), elapsed, fired
+
+
+def compare(live, replayed):
+    """
+    :return: (pours matched, largest volume difference in ounces, largest duration difference in seconds)
+    """
+    if len(live) != len(replayed):
+        return 0, float('nan'), float('nan')
+    volume = max(abs(a[1] - b[1]) for a, b in zip(live, replayed))
+    duration = max(abs(a[2] - b[2]) for a, b in zip(live, replayed))
+    return sum(1 for a, b in zip(live, replayed) if a[0] == b[0]), volume, duration
+
+
+def bench_replay(directory, scale):
+    path = os.path.join(directory, 'session.bin')
+    live = run_live(path, scale)
+    print('live session: %d pours, %d edges recorded' % (len(live), len(TraceReader(path))))
+    print('  %-22s %10s %10s %12s %14s' % ('replay', 'seconds', 'pulses/s', 'max d oz', 'max d seconds'))
+    for name, speed in (('replay_pours', None), ('ReplayGPIO 1x', 1.0)):
+        replayed, elapsed, pulses = run_replayed(path, speed)
+        matched, volume, duration = compare(live, replayed)
+        print('  %-22s %10.3f %10.0f %12.4f %14.4f  %d/%d pours' % (name, elapsed, pulses / elapsed, volume,
+                                                                    duration, matched, len(live)))
+
+
+def main(pulses=200000):
+    FlowMeter.POUR_TIMEOUT = POUR_TIMEOUT
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix='bench-trace-')
+    try:
+        bench_recorder(directory, int(pulses))
+        bench_window(directory, 2)
+        bench_replay(directory, 1.0)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,142 @@
+"""
+Measures the bytes on the wire per pour and per temperature reading for each encoding the sensors can post:
+the form fields and JSON they always posted, against the delta encoded `wire` batches.
+
+    python benchmarks/bench_wire.py [probes]
+
+Pours are a day of taproom traffic over four taps, temperature readings a minute of `probes` DS18B20 probes read
+every 10 seconds (one `TemperatureBatcher` window) and an hour of them (a window that filled `max_readings`).
+Sizes are of the request bodies, without the HTTP headers or the auth token, which are the same for every
+encoding. Every compact batch is decoded again and checked against what was encoded.
+"""
+import os
+import sys
+import gzip
+import json
+import random
+from io import BytesIO
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+import wire
+from pour import TIMEZONE
+
+TAPS = 4
+POURS = 200
+PROBE_INTERVAL = 10
+
+
+def make_pours(count, seed=1):
+    generator = random.Random(seed)
+    start = TIMEZONE.localize(datetime(2026, 10, 16, 16, 0, 0))
+    pours = []
+    for _ in range(count):
+        start += timedelta(seconds=generator.uniform(5, 300), microseconds=generator.randint(0, 999999))
+        duration = generator.uniform(4, 12)
+        # Ounces from pulses, never a round number
+        volume = generator.uniform(8, 20) + 1e-9 * generator.random()
+        pours.append({'kegid': generator.randint(1, TAPS), 'volume': volume, 'duration': duration,
+                      'pourstart': start, 'pourend': start + timedelta(seconds=duration + 3)})
+    return pours
+
+
+def make_readings(probes, seconds, seed=1):
+    generator = random.Random(seed)
+    names = ['28-%012x' % generator.getrandbits(48) for _ in range(probes)]
+    temperatures = [generator.uniform(34, 40) for _ in names]
+    started = datetime(2026, 10, 16, 16, 0, 0)
+    readings = []
+    for step in range(seconds // PROBE_INTERVAL):
+        for index, name in enumerate(names):
+            # The 12 bit resolution of the probes, 0.0625 C
+            temperatures[index] += generator.choice((-0.1125, 0, 0, 0, 0.1125))
+            created = started + timedelta(seconds=step * PROBE_INTERVAL, microseconds=generator.randint(0, 90000))
+            readings.append({'name': name, 'temperature': round(temperatures[index], 4),
+                             'created_on': str(created)})
+    return readings
+
+
+def gzipped(payload):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(payload)
+    return buf.getvalue()
+
+
+def as_json(records):
+    return json.dumps(records, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def check_pours(pours, payload):
+    decoded = wire.decode_pours(payload)
+    assert len(decoded) == len(pours)
+    for pour, copy in zip(pours, decoded):
+        assert copy['kegid'] == pour['kegid']
+        assert abs(copy['volume'] - pour['volume']) <= 0.005
+        assert abs(wire.to_millis(copy['pourstart']) - wire.to_millis(pour['pourstart'])) <= 1
+
+
+def check_readings(readings, payload):
+    decoded = wire.decode_temperatures(payload)
+    assert len(decoded) == len(readings)
+    expected = sorted((r['name'], wire.to_millis(r['created_on']), round(r['temperature'], 2)) for r in readings)
+    actual = sorted((r['name'], wire.to_millis(r['created_on']), r['temperature']) for r in decoded)
+    assert all(a[:2] == b[:2] and abs(a[2] - b[2]) <= 0.005 for a, b in zip(expected, actual))
+
+
+def report(title, rows, unit):
+    print(title)
+    baseline = rows[0][1]
+    print('  %-34s %12s %10s' % ('encoding', 'bytes/%s' % unit, 'saved'))
+    for name, size in rows:
+        print('  %-34s %12.1f %9.1f%%' % (name, size, 100.0 * (1 - size / baseline)))
+    print('')
+
+
+def bench_pours():
+    pours = make_pours(POURS)
+    single = [len(urlencode(pour)) for pour in pours]
+    rows = [('form, one request per pour', sum(single) / float(len(pours))),
+            ('JSON, one request per pour', sum(len(as_json(pour)) for pour in pours) / float(len(pours)))]
+    for size in (1, 10, 100):
+        batches = [pours[i:i + size] for i in range(0, len(pours), size)]
+        payloads = [wire.encode_pours(batch) for batch in batches]
+        for batch, payload in zip(batches, payloads):
+            check_pours(batch, payload)
+        if size > 1:
+            rows.append(('JSON array, %d per batch' % size,
+                         sum(len(as_json(batch)) for batch in batches) / float(len(pours))))
+            rows.append(('JSON array + gzip, %d per batch' % size,
+                         sum(len(gzipped(as_json(batch))) for batch in batches) / float(len(pours))))
+        rows.append(('compact, %d per batch' % size, sum(len(p) for p in payloads) / float(len(pours))))
+    report('%d pours over %d taps' % (len(pours), TAPS), rows, 'pour')
+
+
+def bench_temperatures(probes):
+    for seconds, window in ((60, 'one minute window'), (3600, 'one hour window')):
+        readings = make_readings(probes, seconds)
+        payload = wire.encode_temperatures(readings)
+        check_readings(readings, payload)
+        count = float(len(readings))
+        single = sum(len(urlencode(reading)) for reading in readings) / count
+        rows = [('form, one request per reading', single),
+                ('JSON array', len(as_json(readings)) / count),
+                ('JSON array + gzip', len(gzipped(as_json(readings))) / count),
+                ('compact', len(payload) / count),
+                ('compact + gzip', len(gzipped(payload)) / count)]
+        report('%d readings of %d probes, %s' % (len(readings), probes, window), rows, 'reading')
+
+
+def main(probes=4):
+    bench_pours()
+    bench_temperatures(int(probes))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
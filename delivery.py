@@ -0,0 +1,349 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+DEPTH = metrics.gauge('keg_delivery_queue_depth', 'Records waiting to be delivered', ['queue'])
+DELIVERED = metrics.counter('keg_delivery_delivered_total', 'Records delivered', ['queue'])
+FAILED = metrics.counter('keg_delivery_failed_total', 'Records given up on after every retry', ['queue'])
+DROPPED = metrics.counter('keg_delivery_dropped_total', 'Records dropped from a full queue', ['queue'])
+RETRIES = metrics.counter('keg_delivery_retries_total', 'Retried batches', ['queue'])
+LATENCY = metrics.histogram('keg_delivery_latency_seconds', 'Seconds from queueing a record to its delivery',
+                            ['queue'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+
+
+class DeliveryQueue(object):
+    """
+    Bounded queue of records that background worker threads hand to `send` in batches, so sensor loops
+    never wait on the network.
+
+    `put` never blocks: once `maxsize` records are waiting the oldest one is dropped (and counted) to
+    make room, which keeps memory bounded while the API is unreachable. A batch that fails is retried
+    with exponential backoff and jitter while new records keep queueing behind it.
+
+    With a `journal`, every record is written to it and acknowledged once delivered. `put` only appends
+    the record to a deque: a writer thread journals what was put, in one transaction, and queues it for
+    delivery. Records that were dropped, gave up on, or left over from a previous run are replayed from
+    the journal in bulk on `start`, whenever a delivery succeeds again and every `replay_interval` seconds.
+    Queues sharing a journal need a `kind` each, a queue replays every pending record of its kind.
+
+    Parameters
+    ----------
+    send: Callable
+        Called with a list of records. Returns the records that could not be delivered (an empty list
+        or None on success). Raising an exception counts as a failure of the whole batch.
+    name<optional>: String
+        Used to name the worker threads and in log messages.
+    maxsize<optional>: Integer
+        Maximum number of records waiting for delivery.
+    batch_size<optional>: Integer
+        Maximum number of records handed to `send` at once.
+    linger_time<optional>: Float
+        Seconds a worker waits for a batch to fill up before sending what it has.
+    workers<optional>: Integer
+        Number of worker threads.
+    max_retries<optional>: Integer
+        Attempts made for a batch before its records are dropped, or left in the journal for a replay.
+    backoff<optional>: Float
+        Seconds to wait before the first retry, doubling on every attempt up to `max_backoff`.
+    journal<optional>: Journal
+        Durable journal the records are written to before being queued.
+    kind<optional>: String
+        Kind of the records in the journal, i.e. `pour-<keg id>` or `temperature`. Defaults to `name`.
+    replay_interval<optional>: Float
+        Seconds between replays of the records left in the journal while the queue is idle.
+    """
+    def __init__(self, send, name='delivery', maxsize=1000, batch_size=20, linger_time=0.5, workers=1,
+                 max_retries=8, backoff=1.0, max_backoff=300.0, journal=None, kind=None, replay_interval=60.0):
+        self.send = send
+        self.name = name
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.linger_time = linger_time
+        self.worker_count = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.journal = journal
+        self.kind = kind or name
+        self.replay_interval = replay_interval
+
+        # (enqueued time, record, journal id) tuples
+        self.records = deque()
+        # journal ids of the records queued or being sent, so a replay doesn't queue them twice
+        self.inflight = set()
+        # set when records only remain in the journal and should be replayed
+        self.backlog = False
+        self.replayed = 0.0
+        self.condition = threading.Condition()
+        self.workers = []
+        self.running = False
+
+        # Records put but not journaled yet, written by the journal writer thread
+        self.unjournaled = deque()
+        self.journaling = threading.Condition()
+        self.writer = None
+
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.average_latency = 0.0
+
+        self.latency = LATENCY.labels(name)
+        DEPTH.labels(name).bind(lambda: len(self.records))
+        DELIVERED.labels(name).bind(lambda: self.delivered)
+        FAILED.labels(name).bind(lambda: self.failed)
+        DROPPED.labels(name).bind(lambda: self.dropped)
+        RETRIES.labels(name).bind(lambda: self.retries)
+
+    def start(self):
+        """
+        Starts the worker threads. Calling it more than once is harmless.
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+
+        # Pick up whatever a previous run didn't get to deliver
+        self.replay()
+
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self.work, name='%s-%s' % (self.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=None):
+        """
+        Stops the workers once the records already queued have been handed to `send`.
+        """
+        self.write_journal()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def put(self, record):
+        """
+        Queues a record for delivery without blocking. With a journal it's handed to the journal writer, so
+        the caller never waits on SQLite.
+
+        :return: False if the queue was full and the oldest record had to be dropped. Always True with a
+            journal, where nothing put is lost.
+        """
+        if self.journal is not None:
+            with self.journaling:
+                self.unjournaled.append(record)
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self.journal_loop, name='%s-journal' % self.name)
+                    self.writer.daemon = True
+                    self.writer.start()
+                self.journaling.notify()
+            return True
+
+        accepted = self.enqueue(record)
+        if not accepted:
+            logging.warning("\n\t%s queue is full, dropped the oldest record" % self.name)
+        return accepted
+
+    def journal_loop(self):
+        while True:
+            with self.journaling:
+                while not self.unjournaled:
+                    self.journaling.wait()
+            self.write_journal()
+
+    def write_journal(self):
+        """
+        Journals the records put since the last call in one transaction, then queues them for delivery.
+        """
+        with self.journaling:
+            records = list(self.unjournaled)
+            self.unjournaled.clear()
+        if not records:
+            return
+
+        try:
+            ids = self.journal.append_many(self.kind, records)
+        except Exception as e:
+            logging.error("\n\t%s could not journal %s records" % (self.name, len(records)))
+            logging.error(e)
+            ids = [None] * len(records)
+
+        for record, journal_id in zip(records, ids):
+            if not self.enqueue(record, journal_id):
+                logging.warning("\n\t%s queue is full, dropped the oldest record" % self.name)
+
+    def enqueue(self, record, journal_id=None):
+        with self.condition:
+            # A replay between journaling the record and getting here already queued it
+            if journal_id is not None and journal_id in self.inflight:
+                return True
+            accepted = True
+            if len(self.records) >= self.maxsize:
+                enqueued, dropped, dropped_id = self.records.popleft()
+                self.inflight.discard(dropped_id)
+                self.dropped += 1
+                # a journaled record isn't lost, it's replayed once the queue drains
+                if dropped_id is not None:
+                    self.backlog = True
+                accepted = False
+            self.records.append((time.time(), record, journal_id))
+            if journal_id is not None:
+                self.inflight.add(journal_id)
+            self.condition.notify()
+        return accepted
+
+    def replay(self):
+        """
+        Queues the oldest unacknowledged journal records, as many as there is room for.
+
+        The journal is read with the condition held, so a record acknowledged or queued meanwhile by another
+        thread can't be queued again.
+        """
+        if self.journal is None:
+            return
+
+        with self.condition:
+            self.replayed = time.time()
+            room = self.maxsize - len(self.records)
+            if room <= 0:
+                return
+
+            pending = self.journal.pending(self.kind, limit=room, exclude=list(self.inflight))
+            self.backlog = len(pending) == room
+            for journal_id, record in pending:
+                self.records.append((time.time(), record, journal_id))
+                self.inflight.add(journal_id)
+            self.condition.notify_all()
+
+        if pending:
+            logging.info("\n\t%s replaying %s records from the journal" % (self.name, len(pending)))
+
+    def depth(self):
+        return len(self.records)
+
+    def stats(self):
+        """
+        Snapshot of the queue depth and delivery counters. Latencies are in seconds from `put` to a
+        successful `send`.
+        """
+        return {
+            'depth': len(self.records),
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'retries': self.retries,
+            'last_latency': self.last_latency,
+            'average_latency': self.average_latency,
+            'max_latency': self.max_latency
+        }
+
+    def take(self):
+        """
+        Waits for records and returns the next batch, or None once stopped and drained. Returns an empty
+        batch when records waiting in the journal are due for a replay.
+        """
+        with self.condition:
+            while not self.records:
+                if not self.running:
+                    return None
+                if self.replay_due():
+                    return []
+                self.condition.wait(self.replay_interval if self.backlog else None)
+
+            # Give the batch a moment to fill up so records get coalesced into fewer submissions
+            deadline = time.time() + self.linger_time
+            while self.running and len(self.records) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            count = min(len(self.records), self.batch_size)
+            return [self.records.popleft() for _ in range(count)]
+
+    def work(self):
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            if batch:
+                self.deliver(batch)
+            # Records given up on stay in the journal, so they're retried even if nothing else is put
+            with self.condition:
+                due = self.replay_due()
+            if due:
+                self.replay()
+
+    def replay_due(self):
+        # Called with the condition held
+        return self.backlog and time.time() - self.replayed >= self.replay_interval
+
+    def deliver(self, batch):
+        """
+        Hands a batch to `send`, retrying whatever wasn't delivered with exponential backoff.
+        """
+        attempt = 0
+        while batch:
+            records = [item[1] for item in batch]
+            try:
+                undelivered = self.send(records) or []
+            except Exception as e:
+                logging.error("\n\t%s failed to send %s records" % (self.name, len(records)))
+                logging.error(e)
+                undelivered = records
+
+            failed_ids = set(id(record) for record in undelivered)
+            now = time.time()
+            acknowledged = []
+            for enqueued, record, journal_id in batch:
+                if id(record) not in failed_ids:
+                    self.record_latency(now - enqueued)
+                    if journal_id is not None:
+                        acknowledged.append(journal_id)
+            batch = [item for item in batch if id(item[1]) in failed_ids]
+
+            if acknowledged:
+                self.journal.acknowledge(acknowledged)
+                with self.condition:
+                    self.inflight.difference_update(acknowledged)
+                    backlog = self.backlog
+                # The API is reachable again, so bring back whatever is waiting in the journal
+                if backlog:
+                    self.replay()
+
+            if not batch:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries or not self.running:
+                self.failed += len(batch)
+                logging.error("\n\t%s gave up on %s records" % (self.name, len(batch)))
+                with self.condition:
+                    for item in batch:
+                        if item[2] is not None:
+                            self.inflight.discard(item[2])
+                            self.backlog = True
+                return
+
+            self.retries += 1
+            delay = min(self.backoff * (2 ** (attempt - 1)), self.max_backoff)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def record_latency(self, latency):
+        self.delivered += 1
+        self.latency.observe(latency)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        # exponentially weighted so the average follows recent network conditions
+        self.average_latency += (latency - self.average_latency) * 0.1
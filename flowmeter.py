@@ -1,14 +1,26 @@
+import os
 import time
-from datetime import datetime
-import pytz
-import RPi.GPIO as gpio
+from collections import deque
 # Once we get a DB set up, we'll activate this
 #import mysql.connector 	# To save data locally in the event we can't post or need to recover/reset data
 import logging
-import requests
 import json
 import threading
-from socketIO_client import SocketIO, LoggingNamespace 	# To stream pouring data to the client page
+
+import metrics
+import wire
+from api_client import get_client
+from delivery import DeliveryQueue
+from gpio_backend import get_gpio, monotonic_ms
+from pour import PourState
+from socket_manager import get_socket
+
+PULSES = metrics.counter('keg_pulses_total', 'Flowmeter pulses counted towards pours', ['keg'])
+DEBOUNCED = metrics.counter('keg_debounced_edges_total',
+                            'Edges ignored for following the previous pulse within the debounce time', ['keg'])
+LOOP_PASSES = metrics.counter('keg_sampler_passes_total', 'Iterations of the pin sampling loop', ['loop'])
+LOOP_RATE = metrics.gauge('keg_sampler_passes_per_second',
+                          'Iterations per second of the pin sampling loop since the previous scrape', ['loop'])
 
 LOCAL = True # When False, flow meter will hook up to Live site for api authentication, data posting, and web socket streaming
 
@@ -25,8 +37,40 @@ class FlowMeter(threading.Thread):
         The id of the pin the flowmeter is transmitting the data through.
     local<optional>: Boolean
         A boolean designating whether or not the data is emitting to local or remote web services.
+    capture<optional>: String
+        `edge` (default) timestamps every rising edge from a GPIO event callback and leaves the thread
+        asleep between pulses, `poll` keeps the original busy loop reading the pin.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API. Defaults to `gpio_backend.get_gpio()`.
+    kFactor<optional>: Float
+        Calibrated pulses per liter of the flowmeter.
+    delivery<optional>: DeliveryQueue
+        Queue the finished pours are posted from. Defaults to a queue of its own.
+    journal<optional>: Journal
+        Local journal every pour is recorded in until the API acknowledges it.
+    endpoint<optional>: Dictionary
+        Overrides the web services picked by `local`, with `host`, `port`, `user` and `password` keys.
+    debounce<optional>: Integer
+        Milliseconds after a pulse during which further edges are contact bounce and ignored. 0 disables it.
+    stream<optional>: PourStream
+        On-device event stream the pour events are also published to, for displays on the LAN.
+    progress<optional>: ProgressEmitter
+        Sends the running volume and flow rate while pouring. None only sends the start and end of pours.
+    socket<optional>: SocketManager
+        Connection manager the socket events are queued to. Defaults to the one shared by every flowmeter
+        streaming to the same server.
+    ledger<optional>: KegLedger
+        Inventory every finished pour is taken off, so the remaining volume of the keg is known locally.
+    wireFormat<optional>: String
+        `auto` posts each batch of pours as one compact `wire` payload once the API advertises it, `compact`
+        always does, `json` keeps posting the pours one form at a time.
     """
-    def __init__(self, kegId, pin, local=True):
+    # A pour is considered finished once no pulse has been seen for this many milliseconds
+    POUR_TIMEOUT = 3000
+
+    def __init__(self, kegId, pin, local=True, capture='edge', gpio=None, kFactor=450.0, delivery=None,
+                 journal=None, endpoint=None, debounce=0, stream=None,
+                 progress=None, socket=None, ledger=None, wireFormat='auto'):
         """
             Some properties are declared as 0.0 so they are set to be floating point numbers instead of integers
             as they need finer precision for some calculations.
@@ -35,24 +79,39 @@ class FlowMeter(threading.Thread):
         self.pin = pin
         self.kegId = kegId
         self.local = local
+        self.capture = capture
+        self.gpio = gpio if gpio is not None else get_gpio()
+
+        # Edge timestamps are appended here by the GPIO callback thread and drained by `main`
+        self.pulseTimes = deque()
+        self.pulseEvent = threading.Event()
+        self.running = True
 
-        self.pouring = False
         self.lastPinState = False
         self.pinState = 0
-        self.lastPinChange = int(time.time() * 1000)
-        self.pourStart = 0
-        self.pinChange = self.lastPinChange
-        self.litersPoured = 0.0
-        self.ouncesPoured = 0.0
-        self.totalDelta = 0.0
-
-        self.pourRate = 24.0  # represents milliliters poured in a second
-
-        # TODO: move values to a config that is excluded from repo 
-        self.user = 'pi'
-        self.password = 'raspberry'
 
-        if self.local:
+        self.pour = PourState(kegId, kFactor=kFactor, pourTimeout=self.POUR_TIMEOUT)
+        self.debounce = debounce
+        self.stream = stream
+        self.progress = progress
+        self.ledger = ledger
+
+        # Looked up once so counting a pulse is a single increment
+        self.pulseCounter = PULSES.labels(kegId)
+        self.debouncedCounter = DEBOUNCED.labels(kegId)
+        self.passes = 0
+        self.checkedPulses = 0
+
+        endpoint = endpoint or {}
+        self.user = endpoint.get('user', 'pi')
+        self.password = endpoint.get('password', 'raspberry')
+
+        if 'host' in endpoint:
+            self.targetHost = endpoint['host']
+            self.targetWsPort = endpoint.get('port', 80)
+            self.AuthenticationUrl = '%s:%s/api/authenticate' % (self.targetHost, self.targetWsPort)
+            self.PostPourUrl = '%s:%s/api/pour' % (self.targetHost, self.targetWsPort)
+        elif self.local:
             # local debugging
             self.targetHost = 'http://10.0.0.78'
             self.targetWsPort = 3000
@@ -65,64 +124,56 @@ class FlowMeter(threading.Thread):
             self.AuthenticationUrl = "%s/api/authenticate" % self.targetHost
             self.PostPourUrl = '%s/api/pour' % self.targetHost
 
-        self.lastFivePours = []
+        # Every flowmeter talking to the same API shares one pooled session and one cached token
+        self.client = get_client(self.AuthenticationUrl, self.user, self.password,
+                                 auth_format='form', token_location='form')
+        self.negotiation = wire.Negotiation(wireFormat)
+
+        # Pours are journaled locally and posted from a background worker so the sampling loop never
+        # waits on the API and no pour is lost while it is unreachable
+        if delivery is None:
+            delivery = DeliveryQueue(self.deliverPours, name='pours-%s' % kegId, journal=journal,
+                                     kind='pour-%s' % kegId)
+        self.delivery = delivery
+
+        # Every flowmeter streaming to the same server shares one web socket, owned by its own thread
+        self.socket = socket if socket is not None else get_socket(self.targetHost, self.targetWsPort)
 
     def run(self):
         self.startup()
 
     def GetToken(self):
         """
-        Gets a JSON Web Token used to authenticate our POSTs to the API
-        # TODO: reauthorize every 24 hours at 3 A.M. since the auth token only lasts that long
+        Gets a JSON Web Token used to authenticate our POSTs to the API. The token is cached by the shared
+        client and refreshed in the background before it expires.
         """
-        logging.info("\n\tauth url: %s" % self.AuthenticationUrl)
-        response = requests.post(self.AuthenticationUrl, data={'username': self.user, 'password': self.password })
-        data = json.loads(response.text)
-        if data['success'] is True:
-            logging.info("\n\tSuccessfully generated token!")
-            return data['token']
-        else:
-            raise "Unauthorized! Please check the username and password."
-
-    def GetSocketConnection(self):
-        """
-        Creates a web socket connection to target host
-
-        :rtype: Socket connection
-        """
-        logging.info("\n\tGetting socket connection...")
-        # only log if we're running against the local instance
-        logging.getLogger('requests').setLevel(logging.WARNING)
-
-        socket = SocketIO(self.targetHost, self.targetWsPort, LoggingNamespace)
-        return socket
+        return self.client.token()
 
     def emitPourStart(self):
-        try:
-            logging.info("\n\tEmitting pour start...")
-            self.socketIO.emit('pourStart', self.kegId)
-            logging.info("\n\tDone emitting pour start...")
-        except Exception as e:
-            logging.error("\n\tAn error occurred when emitting the pour data")
-            logging.error(e)
+        if self.stream is not None:
+            self.stream.publish('pourStart', {'kegid': self.kegId, 'time': time.time()})
+
+        # Queued, the socket manager sends it once connected
+        self.socket.emit('pourStart', self.kegId)
 
-    def emitPourInterval(self, volume):
+    def emitPourInterval(self, volume, flowRate=None):
         """
-        Emits the pour data on a configurable ounce basis.
+        Emits the progress of the current pour. Called by the `ProgressEmitter` thread, never by the
+        sampling loop.
 
         Parameters
         ----------
         volume: Float
             The amount in ounces that have poured thus far.
+        flowRate<optional>: Float
+            The current flow rate in liters per minute.
         """
-        try:
-            logging.info("\n\tEmitting pour start...")
-            self.socketIO.emit('pourInterval', self.kegId, volume)
-            logging.info("\n\tDone emitting pour start...")
-        except Exception as e:
-            logging.error("\n\tAn error occurred when emitting the pour data")
-            logging.error(e)
+        if self.stream is not None:
+            self.stream.publish('pourInterval', {'kegid': self.kegId, 'volume': volume, 'flowRate': flowRate,
+                                                 'time': time.time()})
 
+        # Replaces the previous update of this keg if the socket didn't get to send it yet
+        self.socket.emit_latest(('pourInterval', self.kegId), 'pourInterval', self.kegId, volume, flowRate)
 
     def emitTotalPour(self, pourData):
         """
@@ -130,65 +181,93 @@ class FlowMeter(threading.Thread):
 
         :param pourData: Object containing the keg id, volume, and pour duration
         """
-        try:
-            logging.info("\n\tEmitting data...")
-            self.socketIO.emit('emitTotalPourData', pourData)
-            logging.info("\n\tDone emitting data...")
-            # save latest pour
-            if len(self.lastFivePours) == 5:
-                del self.lastFivePours[-1]
+        if self.stream is not None:
+            event = dict(pourData)
+            event['time'] = time.time()
+            self.stream.publish('pourEnd', event)
 
-            # append new pour data to beginning of list
-            self.lastFivePours = [pourData] + self.lastFivePours
-        except Exception as e:
-            logging.error("\n\tAn error occurred when emitting the pour data")
-            logging.error(e)
+        # Totals are kept in the socket queue until they are sent, however long the socket is down
+        self.socket.emit('emitTotalPourData', pourData)
 
     def postPourData(self, pourData):
         """
         Posts the pour data to the server.
 
         :param pourData: Object containing the keg id, volume, and pour duration
+        :return: True if the API accepted the pour
         """
         logging.info("\n\tposturl: %s" % self.PostPourUrl)
 
-        # Must mixin the auth token in order to post the data
-        pourData['token'] = self.token
-
-        response = requests.post(self.PostPourUrl, data=pourData)
+        # The client mixes in the auth token and re-authenticates if it was rejected
+        response = self.client.post(self.PostPourUrl, data=pourData)
+        self.negotiation.observe(response, 'pour', 'form', 1)
         data = json.loads(response.text)
 
-        # No need to keep the latest pour if it posted successfully
         if data['success'] == True:
             if data['message']:
                 logging.info("\n\t%s" % data['message'])
             else:
                 logging.info("\n\tSuccessfully posted pour data!")
-            del self.lastFivePours[-1]
+            return True
         else:
             if data['message']:
                 logging.warning("\n\tThe post was not successful.")
                 logging.warning("\n\t%s" % data['message'])
             else:
                 logging.error("\n\tSomething went wrong.")
-            #TODO: log pour data to local database
-            pass
+            # The pour stays unacknowledged in the journal and is replayed later
+            return False
 
-    def tryAgainInaMinute(self):
+    def postCompactPours(self, pours):
         """
-        Keeps trying to emit the pour data every minute until all the pours are emitted.
+        Posts a batch of pours as one compact `wire` payload.
+
+        :param pours: List of pour data objects
+        :return: The pours that could not be posted, or None if the API rejected the encoding
         """
-        failedTime = time.time()
-        while (self.currentTime - failedTime) > 60:
-            # Try getting a new connection every minute
-            self.socketIO = self.GetSocketConnection()
-            # TODO: find a way to check to see if we got a new connection
-            # If we do, only emit the latest one, but post the others.
-            for idx, pour in enumerate(self.lastFivePours):
-                if idx == 0:
-                    self.emitTotalPour(pour)
-                del self.lastFivePours[idx]
-            break
+        payload = wire.encode_pours(pours)
+        response = self.client.post(self.PostPourUrl, data=payload, headers={'Content-Type': wire.MEDIA_TYPE})
+        if not self.negotiation.observe(response, 'pour', 'compact', len(pours)):
+            logging.warning("\n\tThe API doesn't take compact pours, posting them as forms")
+            return None
+
+        data = json.loads(response.text)
+        if data['success'] == True:
+            logging.info("\n\tSuccessfully posted %s pours!" % len(pours))
+            return []
+        logging.warning("\n\tThe post was not successful.")
+        if data.get('message'):
+            logging.warning("\n\t%s" % data['message'])
+        return list(pours)
+
+    def deliverPours(self, pours):
+        """
+        Sends a batch of pours from the delivery queue to the API, in one request when it takes compact
+        payloads.
+
+        :param pours: List of pour data objects
+        :return: The pours that could not be posted
+        """
+        if self.negotiation.compact():
+            try:
+                failed = self.postCompactPours(pours)
+            except Exception as e:
+                logging.error(e)
+                return list(pours)
+            if failed is not None:
+                return failed
+
+        failed = []
+        for index, pourData in enumerate(pours):
+            try:
+                if not self.postPourData(pourData):
+                    failed.append(pourData)
+            except Exception as e:
+                logging.error(e)
+                # The API is unreachable, no point trying the rest of the batch right now
+                failed.extend(pours[index:])
+                break
+        return failed
 
     def startup(self):
         """
@@ -197,18 +276,51 @@ class FlowMeter(threading.Thread):
         logging.basicConfig(level=logging.DEBUG)
         logging.info("\n\n\n") # pad the log a bit so we can see where the program restarted
 
+        self.connect()
+        self.setupPin()
+
+        logging.info("\n\twe're ready to pour!")
+        # start up main loop
+        self.main()
+
+    def connect(self):
+        """
+        Starts posting pours, authenticates against the API and opens the web socket connection.
+        """
+        # Both retry on their own, so start them even if the server is unreachable right now
+        self.delivery.start()
+        self.socket.start()
         self.token = self.GetToken()
-        # set up connection
-        self.socketIO = self.GetSocketConnection()
 
-        # Initializing GPIO ports
+    def setupPin(self):
+        """
+        Initializes the GPIO pin of the flowmeter and, when capturing edges, registers the pulse callback.
+        """
+        gpio = self.gpio
         boardRevision = gpio.RPI_REVISION # Clearing previous gpio port settings
         gpio.setmode(gpio.BCM) # Use real physical gpio port numbering
         gpio.setup(self.pin, gpio.IN, pull_up_down = gpio.PUD_UP)
 
-        logging.info("\n\twe're ready to pour!")
-        # start up main loop
-        self.main()
+        if self.capture == 'edge':
+            gpio.add_event_detect(self.pin, gpio.RISING, callback=self.onPulse)
+
+    def stop(self):
+        """
+        Makes `main` return after its current iteration.
+        """
+        self.running = False
+        self.pulseEvent.set()
+
+    def onPulse(self, channel, timestamp=None):
+        """
+        GPIO event callback fired on every rising edge. It only timestamps the pulse and wakes the
+        flowmeter thread so the GPIO event thread is never held up by the pour logic or the network.
+
+        :param timestamp: Kernel timestamp of the edge in nanoseconds on the monotonic clock, from backends
+            that have one. Otherwise the pulse is timestamped now.
+        """
+        self.pulseTimes.append(timestamp / 1000000.0 if timestamp is not None else monotonic_ms())
+        self.pulseEvent.set()
 
     def main(self):
         """
@@ -216,101 +328,135 @@ class FlowMeter(threading.Thread):
         is set to calculate the pulses into pour data then emit the data on a socket connection
         and post it to the API.
         """
+        loop = 'flowmeter-%s' % self.kegId
+        LOOP_PASSES.labels(loop).bind(lambda: self.passes)
+        LOOP_RATE.labels(loop).bind(metrics.rate_of(lambda: self.passes))
+
+        if self.capture == 'edge':
+            self.edgeLoop()
+        else:
+            self.pollLoop()
+
+    def edgeLoop(self):
+        """
+        Sleeps until the GPIO callback reports pulses, then feeds their timestamps through the pour logic.
+        While idle the thread blocks on an event, so it costs no CPU between pours.
+        """
+        while self.running:
+            # Only wake up on a timer while pouring so the end of the pour can be detected
+            timeout = self.POUR_TIMEOUT / 1000.0 if self.pour.pouring else None
+            self.pulseEvent.wait(timeout)
+            self.pulseEvent.clear()
+            self.passes += 1
+
+            while self.pulseTimes:
+                self.recordPulse(self.pulseTimes.popleft())
+
+            self.checkPourEnd(monotonic_ms())
+
+    def pollLoop(self):
+        """
+        The original capture mode: continuously reads the pin and looks for rising edges.
+        """
         # We want this to constantly monitor to gpio pins so start an infinite loop
-        while True:
-            # this is multiplied by 1000 and converted to an int to maintain enough precision
-            # but not enough that the comparison later to determine if pouring is finished
-            # is too precise
-            currentTime = int(time.time() * 1000)
-            if gpio.input(self.pin):
+        while self.running:
+            # Monotonic milliseconds, so the wall clock being adjusted never distorts a pour
+            currentTime = monotonic_ms()
+            if self.gpio.input(self.pin):
                 self.pinState = True
             else:
                 self.pinState = False
 
             if self.pinState != self.lastPinState and self.pinState == True:
-                if self.pouring == False:
-                    self.startTime = currentTime
-                    self.pourStart = datetime.now(pytz.timezone('America/Los_Angeles'))
-                    self.totalDelta = 0.0
-                    self.emitPourStart()
-
-                self.pouring = True
-                # get the current time
-                self.pinChange = currentTime
-                pinDelta = self.pinChange - self.lastPinChange
-
-                #TODO: I wonder why 1000 was chosen as an upper limit...
-                if pinDelta > 0 and pinDelta < 1000:
-                    # Total the time captured between each read
-                    self.totalDelta += float(pinDelta)
-
-                    #TODO: emit data at a configured interval of poured beer
-                    # such as every 2-3 oz.
-                    volume = ((self.totalDelta / 1000) * (self.pourRate / 1000)) * 33.814
-                    # if int(volume) % 2:
-                    #     self.emitPourInterval(volume)
-
-            # if pouring was set to true, and the pin hasn't changed state and there hasn't been a change in
-            # the pin in over 3 seconds, we can assume pouring has ceased so we'll post the data and reset
-            # the variables
-            if self.pouring == True and self.pinState == self.lastPinState and (currentTime - self.lastPinChange) > 3000:
-                # set pouring back to false to set up for the next pour capture
-                self.pouring = False
-
-                # derive pour time in seconds by subtracting the current time from the start time
-                # and unraveling the precision we added earlier
-                pourTime = self.totalDelta / 1000
-
-                self.litersPoured = (pourTime * self.pourRate) / 1000  # divide by 1000 to convert milliliters into liters
-
-                self.ouncesPoured = self.litersPoured * 33.814
-
-                # we want to return ounces and this value is the constant to do so
-                # the 0.2 value is a bit arbitrary. when the flow meter gets jostled, the impeller can sometimes
-                # trip the pin state, creating a 'false positive' read. This value helps to capture what are
-                # only what are perceived to be legit pours.
-                if self.ouncesPoured > 0.2:
-
-                    socketPourData = {
-                        'kegid': self.kegId,
-                        'volume': self.ouncesPoured,
-                        'duration': pourTime
-                    }
-                    pourEnd = datetime.now(pytz.timezone('America/Los_Angeles'))
-
-                    postPourData = {
-                        'kegid': self.kegId,
-                        'volume': self.ouncesPoured,
-                        'pourstart': self.pourStart,
-                        'pourend': pourEnd,
-                        'duration': pourTime
-                    }
-
-                    logging.info('\n volume: %s oz\n duration: %s secs' % (socketPourData['volume'], socketPourData['duration']))
-
-                    # Zero out the pour amount now that we've created an object to emit/post
-                    self.litersPoured = 0
-                    self.ouncesPoured = 0
-                    self.pourTime = 0
-
-                    try:
-                        # Sends data through socket connect to the server to pass through to
-                        # any connected users
-                        self.emitTotalPour(socketPourData)
-                        self.postPourData(postPourData)
-
-                    except Exception as e:
-                        #TODO: log error to database
-                        logging.error(e)
-                        #self.tryAgainInaMinute()
-
-            self.lastPinChange = self.pinChange
+                self.recordPulse(currentTime)
+            elif self.pinState == self.lastPinState:
+                self.checkPourEnd(currentTime)
+
             self.lastPinState = self.pinState
+            self.passes += 1
 
-try:
-    fm1 = FlowMeter(1, 4, LOCAL)
-    fm2 = FlowMeter(2, 27, LOCAL)
-    fm1.start()
-    fm2.start()
-except Exception as e:
-    print e
\ No newline at end of file
+    def recordPulse(self, currentTime):
+        """
+        Adds a single pulse of the flowmeter to the current pour, starting a new pour if needed.
+
+        :param currentTime: Time of the rising edge in milliseconds on the monotonic clock
+        """
+        pour = self.pour
+        if self.debounce and pour.pouring and currentTime - pour.lastPinChange < self.debounce:
+            self.debouncedCounter.inc()
+            return
+        self.pulseCounter.inc()
+
+        if pour.pulse(currentTime):
+            self.emitPourStart()
+
+        # Only decides whether an update is due, the emitter thread sends it
+        if self.progress is not None:
+            self.progress.pulse(self, currentTime)
+
+    def checkPourEnd(self, currentTime):
+        """
+        If pouring was set to true and there hasn't been a change in the pin in over 3 seconds, we can
+        assume pouring has ceased so we'll post the data and reset the variables.
+
+        :param currentTime: Current time in milliseconds on the monotonic clock
+        """
+        # Pulses came in since the last check. With kernel timestamps they may be the start of a backlog
+        # read after a stall, older than the timeout while the rest of the pour is still queued.
+        if self.pour.pulses != self.checkedPulses:
+            self.checkedPulses = self.pour.pulses
+            return
+        if self.pour.expired(currentTime):
+            self.finishPour()
+
+    def finishPour(self):
+        """
+        Closes the current pour, then emits and posts it.
+        """
+        postPourData = self.pour.finish()
+
+        # The pour was too small to be a legit pour
+        if postPourData is None:
+            return
+
+        socketPourData = {
+            'kegid': postPourData['kegid'],
+            'volume': postPourData['volume'],
+            'duration': postPourData['duration']
+        }
+
+        logging.info('\n volume: %s oz\n duration: %s secs' % (socketPourData['volume'], socketPourData['duration']))
+
+        # Sends data through socket connect to the server to pass through to
+        # any connected users
+        self.emitTotalPour(socketPourData)
+        self.delivery.put(postPourData)
+
+        if self.ledger is not None:
+            self.ledger.put(postPourData, self.publishLevel if self.stream is not None else None)
+
+    def publishLevel(self, level):
+        """
+        Publishes the level of the keg once the ledger thread recorded a pour.
+        """
+        level['time'] = time.time()
+        self.stream.publish('keg', level)
+
+
+if __name__ == '__main__':
+    from journal import Journal
+    from progress import ProgressEmitter
+    from tap_manager import TapManager
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    try:
+        journal = Journal(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keg-journal.db'))
+        progress = ProgressEmitter()
+        progress.start()
+        # A single sampler serves every tap instead of one spinning thread per flowmeter
+        manager = TapManager([FlowMeter(1, 4, LOCAL, journal=journal, progress=progress),
+                              FlowMeter(2, 27, LOCAL, journal=journal, progress=progress)])
+        manager.start()
+    except Exception as e:
+        print e
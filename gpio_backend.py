@@ -0,0 +1,295 @@
+import os
+import time
+import threading
+
+# Name of the environment variable used to pick the GPIO backend without touching any code,
+# i.e. `KEG_GPIO_BACKEND=sim python flowmeter.py` on a dev box.
+BACKEND_ENV = 'KEG_GPIO_BACKEND'
+# Character device the `cdev` backend opens
+CHIP_ENV = 'KEG_GPIO_CHIP'
+
+_simulated = None
+_cdev = None
+
+
+def _clock_gettime_ns():
+    """
+    CLOCK_MONOTONIC in nanoseconds through libc, for Pythons without `time.monotonic_ns`. It is the clock
+    the kernel timestamps GPIO line events with.
+    """
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    now = timespec()
+    CLOCK_MONOTONIC = 1
+
+    def monotonic_ns():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+        return now.tv_sec * 1000000000 + now.tv_nsec
+    monotonic_ns()
+    return monotonic_ns
+
+
+if hasattr(time, 'monotonic_ns'):
+    monotonic_ns = time.monotonic_ns
+else:
+    try:
+        monotonic_ns = _clock_gettime_ns()
+    except (OSError, AttributeError):
+        # Not Linux, only the simulated pins can run here anyway
+        def monotonic_ns():
+            return int(time.time() * 1000000000)
+
+
+def monotonic_ms():
+    """
+    Milliseconds on the monotonic clock, with sub-millisecond precision. Pulse and pour timing use it
+    instead of `time.time()` so NTP adjusting the wall clock never stretches or shrinks a pour.
+    """
+    return monotonic_ns() / 1000000.0
+
+
+def get_gpio(name=None):
+    """
+    Returns the GPIO module/object the sensors should talk to.
+
+    Parameters
+    ----------
+    name<optional>: String
+        `rpi` for the real `RPi.GPIO` module, `cdev` for the Linux GPIO character device named by
+        `KEG_GPIO_CHIP` (`/dev/gpiochip0` by default) or `sim` for the simulated pins. Defaults to the
+        `KEG_GPIO_BACKEND` environment variable, falling back to `rpi`.
+    """
+    name = name or os.environ.get(BACKEND_ENV, 'rpi')
+
+    if name == 'rpi':
+        import RPi.GPIO as GPIO
+        return GPIO
+
+    if name == 'cdev':
+        global _cdev
+        if _cdev is None:
+            from gpio_cdev import CdevGPIO, GpioChip
+            _cdev = CdevGPIO(GpioChip(os.environ.get(CHIP_ENV, '/dev/gpiochip0')))
+        return _cdev
+
+    if name == 'sim':
+        global _simulated
+        if _simulated is None:
+            _simulated = SimulatedGPIO()
+        return _simulated
+
+    raise ValueError("Unknown GPIO backend `%s`" % name)
+
+
+class SimulatedGPIO(object):
+    """
+    Drop-in stand-in for the parts of `RPi.GPIO` used by the keg server.
+
+    Input levels are driven from test code with `drive` or `pulse`; edge callbacks registered with
+    `add_event_detect` are fired synchronously on the driving thread, so a simulated pulse train is
+    delivered exactly like the RPi.GPIO event thread would deliver it.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    RPI_REVISION = 3
+
+    def __init__(self):
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.callbacks = {}
+        self.edges = {}
+        self.detected = {}
+        self.waiters = {}
+        self.watchers = {}
+        self.sources = {}
+        self.condition = threading.Condition()
+
+    # RPi.GPIO API
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        self.directions[channel] = direction
+        if direction == self.OUT:
+            self.levels[channel] = initial if initial is not None else self.LOW
+        elif channel not in self.levels:
+            self.levels[channel] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, channel):
+        source = self.sources.get(channel)
+        if source is not None:
+            return source()
+        return self.levels.get(channel, self.LOW)
+
+    def output(self, channel, value):
+        self._set_level(channel, 1 if value else 0)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if channel in self.edges:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self.edges[channel] = edge
+        self.callbacks[channel] = []
+        self.detected[channel] = False
+        if callback is not None:
+            self.callbacks[channel].append(callback)
+
+    def add_event_callback(self, channel, callback):
+        if channel not in self.edges:
+            raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+        self.callbacks[channel].append(callback)
+
+    def remove_event_detect(self, channel):
+        self.edges.pop(channel, None)
+        self.callbacks.pop(channel, None)
+        self.detected.pop(channel, None)
+
+    def event_detected(self, channel):
+        detected = self.detected.get(channel, False)
+        if detected:
+            self.detected[channel] = False
+        return detected
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """
+        Blocks until `edge` is seen on `channel`. `timeout` is in milliseconds like RPi.GPIO and
+        `None` is returned if it expires.
+        """
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        with self.condition:
+            seen = []
+            waiter = (edge, seen)
+            self.waiters.setdefault(channel, []).append(waiter)
+            try:
+                while not seen:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters[channel].remove(waiter)
+            return channel
+
+    def cleanup(self, channel=None):
+        # The simulated devices watching the pins stay wired up, like the real ones
+        if channel is None:
+            watchers, sources = self.watchers, self.sources
+            self.__init__()
+            self.watchers, self.sources = watchers, sources
+        else:
+            for table in (self.directions, self.levels, self.callbacks, self.edges, self.detected):
+                table.pop(channel, None)
+
+    # Simulation controls
+
+    def drive(self, channel, value):
+        """
+        Sets the level seen on an input pin, firing any matching edge callbacks.
+        """
+        self._set_level(channel, 1 if value else 0)
+
+    def pulse(self, channel, count=1):
+        """
+        Drives `count` full high/low pulses onto `channel`.
+        """
+        for _ in range(count):
+            self._set_level(channel, 1)
+            self._set_level(channel, 0)
+
+    def play(self, channel, frequency, count, duty=0.5):
+        """
+        Drives a pulse train of `count` pulses at `frequency` Hz onto `channel` in real time, blocking until
+        it's done. Long periods are slept, short ones are spun, so trains of several kHz keep their timing.
+        Run it from a thread of its own to feed a sampler.
+
+        :return: Seconds the train actually took
+        """
+        period = 1.0 / frequency
+        high = period * duty
+        # Every pulse of the train starts with a rising edge
+        self._set_level(channel, 0)
+        started = time.time()
+        for i in range(count):
+            edge = started + i * period
+            wait_until(edge)
+            self._set_level(channel, 1)
+            wait_until(edge + high)
+            self._set_level(channel, 0)
+        return time.time() - started
+
+    def watch(self, channel, callback):
+        """
+        Calls `callback(channel, level)` on every level change of `channel`, outputs included. This is how
+        simulated devices, like `simulation.SimulatedHX711`, follow the clock the code under test drives.
+        """
+        self.watchers.setdefault(channel, []).append(callback)
+
+    def feed(self, channel, source):
+        """
+        Reads the level of `channel` from `source()` instead of the driven level. Lets a simulated device
+        compute its output only when the code under test looks at it.
+        """
+        self.sources[channel] = source
+
+    def _set_level(self, channel, level, timestamp=None):
+        previous = self.levels.get(channel, self.LOW)
+        self.levels[channel] = level
+        if previous == level:
+            return
+
+        for callback in self.watchers.get(channel, ()):
+            callback(channel, level)
+
+        if self.waiters.get(channel):
+            with self.condition:
+                for edge, seen in self.waiters[channel]:
+                    if self._matches(edge, level):
+                        seen.append(level)
+                self.condition.notify_all()
+
+        edge = self.edges.get(channel)
+        if edge is None:
+            return
+        if self._matches(edge, level):
+            self.detected[channel] = True
+            for callback in self.callbacks.get(channel, ()):
+                if timestamp is None:
+                    callback(channel)
+                else:
+                    callback(channel, timestamp)
+
+    def _matches(self, edge, level):
+        return edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level)
+
+
+def wait_until(deadline):
+    """
+    Sleeps until `deadline` (a `time.time()` value), spinning through the last couple of milliseconds
+    which `time.sleep` can't hit reliably.
+    """
+    remaining = deadline - time.time()
+    if remaining > 0.002:
+        time.sleep(remaining - 0.002)
+    while time.time() < deadline:
+        pass
@@ -0,0 +1,355 @@
+"""
+`RPi.GPIO` compatible backend on the Linux GPIO character device (`/dev/gpiochipN`, uAPI v2, kernel 5.10+):
+
+    KEG_GPIO_BACKEND=cdev python kegserver.py
+
+Edges are timestamped by the kernel on the CLOCK_MONOTONIC clock when the interrupt fires, queued in a
+per-line kernel buffer and read by one event thread in batches. The flowmeters time their pulses with these
+timestamps instead of the moment Python got around to them, so a pour keeps its exact duration when the
+process is descheduled or held up by the GIL for a while.
+"""
+import os
+import errno
+import fcntl
+import select
+import struct
+import logging
+import threading
+
+import metrics
+
+LOST = metrics.counter('keg_gpio_lost_events_total',
+                       'Edges dropped by the kernel because the event buffer of their line was full', ['chip'])
+
+# linux/gpio.h, uAPI v2
+LINES_MAX = 64
+NUM_ATTRS_MAX = 10
+
+FLAG_INPUT = 1 << 2
+FLAG_OUTPUT = 1 << 3
+FLAG_EDGE_RISING = 1 << 4
+FLAG_EDGE_FALLING = 1 << 5
+FLAG_BIAS_PULL_UP = 1 << 8
+FLAG_BIAS_PULL_DOWN = 1 << 9
+FLAG_BIAS_DISABLED = 1 << 10
+
+ATTR_OUTPUT_VALUES = 2
+ATTR_DEBOUNCE = 3
+
+EVENT_RISING_EDGE = 1
+EVENT_FALLING_EDGE = 2
+
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno, padding[6]
+EVENT = struct.Struct('=QIIII24x')
+# struct gpio_v2_line_config: flags, num_attrs, padding[5], then the attributes
+CONFIG = struct.Struct('=QI20x')
+# struct gpio_v2_line_config_attribute: id, padding, flags/values/debounce_period_us union, mask
+ATTRIBUTE = struct.Struct('=II8sQ')
+CONFIG_SIZE = CONFIG.size + NUM_ATTRS_MAX * ATTRIBUTE.size
+# struct gpio_v2_line_request: offsets[64], consumer[32], config, num_lines, event_buffer_size, padding[5], fd
+REQUEST_HEAD = struct.Struct('=%dI32s' % LINES_MAX)
+REQUEST_TAIL = struct.Struct('=II20xi')
+REQUEST_SIZE = REQUEST_HEAD.size + CONFIG_SIZE + REQUEST_TAIL.size
+# struct gpio_v2_line_values: bits, mask
+VALUES = struct.Struct('=QQ')
+
+
+def _iowr(number, size):
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | number
+
+
+GET_LINE_IOCTL = _iowr(0x07, REQUEST_SIZE)
+SET_CONFIG_IOCTL = _iowr(0x0D, CONFIG_SIZE)
+GET_VALUES_IOCTL = _iowr(0x0E, VALUES.size)
+SET_VALUES_IOCTL = _iowr(0x0F, VALUES.size)
+
+
+def pack_config(flags, value=None, debounce_us=0):
+    """
+    A `gpio_v2_line_config` for a single line, with its initial output value and debounce period.
+    """
+    attributes = []
+    if value is not None:
+        attributes.append(ATTRIBUTE.pack(ATTR_OUTPUT_VALUES, 0, struct.pack('=Q', 1 if value else 0), 1))
+    if debounce_us:
+        attributes.append(ATTRIBUTE.pack(ATTR_DEBOUNCE, 0, struct.pack('=I4x', debounce_us), 1))
+    padding = b'\0' * (ATTRIBUTE.size * (NUM_ATTRS_MAX - len(attributes)))
+    return CONFIG.pack(flags, len(attributes)) + b''.join(attributes) + padding
+
+
+class GpioChip(object):
+    """
+    A GPIO character device, requesting one line per file descriptor.
+
+    Parameters
+    ----------
+    path: String
+        Device to open, i.e. `/dev/gpiochip0`, the header pins of every Raspberry Pi.
+    event_buffer<optional>: Integer
+        Edges the kernel queues per line before dropping the newest ones, 1024 at most.
+    """
+    def __init__(self, path='/dev/gpiochip0', event_buffer=1024):
+        self.path = path
+        self.event_buffer = event_buffer
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_CLOEXEC', 0))
+
+    def request(self, offset, flags, value=None, debounce_us=0, consumer='keg-server'):
+        """
+        :return: File descriptor of the line, readable for its edge events
+        """
+        offsets = [offset] + [0] * (LINES_MAX - 1)
+        request = bytearray(REQUEST_HEAD.pack(*(offsets + [consumer.encode('ascii')[:31]])) +
+                            pack_config(flags, value, debounce_us) +
+                            REQUEST_TAIL.pack(1, self.event_buffer, 0))
+        fcntl.ioctl(self.fd, GET_LINE_IOCTL, request, True)
+        return REQUEST_TAIL.unpack_from(bytes(request), REQUEST_HEAD.size + CONFIG_SIZE)[2]
+
+    def configure(self, fd, flags, value=None, debounce_us=0):
+        fcntl.ioctl(fd, SET_CONFIG_IOCTL, bytearray(pack_config(flags, value, debounce_us)), True)
+
+    def get_value(self, fd):
+        values = bytearray(VALUES.pack(0, 1))
+        fcntl.ioctl(fd, GET_VALUES_IOCTL, values, True)
+        return VALUES.unpack(bytes(values))[0] & 1
+
+    def set_value(self, fd, value):
+        fcntl.ioctl(fd, SET_VALUES_IOCTL, bytearray(VALUES.pack(1 if value else 0, 1)), True)
+
+    def release(self, fd):
+        os.close(fd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Line(object):
+    __slots__ = ('offset', 'fd', 'flags', 'value', 'debounce', 'edge', 'callbacks', 'detected', 'seqno')
+
+    def __init__(self, offset, fd, flags, value):
+        self.offset = offset
+        self.fd = fd
+        self.flags = flags
+        self.value = value
+        self.debounce = 0
+        self.edge = None
+        self.callbacks = []
+        self.detected = False
+        self.seqno = 0
+
+
+class CdevGPIO(object):
+    """
+    The parts of the `RPi.GPIO` API used by the keg server, on a GPIO character device. Only BCM numbering is
+    supported, the BCM number of a pin is its line offset on the chip.
+
+    Edge callbacks are called from a single event thread with the channel and the kernel timestamp of the
+    edge in nanoseconds on the monotonic clock: `callback(channel, timestamp_ns)`. `EVENT_TIMESTAMPS` tells
+    the sensors they get one.
+
+    Parameters
+    ----------
+    chip: GpioChip
+        The device, or a `simulation.FakeChip` to run without one.
+    batch<optional>: Integer
+        Events read from a line in one system call.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    RPI_REVISION = 3
+
+    EVENT_TIMESTAMPS = True
+
+    EDGE_FLAGS = {RISING: FLAG_EDGE_RISING, FALLING: FLAG_EDGE_FALLING, BOTH: FLAG_EDGE_RISING | FLAG_EDGE_FALLING}
+    BIAS_FLAGS = {PUD_OFF: FLAG_BIAS_DISABLED, PUD_UP: FLAG_BIAS_PULL_UP, PUD_DOWN: FLAG_BIAS_PULL_DOWN}
+
+    def __init__(self, chip, batch=64):
+        self.chip = chip
+        self.batch = batch
+        self.lines = {}
+        self.lock = threading.RLock()
+        self.thread = None
+        self.wake = None
+        self.lost = 0
+
+        LOST.labels(getattr(chip, 'path', 'fake')).bind(lambda: self.lost)
+
+    # RPi.GPIO API
+
+    def setmode(self, mode):
+        if mode != self.BCM:
+            raise ValueError("The cdev backend only supports BCM numbering")
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        if direction == self.OUT:
+            flags = FLAG_OUTPUT
+            value = initial if initial is not None else self.LOW
+        else:
+            flags = FLAG_INPUT | self.BIAS_FLAGS.get(pull_up_down, FLAG_BIAS_DISABLED)
+            value = None
+
+        with self.lock:
+            line = self.lines.get(channel)
+            if line is None:
+                self.lines[channel] = Line(channel, self.chip.request(channel, flags, value), flags, value)
+            else:
+                line.flags, line.value, line.edge, line.callbacks = flags, value, None, []
+                self.chip.configure(line.fd, flags, value)
+
+    def input(self, channel):
+        return self.chip.get_value(self.line(channel).fd)
+
+    def output(self, channel, value):
+        line = self.line(channel)
+        line.value = 1 if value else 0
+        self.chip.set_value(line.fd, line.value)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.lock:
+            line = self.line(channel)
+            if line.edge is not None:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.enable_edges(line, edge, bouncetime)
+            if callback is not None:
+                line.callbacks.append(callback)
+            self.start()
+
+    def add_event_callback(self, channel, callback):
+        line = self.line(channel)
+        if line.edge is None:
+            raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+        line.callbacks.append(callback)
+
+    def remove_event_detect(self, channel):
+        with self.lock:
+            line = self.line(channel)
+            line.edge = None
+            line.callbacks = []
+            self.chip.configure(line.fd, line.flags, line.value, 0)
+            self.notify()
+
+    def event_detected(self, channel):
+        line = self.line(channel)
+        detected = line.detected
+        line.detected = False
+        return detected
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """
+        Blocks until `edge` is seen on `channel`. `timeout` is in milliseconds like RPi.GPIO and `None` is
+        returned if it expires.
+        """
+        with self.lock:
+            line = self.line(channel)
+            if line.callbacks:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            if line.edge != edge:
+                self.enable_edges(line, edge)
+
+        # Only edges from now on count, drop the ones queued since the last wait
+        while select.select([line.fd], [], [], 0)[0]:
+            os.read(line.fd, EVENT.size * self.batch)
+        if not select.select([line.fd], [], [], None if timeout is None else timeout / 1000.0)[0]:
+            return None
+        os.read(line.fd, EVENT.size * self.batch)
+        return channel
+
+    def cleanup(self, channel=None):
+        with self.lock:
+            channels = list(self.lines) if channel is None else [channel]
+            for item in channels:
+                line = self.lines.pop(item, None)
+                if line is not None:
+                    self.chip.release(line.fd)
+            self.notify()
+            thread = None
+            if channel is None and self.thread is not None:
+                # Detaching the wake pipe tells the event thread to exit
+                thread, self.thread, self.wake = self.thread, None, None
+        if thread is not None:
+            thread.join(1)
+
+    # Event thread
+
+    def line(self, channel):
+        line = self.lines.get(channel)
+        if line is None:
+            raise RuntimeError("The GPIO channel has not been set up as an input")
+        return line
+
+    def enable_edges(self, line, edge, bouncetime=None):
+        line.edge = edge
+        line.debounce = int(bouncetime * 1000) if bouncetime else 0
+        self.chip.configure(line.fd, line.flags | self.EDGE_FLAGS[edge], line.value, line.debounce)
+
+    def start(self):
+        """
+        Starts the event thread, once. Called with the lock held.
+        """
+        if self.thread is not None:
+            self.notify()
+            return
+        self.wake = os.pipe()
+        self.thread = threading.Thread(target=self.run, name='gpio-events', args=(self.wake,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self):
+        # Makes the event thread pick up lines that were added or removed
+        if self.wake is not None:
+            os.write(self.wake[1], b'x')
+
+    def run(self, wake):
+        while self.wake is wake:
+            with self.lock:
+                lines = dict((line.fd, line) for line in self.lines.values() if line.callbacks)
+            try:
+                readable = select.select([wake[0]] + list(lines), [], [])[0]
+            except (select.error, OSError, ValueError):
+                # A line was released under us, the wake pipe has the new set ready
+                continue
+            for fd in readable:
+                if fd == wake[0]:
+                    os.read(fd, 4096)
+                    continue
+                try:
+                    data = os.read(fd, EVENT.size * self.batch)
+                except OSError as e:
+                    # The line was released while we were waiting on it
+                    if e.errno != errno.EBADF:
+                        logging.error("\n\tCould not read the events of GPIO %s: %s" % (lines[fd].offset, e))
+                    continue
+                self.dispatch(lines[fd], data)
+
+        os.close(wake[0])
+        os.close(wake[1])
+
+    def dispatch(self, line, data):
+        """
+        Hands a batch of events read from a line to its callbacks, counting the ones the kernel dropped.
+        """
+        callbacks = line.callbacks
+        for position in range(0, len(data) - EVENT.size + 1, EVENT.size):
+            timestamp, event_id, offset, seqno, line_seqno = EVENT.unpack_from(data, position)
+            if line.seqno and line_seqno != line.seqno + 1:
+                self.lost += line_seqno - line.seqno - 1
+            line.seqno = line_seqno
+            line.detected = True
+            for callback in callbacks:
+                try:
+                    callback(line.offset, timestamp)
+                except Exception as e:
+                    logging.error("\n\tThe edge callback of GPIO %s failed" % line.offset)
+                    logging.error(e)
@@ -0,0 +1,462 @@
+"""
+`RPi.GPIO` compatible backend that adds the 16 inputs of MCP23017 I2C port expanders to the Pi's own pins, so
+one Pi can meter a wall of 16 to 32 taps:
+
+    "expanders": {"bus": 1, "addresses": [32, 33], "interrupt": 17, "base": 100}
+
+Expander pins are numbered from `base`, 16 per chip in the order of `addresses` (GPA0-7 then GPB0-7), so the
+taps on the second chip above are pins 116 to 131. Lower numbers are the Pi's own pins and are passed through
+to the native backend.
+
+The INTA/INTB outputs of every chip are mirrored and open drain, so all the chips share one interrupt pin of the
+Pi, pulled up. An interrupt only wakes the service thread, which reads the flags, captured state and current
+state of both ports of a chip in one 6 byte burst and fans the edges out to the callbacks of the pins. The read
+clears the interrupt. Each chip read takes ~0.25 ms at 400 kHz, which bounds how fast edges are seen: a pin
+changing twice in the time it takes to service the chips loses that pulse.
+"""
+import os
+import select
+import logging
+import threading
+
+import metrics
+from gpio_backend import monotonic_ns
+
+READS = metrics.counter('keg_expander_reads_total', 'Burst reads of the ports of an I2C expander', ['chip'])
+READ_SECONDS = metrics.histogram('keg_expander_read_seconds', 'Time to read the ports of an I2C expander',
+                                 ['chip'])
+LATENCY = metrics.histogram('keg_expander_latency_seconds', 'Time from the expander interrupt to the edges of '
+                            'every chip being dispatched', buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.025,
+                                                                    0.05, 0.1, 0.25))
+
+# Registers with IOCON.BANK = 0, where the A and B register of a pair are next to each other
+IODIR = 0x00
+IPOL = 0x02
+GPINTEN = 0x04
+DEFVAL = 0x06
+INTCON = 0x08
+IOCON = 0x0A
+GPPU = 0x0C
+INTF = 0x0E
+INTCAP = 0x10
+GPIO = 0x12
+OLAT = 0x14
+
+IOCON_MIRROR = 0x40
+IOCON_SEQOP = 0x20
+IOCON_ODR = 0x04
+
+PINS = 16
+
+
+def open_bus(number=1):
+    """
+    Opens `/dev/i2c-<number>` with smbus2, or the older smbus module. Imported here so they're only needed
+    with expanders.
+    """
+    try:
+        from smbus2 import SMBus
+    except ImportError:
+        from smbus import SMBus
+    return SMBus(number)
+
+
+class MCP23017(object):
+    """
+    One expander on the bus: its configuration and the last state read from its ports, both ports as a 16 bit
+    word with GPA0 as bit 0.
+
+    Parameters
+    ----------
+    bus: SMBus
+        The I2C bus, or a `simulation.FakeI2CBus`.
+    address<optional>: Integer
+        7 bit address of the chip, 0x20 to 0x27.
+    """
+    def __init__(self, bus, address=0x20):
+        self.bus = bus
+        self.address = address
+        self.inputs = 0xffff
+        self.pullups = 0
+        self.enabled = 0
+        self.latch = 0
+        self.state = 0
+        self.read_time = READ_SECONDS.labels(hex(address))
+        self.reads = 0
+        READS.labels(hex(address)).bind(lambda: self.reads)
+
+    def reset(self):
+        """
+        Mirrors the interrupt outputs as open drain, interrupts on change from the previous value, all pins
+        inputs without pull-ups. Expects the chip in BANK = 0, the power-on default.
+        """
+        self.write_byte(IOCON, IOCON_MIRROR | IOCON_ODR)
+        self.write_word(INTCON, 0)
+        self.write_word(IPOL, 0)
+        self.inputs, self.pullups, self.enabled, self.latch = 0xffff, 0, 0, 0
+        self.write_word(IODIR, self.inputs)
+        self.write_word(GPPU, self.pullups)
+        self.write_word(GPINTEN, self.enabled)
+        self.state = self.read_word(GPIO)
+
+    def configure(self, bit, direction_input, pullup=False, latch=None):
+        mask = 1 << bit
+        self.inputs = self.inputs | mask if direction_input else self.inputs & ~mask
+        self.pullups = self.pullups | mask if pullup else self.pullups & ~mask
+        if latch is not None:
+            self.output(bit, latch)
+        self.write_word(GPPU, self.pullups)
+        self.write_word(IODIR, self.inputs)
+
+    def output(self, bit, value):
+        self.latch = self.latch | (1 << bit) if value else self.latch & ~(1 << bit)
+        self.write_word(OLAT, self.latch)
+
+    def enable(self, bit, enabled=True):
+        self.enabled = self.enabled | (1 << bit) if enabled else self.enabled & ~(1 << bit)
+        self.write_word(GPINTEN, self.enabled)
+
+    def read(self):
+        """
+        Reads INTF, INTCAP and GPIO of both ports in one burst, which also clears the interrupt.
+
+        :return: (previous state, state when the interrupt fired, current state). The middle one is the
+            previous state for a port without an interrupt pending.
+        """
+        with self.read_time.time():
+            data = self.bus.read_i2c_block_data(self.address, INTF, 6)
+        self.reads += 1
+        flags = data[0] | data[1] << 8
+        captured = data[2] | data[3] << 8
+        current = data[4] | data[5] << 8
+
+        previous = self.state
+        # INTCAP only means something for the port that raised the interrupt
+        mask = (0x00ff if flags & 0x00ff else 0) | (0xff00 if flags & 0xff00 else 0)
+        middle = (captured & mask) | (previous & ~mask)
+        self.state = current
+        return previous, middle, current
+
+    def write_byte(self, register, value):
+        self.bus.write_byte_data(self.address, register, value & 0xff)
+
+    def write_word(self, register, value):
+        self.bus.write_i2c_block_data(self.address, register, [value & 0xff, (value >> 8) & 0xff])
+
+    def read_word(self, register):
+        data = self.bus.read_i2c_block_data(self.address, register, 2)
+        return data[0] | data[1] << 8
+
+
+class ExpanderPin(object):
+    __slots__ = ('chip', 'bit', 'edge', 'callbacks', 'detected', 'waiters')
+
+    def __init__(self, chip, bit):
+        self.chip = chip
+        self.bit = bit
+        self.edge = None
+        self.callbacks = []
+        self.detected = False
+        self.waiters = 0
+
+
+class ExpanderGPIO(object):
+    """
+    The parts of the `RPi.GPIO` API used by the keg server, over the Pi's own pins and the pins of MCP23017
+    expanders. Only BCM numbering is supported.
+
+    Edge callbacks of expander pins are called from the service thread with the channel and the time of the
+    edge in nanoseconds on the monotonic clock, `callback(channel, timestamp_ns)`: the time of the interrupt
+    for the edge that raised it, which is the kernel timestamp when the native backend is `cdev`, and the time
+    of the read for an edge that came after it.
+
+    Parameters
+    ----------
+    gpio: GPIO backend
+        Native backend, for the Pi's own pins and the interrupt pin.
+    bus: SMBus
+        The I2C bus of the expanders, see `open_bus`.
+    addresses<optional>: List of Integer
+        Addresses of the expanders, their pins are numbered in this order.
+    interrupt<optional>: Integer
+        Pin of the Pi the interrupt outputs are wired to. Without one the chips are polled.
+    base<optional>: Integer
+        Number of the first expander pin.
+    poll_interval<optional>: Float
+        Seconds between reads while no interrupt comes, so a lost interrupt can't leave the line asserted
+        forever. Also the polling period without an interrupt pin.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    RPI_REVISION = 3
+
+    EVENT_TIMESTAMPS = True
+
+    def __init__(self, gpio, bus, addresses=(0x20,), interrupt=None, base=100, poll_interval=0.05):
+        self.gpio = gpio
+        self.bus = bus
+        self.interrupt = interrupt
+        self.base = base
+        self.poll_interval = poll_interval
+        self.chips = [MCP23017(bus, address) for address in addresses]
+        self.pins = {}
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.interrupt_time = None
+        self.thread = None
+        # Pipe the interrupt callback wakes the service thread through, select waits on it precisely on every
+        # Python, unlike `Event.wait` with a timeout on Python 2
+        self.wake = None
+        self.running = False
+
+        for chip in self.chips:
+            chip.reset()
+
+    # RPi.GPIO API
+
+    def setmode(self, mode):
+        if mode != self.BCM:
+            raise ValueError("The expander backend only supports BCM numbering")
+        self.gpio.setmode(mode)
+
+    def setwarnings(self, flag):
+        self.gpio.setwarnings(flag)
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        if channel < self.base:
+            return self.gpio.setup(channel, direction, pull_up_down=pull_up_down, initial=initial)
+        if pull_up_down == self.PUD_DOWN:
+            raise ValueError("The MCP23017 only has pull-up resistors")
+
+        pin = self.pin(channel, create=True)
+        with self.lock:
+            pin.edge, pin.callbacks = None, []
+            pin.chip.enable(pin.bit, False)
+            pin.chip.configure(pin.bit, direction == self.IN, pull_up_down == self.PUD_UP,
+                               initial if direction == self.OUT else None)
+
+    def input(self, channel):
+        if channel < self.base:
+            return self.gpio.input(channel)
+        pin = self.pin(channel)
+        # The service thread keeps the state current, reading the port here would clear its interrupt
+        if not self.running:
+            self.service(pin.chip)
+        return pin.chip.state >> pin.bit & 1
+
+    def output(self, channel, value):
+        if channel < self.base:
+            return self.gpio.output(channel, value)
+        pin = self.pin(channel)
+        with self.lock:
+            pin.chip.output(pin.bit, value)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        """
+        `bouncetime` is ignored on expander pins, the chips have no debouncing.
+        """
+        if channel < self.base:
+            return self.gpio.add_event_detect(channel, edge, callback=callback, bouncetime=bouncetime)
+        pin = self.pin(channel)
+        with self.lock:
+            if pin.edge is not None:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            pin.edge = edge
+            if callback is not None:
+                pin.callbacks.append(callback)
+            pin.chip.enable(pin.bit)
+            self.start()
+
+    def add_event_callback(self, channel, callback):
+        if channel < self.base:
+            return self.gpio.add_event_callback(channel, callback)
+        pin = self.pin(channel)
+        if pin.edge is None:
+            raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+        pin.callbacks.append(callback)
+
+    def remove_event_detect(self, channel):
+        if channel < self.base:
+            return self.gpio.remove_event_detect(channel)
+        pin = self.pin(channel)
+        with self.lock:
+            pin.edge = None
+            pin.callbacks = []
+            pin.chip.enable(pin.bit, False)
+
+    def event_detected(self, channel):
+        if channel < self.base:
+            return self.gpio.event_detected(channel)
+        pin = self.pin(channel)
+        detected = pin.detected
+        pin.detected = False
+        return detected
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """
+        Blocks until `edge` is seen on `channel`. `timeout` is in milliseconds like RPi.GPIO and `None` is
+        returned if it expires.
+        """
+        if channel < self.base:
+            return self.gpio.wait_for_edge(channel, edge, timeout=timeout)
+        pin = self.pin(channel)
+        with self.condition:
+            if pin.callbacks:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            pin.edge = edge
+            pin.detected = False
+            pin.waiters += 1
+            pin.chip.enable(pin.bit)
+            self.start()
+            deadline = None if timeout is None else monotonic_ns() + timeout * 1000000
+            try:
+                # Other pins wake the condition too
+                while not pin.detected:
+                    remaining = None if deadline is None else (deadline - monotonic_ns()) / 1e9
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                seen = pin.detected
+            finally:
+                pin.waiters -= 1
+            pin.detected = False
+            return channel if seen else None
+
+    def cleanup(self, channel=None):
+        if channel is not None and channel >= self.base:
+            pin = self.pins.pop(channel, None)
+            if pin is not None:
+                with self.lock:
+                    pin.chip.enable(pin.bit, False)
+                    pin.chip.configure(pin.bit, True)
+            return
+
+        if channel is None:
+            with self.lock:
+                thread, self.thread, self.running = self.thread, None, False
+                self.pins = {}
+                for chip in self.chips:
+                    chip.reset()
+                # Detaching the wake pipe tells the service thread to exit
+                self.notify()
+                self.wake = None
+            if thread is not None:
+                thread.join(1)
+        self.gpio.cleanup(channel)
+
+    # Service thread
+
+    def pin(self, channel, create=False):
+        pin = self.pins.get(channel)
+        if pin is None:
+            index, bit = divmod(channel - self.base, PINS)
+            if not create or index >= len(self.chips):
+                raise RuntimeError("The GPIO channel has not been set up as an input")
+            pin = self.pins[channel] = ExpanderPin(self.chips[index], bit)
+        return pin
+
+    def start(self):
+        """
+        Starts the service thread and hooks the interrupt pin, once. Called with the lock held.
+        """
+        if self.thread is not None:
+            return
+        if self.interrupt is not None:
+            # The outputs are open drain and active low, held low until the chips are read
+            self.gpio.setup(self.interrupt, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+            self.gpio.add_event_detect(self.interrupt, self.gpio.FALLING, callback=self.on_interrupt)
+        self.running = True
+        self.wake = os.pipe()
+        self.thread = threading.Thread(target=self.run, name='gpio-expanders', args=(self.wake,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def on_interrupt(self, channel, timestamp=None):
+        self.interrupt_time = timestamp if timestamp is not None else monotonic_ns()
+        self.notify()
+
+    def notify(self):
+        if self.wake is not None:
+            os.write(self.wake[1], b'x')
+
+    def run(self, wake):
+        pending = False
+        while self.wake is wake:
+            if not pending and select.select([wake[0]], [], [], self.poll_interval)[0]:
+                os.read(wake[0], 4096)
+            interrupted, self.interrupt_time = self.interrupt_time, None
+            for chip in self.chips:
+                self.service(chip, interrupted)
+            if interrupted is not None:
+                LATENCY.observe((monotonic_ns() - interrupted) / 1e9)
+
+            # The shared line stays low without a new falling edge when another chip raised an interrupt while
+            # the first one was being read
+            pending = self.interrupt is not None and not self.gpio.input(self.interrupt)
+
+        os.close(wake[0])
+        os.close(wake[1])
+
+    def service(self, chip, interrupted=None):
+        """
+        Reads both ports of `chip` and calls the callbacks of the pins that saw their edge, the first change
+        of a pin at the interrupt time and the second at the time of the read.
+        """
+        try:
+            with self.lock:
+                previous, middle, current = chip.read()
+        except IOError as e:
+            logging.error("\n\tCould not read the expander at %s" % hex(chip.address))
+            logging.error(e)
+            return
+        now = monotonic_ns()
+        if previous == middle == current:
+            return
+
+        rising_first, rising_second = middle & ~previous, current & ~middle
+        falling_first, falling_second = previous & ~middle, middle & ~current
+        base = self.base + self.chips.index(chip) * PINS
+        woken = False
+        for bit in bits((rising_first | rising_second | falling_first | falling_second) & chip.enabled):
+            pin = self.pins.get(base + bit)
+            if pin is None or pin.edge is None:
+                continue
+            mask = 1 << bit
+            first = (pin.edge != self.FALLING and rising_first & mask) or \
+                (pin.edge != self.RISING and falling_first & mask)
+            second = (pin.edge != self.FALLING and rising_second & mask) or \
+                (pin.edge != self.RISING and falling_second & mask)
+            if not first and not second:
+                continue
+
+            pin.detected = True
+            woken = woken or pin.waiters
+            for callback in pin.callbacks:
+                if first:
+                    callback(base + bit, interrupted if interrupted is not None else now)
+                if second:
+                    callback(base + bit, now)
+
+        if woken:
+            with self.condition:
+                self.condition.notify_all()
+
+
+def bits(word):
+    """
+    The numbers of the bits set in `word`, lowest first.
+    """
+    while word:
+        low = word & -word
+        yield low.bit_length() - 1
+        word ^= low
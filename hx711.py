@@ -1,17 +1,51 @@
-import RPi.GPIO as GPIO
 import time
+import logging
+import threading
 import numpy  # sudo apt-get python-numpy
 
+import metrics
+from gpio_backend import get_gpio
+
+READ_SECONDS = metrics.histogram('keg_hx711_read_seconds', 'Time to shift a sample out of an hx711, excluding '
+                                 'the wait for data ready', ['dout'])
+TIMEOUTS = metrics.counter('keg_hx711_timeouts_total', 'Waits for hx711 data ready that timed out', ['dout'])
+RESETS = metrics.counter('keg_hx711_resets_total', 'Power cycles of an hx711 after repeated timeouts', ['dout'])
+
+# Seconds between two logged timeouts of a streaming hx711, the rest are only counted
+TIMEOUT_LOG_INTERVAL = 60.0
+
+
+class HX711TimeoutError(Exception):
+    """
+    Raised when the hx711 doesn't signal data ready in time, usually a disconnected load cell.
+    """
+    pass
+
 
 class HX711:
-    def __init__(self, dout, pd_sck, gain=128):
+    def __init__(self, dout, pd_sck, gain=128, timeout=1.0, max_timeouts=3, gpio=None):
+        # The module/object providing the RPi.GPIO API, see `gpio_backend`
+        self.GPIO = gpio if gpio is not None else get_gpio()
         self.PD_SCK = pd_sck
         self.DOUT = dout
 
+        # Seconds to wait for DOUT to signal data ready, and the number of timeouts in a row after which
+        # the chip is power cycled
+        self.timeout = timeout
+        self.max_timeouts = max_timeouts
+
+        # Sensor fault counters
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.resets = 0
+        self.read_time = READ_SECONDS.labels(dout)
+        TIMEOUTS.labels(dout).bind(lambda: self.timeouts)
+        RESETS.labels(dout).bind(lambda: self.resets)
+
         try:
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setup(self.PD_SCK, GPIO.OUT)
-            GPIO.setup(self.DOUT, GPIO.IN)
+            self.GPIO.setmode(self.GPIO.BCM)
+            self.GPIO.setup(self.PD_SCK, self.GPIO.OUT)
+            self.GPIO.setup(self.DOUT, self.GPIO.IN)
         except Exception as e:
             print e
 
@@ -30,12 +64,23 @@ class HX711:
         self.byte_range_values = self.LSByte
         self.bit_range_values = self.MSBit
 
+        # Streaming state, see `start_stream`
+        self.buffer = None
+        self.count = 0
+        self.last_sample_time = 0
+        self.rate = 10
+        self.streaming = False
+        self.stream_thread = None
+        self.filter = None
+        # When a timeout was last logged, a disconnected chip times out every `timeout` seconds
+        self.timeout_logged = 0
+
         self.set_gain(gain)
 
         time.sleep(1)
 
     def is_ready(self):
-        return GPIO.input(self.DOUT) == 0
+        return self.GPIO.input(self.DOUT) == 0
 
     def set_gain(self, gain):
         if gain is 128:
@@ -45,8 +90,156 @@ class HX711:
         elif gain is 32:
             self.GAIN = 2
 
-        GPIO.output(self.PD_SCK, False)
-        self.read()
+        self.GPIO.output(self.PD_SCK, False)
+        self.read_raw()
+
+    def wait_ready(self):
+        """
+        Waits for the falling edge of DOUT that signals data ready, blocking in the GPIO library instead of
+        spinning. If it doesn't come within `timeout` the timeout is counted, the chip is power cycled
+        after `max_timeouts` in a row, and HX711TimeoutError is raised.
+        """
+        if self.is_ready():
+            self.consecutive_timeouts = 0
+            return
+
+        self.GPIO.wait_for_edge(self.DOUT, self.GPIO.FALLING, timeout=int(self.timeout * 1000))
+
+        # DOUT stays low until read, so the edge may have come before we started waiting
+        if self.is_ready():
+            self.consecutive_timeouts = 0
+            return
+
+        self.timeouts += 1
+        self.consecutive_timeouts += 1
+        if self.consecutive_timeouts >= self.max_timeouts:
+            logging.warning("\n\thx711 on pin %s timed out %s times in a row, power cycling it"
+                            % (self.DOUT, self.consecutive_timeouts))
+            self.consecutive_timeouts = 0
+            self.resets += 1
+            self.reset()
+
+        raise HX711TimeoutError("hx711 on pin %s did not signal data ready within %s seconds, check the load cell"
+                                % (self.DOUT, self.timeout))
+
+    def read_raw(self):
+        """
+        Reads one sample by shifting the 24 data bits straight into an integer, MSB first, without
+        allocating anything per read.
+
+        :return: The signed 24 bit value
+        """
+        self.wait_ready()
+        started = time.time()
+
+        output = self.GPIO.output
+        read = self.GPIO.input
+        sck = self.PD_SCK
+        dout = self.DOUT
+
+        value = 0
+        for i in range(24):
+            output(sck, True)
+            value = (value << 1) | read(dout)
+            output(sck, False)
+
+        # set channel and gain factor for next reading
+        for i in range(self.GAIN):
+            output(sck, True)
+            output(sck, False)
+
+        self.read_time.observe(time.time() - started)
+
+        # the hx711 outputs two's complement
+        if value & 0x800000:
+            value -= 0x1000000
+        return value
+
+    def samples(self):
+        """
+        Generator yielding samples as fast as the chip produces them (10 or 80 SPS), storing each one in
+        the preallocated int32 ring buffer set up by `start_stream`. Ends once `stop_stream` is called, even
+        while the chip keeps timing out.
+        """
+        while True:
+            try:
+                value = self.read_raw()
+            except HX711TimeoutError as e:
+                if not self.streaming:
+                    return
+                now = time.time()
+                if now - self.timeout_logged >= TIMEOUT_LOG_INTERVAL:
+                    self.timeout_logged = now
+                    logging.error("%s (%s timeouts so far)" % (e, self.timeouts))
+                continue
+            if self.buffer is not None:
+                self.buffer[self.count % len(self.buffer)] = value
+                self.count += 1
+                self.last_sample_time = time.time()
+            if self.filter is not None:
+                self.filter.add(value)
+            yield value
+
+    def start_stream(self, buffer_size=256, rate=10, filter=None):
+        """
+        Continuously reads samples into a ring buffer from a background thread. While streaming,
+        `read_average`, `get_value` and `get_weight` are computed over the buffered samples instead of
+        waiting for new conversions.
+
+        :param buffer_size: Number of samples kept
+        :param rate: Output rate of the chip in samples per second, 10 or 80 depending on the RATE pin
+        :param filter: WeightFilter every sample is fed through, see `get_filtered_weight`
+        """
+        self.filter = filter
+        self.buffer = numpy.zeros(buffer_size, dtype=numpy.int32)
+        self.count = 0
+        self.rate = rate
+        self.streaming = True
+
+        def run():
+            for value in self.samples():
+                if not self.streaming:
+                    return
+                # The next conversion won't be ready before most of a sample period has gone by
+                time.sleep(0.8 / self.rate)
+
+        self.stream_thread = threading.Thread(target=run, name='hx711-%s' % self.DOUT)
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+
+    def stop_stream(self):
+        self.streaming = False
+        if self.stream_thread is not None:
+            # The thread may be waiting out a timeout of a disconnected chip
+            self.stream_thread.join(self.timeout * 2)
+            self.stream_thread = None
+
+    def latest(self, times):
+        """
+        The last `times` streamed samples, oldest first, as a numpy array.
+        """
+        size = len(self.buffer)
+        times = min(times, self.count, size)
+        end = self.count % size
+        if end >= times:
+            return self.buffer[end - times:end]
+        return numpy.concatenate((self.buffer[size - (times - end):], self.buffer[:end]))
+
+    def wait_samples(self, times):
+        """
+        Waits for the stream to hold `times` samples, the last one fresh, for as long as the chip takes to
+        convert them plus `timeout` seconds.
+
+        :return: The last `times` streamed samples
+        """
+        deadline = time.time() + self.timeout + times / float(self.rate)
+        while self.count < times or time.time() - self.last_sample_time >= self.timeout:
+            if time.time() >= deadline:
+                raise HX711TimeoutError("hx711 on pin %s streamed %s of %s samples, the last %.1f seconds ago"
+                                        % (self.DOUT, min(self.count, times), times,
+                                           time.time() - self.last_sample_time))
+            time.sleep(0.2 / self.rate)
+        return self.latest(times)
 
     def createBoolList(self, size=8):
         ret = []
@@ -55,26 +248,26 @@ class HX711:
         return ret
 
     def read(self):
-        print "checking if board is ready"
-        while not self.is_ready():
-            # print("WAITING")
-            pass
+        """
+        Reads one sample as bytes in the order set with `set_reading_format`. Only used to debug the
+        byte and bit order, see `read_raw` for the fast path.
+        """
+        self.wait_ready()
 
-        print "board is ready. now reading"
         dataBits = [self.createBoolList(), self.createBoolList(), self.createBoolList()]
         dataBytes = [0x0] * 4
 
         for j in range(self.byte_range_values[0], self.byte_range_values[1], self.byte_range_values[2]):
             for i in range(self.bit_range_values[0], self.bit_range_values[1], self.bit_range_values[2]):
-                GPIO.output(self.PD_SCK, True)
-                dataBits[j][i] = GPIO.input(self.DOUT)
-                GPIO.output(self.PD_SCK, False)
+                self.GPIO.output(self.PD_SCK, True)
+                dataBits[j][i] = self.GPIO.input(self.DOUT)
+                self.GPIO.output(self.PD_SCK, False)
             dataBytes[j] = numpy.packbits(numpy.uint8(dataBits[j]))
 
         # set channel and gain factor for next reading
         for i in range(self.GAIN):
-            GPIO.output(self.PD_SCK, True)
-            GPIO.output(self.PD_SCK, False)
+            self.GPIO.output(self.PD_SCK, True)
+            self.GPIO.output(self.PD_SCK, False)
 
         # check for all 1
         # if all(item is True for item in dataBits[0]):
@@ -113,13 +306,16 @@ class HX711:
         return np_arr8
 
     def read_long(self):
-        np_arr8 = self.read_np_arr8()
-        np_arr32 = np_arr8.view('uint32')
-        self.lastVal = np_arr32
+        self.lastVal = self.read_raw()
 
         return long(self.lastVal)
 
     def read_average(self, times=3):
+        # Average the streamed samples rather than waiting for new conversions, as long as they are fresh.
+        # Only the stream thread may clock the chip, a read from here would interleave with its bits.
+        if self.streaming:
+            return long(self.wait_samples(times).mean())
+
         values = long(0)
         for i in range(times):
             values += self.read_long()
@@ -134,8 +330,25 @@ class HX711:
         value = value / self.REFERENCE_UNIT
         return value
 
+    def get_filtered_weight(self):
+        """
+        The current weight from the streaming filter, returned instantly without reading the chip.
+        None until the filter has seen a sample.
+        """
+        if self.filter is None or self.filter.value is None:
+            return None
+        return (self.filter.value - self.OFFSET) / float(self.REFERENCE_UNIT)
+
+    def is_settled(self):
+        return self.filter is not None and self.filter.settled
+
     def tare(self, times=15):
 
+        # A settled filtered value is already a stable zero
+        if self.is_settled():
+            self.set_offset(self.filter.value)
+            return
+
         # Backup REFERENCE_UNIT value
         reference_unit = self.REFERENCE_UNIT
         self.set_reference_unit(1)
@@ -166,12 +379,12 @@ class HX711:
     # I used 100 microseconds, just in case.
     # I've found it is good practice to reset the hx711 if it wasn't used for more than a few seconds.
     def power_down(self):
-        GPIO.output(self.PD_SCK, False)
-        GPIO.output(self.PD_SCK, True)
+        self.GPIO.output(self.PD_SCK, False)
+        self.GPIO.output(self.PD_SCK, True)
         time.sleep(0.0001)
 
     def power_up(self):
-        GPIO.output(self.PD_SCK, False)
+        self.GPIO.output(self.PD_SCK, False)
         time.sleep(0.0001)
 
     def reset(self):
@@ -0,0 +1,215 @@
+import time
+import numpy
+
+from gpio_backend import get_gpio
+from hx711 import HX711TimeoutError, READ_SECONDS, TIMEOUTS
+
+# Number of clock pulses after the 24 data bits selecting the channel and gain of the next conversion
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}
+
+
+class MultiHX711:
+    """
+    Reads several hx711 boards wired to one shared PD_SCK pin, each with its own DOUT pin, in a single
+    clock pass. Every clock edge samples all the DOUT pins, so a sweep of N load cells costs one 24 bit
+    read instead of N.
+
+    The pulses following the data bits select the channel and gain of the next conversion, and with a
+    shared clock every board gets the same number of them. Cells with different gains are therefore read
+    in alternating sweeps, one per distinct gain, and a cell only keeps values converted at its own gain.
+    With a single gain, which is the usual setup, every sweep reads every cell.
+
+    With `filters`, `update` feeds every cell's raw value through a WeightFilter of its own, and
+    `get_filtered_weight` and `is_settled` answer for a cell without reading the boards, as they do for a
+    streaming HX711.
+
+    Each clock pulse is ended before the DOUT pins are read (the bit stays on DOUT until the next rising
+    edge), so PD_SCK is never held high long enough to power the boards down, however many share it.
+
+    Parameters
+    ----------
+    douts: List of Integer
+        The DOUT pin of every board.
+    pd_sck: Integer
+        The shared PD_SCK pin.
+    gains<optional>: Integer or List of Integer
+        Gain (128, 64 or 32) for all the cells or for each cell. 128 and 64 read channel A, 32 channel B.
+    timeout<optional>: Float
+        Seconds to wait for every board to signal data ready.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API. Defaults to `gpio_backend.get_gpio()`.
+    filters<optional>: List of WeightFilter
+        One filter per cell, fed by `update`.
+    """
+    def __init__(self, douts, pd_sck, gains=128, timeout=1.0, gpio=None, filters=None):
+        self.GPIO = gpio if gpio is not None else get_gpio()
+        self.PD_SCK = pd_sck
+        self.DOUTS = list(douts)
+        self.timeout = timeout
+
+        count = len(self.DOUTS)
+        if isinstance(gains, int):
+            gains = [gains] * count
+        for gain in gains:
+            if gain not in GAIN_PULSES:
+                raise ValueError("Gain must be 128, 64 or 32, got %s" % gain)
+        self.gains = list(gains)
+        self.gain_cycle = sorted(set(self.gains), reverse=True)
+        # Gain the boards were told to use for the conversion they're doing now
+        self.current_gain = None
+
+        self.offsets = numpy.zeros(count, dtype=numpy.float64)
+        self.reference_units = numpy.ones(count, dtype=numpy.float64)
+        self.values = numpy.zeros(count, dtype=numpy.int32)
+        self.timeouts = 0
+
+        if filters is not None and len(filters) != count:
+            raise ValueError("Expected %d filters, got %d" % (count, len(filters)))
+        self.filters = filters
+
+        # A sweep reads every board, so it's labeled with all their DOUT pins
+        pins = ','.join(str(dout) for dout in self.DOUTS)
+        self.read_time = READ_SECONDS.labels(pins)
+        TIMEOUTS.labels(pins).bind(lambda: self.timeouts)
+
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.GPIO.setup(self.PD_SCK, self.GPIO.OUT)
+        for dout in self.DOUTS:
+            self.GPIO.setup(dout, self.GPIO.IN)
+        self.GPIO.output(self.PD_SCK, False)
+
+        # Discard the first sweep, it only programs the gain of the next conversion
+        self.sweep(self.gain_cycle[0])
+
+    def set_offset(self, index, offset):
+        self.offsets[index] = offset
+
+    def set_reference_unit(self, index, reference_unit):
+        self.reference_units[index] = reference_unit
+
+    def set_gain(self, index, gain):
+        if gain not in GAIN_PULSES:
+            raise ValueError("Gain must be 128, 64 or 32, got %s" % gain)
+        self.gains[index] = gain
+        self.gain_cycle = sorted(set(self.gains), reverse=True)
+
+    def wait_ready(self):
+        """
+        Waits until every board pulled its DOUT low, blocking on falling edges rather than spinning.
+        """
+        deadline = time.time() + self.timeout
+        for dout in self.DOUTS:
+            while self.GPIO.input(dout) != 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    waiting = [pin for pin in self.DOUTS if self.GPIO.input(pin) != 0]
+                    raise HX711TimeoutError("hx711 on pins %s did not signal data ready within %s seconds"
+                                            % (waiting, self.timeout))
+                self.GPIO.wait_for_edge(dout, self.GPIO.FALLING, timeout=max(int(remaining * 1000), 1))
+
+    def sweep(self, next_gain):
+        """
+        Clocks the 24 data bits out of every board at once, then programs `next_gain` for the next
+        conversion.
+
+        :return: List of the signed 24 bit values, one per board
+        """
+        self.wait_ready()
+        started = time.time()
+
+        output = self.GPIO.output
+        read = self.GPIO.input
+        sck = self.PD_SCK
+        douts = self.DOUTS
+
+        values = [0] * len(douts)
+        indexes = range(len(douts))
+        for bit in range(24):
+            # A pulse longer than 60 microseconds powers the boards down, end it before reading the bits
+            output(sck, True)
+            output(sck, False)
+            levels = [read(dout) for dout in douts]
+            for i in indexes:
+                values[i] = (values[i] << 1) | levels[i]
+
+        for i in range(GAIN_PULSES[next_gain]):
+            output(sck, True)
+            output(sck, False)
+
+        self.current_gain = next_gain
+        self.read_time.observe(time.time() - started)
+        return [value - 0x1000000 if value & 0x800000 else value for value in values]
+
+    def read(self):
+        """
+        Reads every cell, doing one sweep per distinct gain.
+
+        :return: numpy int32 array of the raw value of each cell
+        """
+        cycle = self.gain_cycle
+        for step in range(len(cycle)):
+            converted_gain = self.current_gain
+            next_gain = cycle[(cycle.index(converted_gain) + 1) % len(cycle)] if converted_gain in cycle else cycle[0]
+            values = self.sweep(next_gain)
+            for i, gain in enumerate(self.gains):
+                if gain == converted_gain:
+                    self.values[i] = values[i]
+        return self.values.copy()
+
+    def read_average(self, times=3):
+        total = numpy.zeros(len(self.DOUTS), dtype=numpy.float64)
+        for i in range(times):
+            total += self.read()
+        return total / times
+
+    def get_values(self, times=3):
+        return self.read_average(times) - self.offsets
+
+    def get_weights(self, times=3):
+        """
+        The weight on every cell, computed for all of them at once.
+        """
+        return self.get_values(times) / self.reference_units
+
+    def update(self):
+        """
+        Reads every cell once and feeds each raw value through the filter of its cell.
+
+        :return: numpy int32 array of the raw value of each cell
+        """
+        values = self.read()
+        if self.filters is not None:
+            for value, weight_filter in zip(values, self.filters):
+                weight_filter.add(float(value))
+        return values
+
+    def get_filtered_weight(self, index):
+        """
+        The current weight on a cell from its filter, returned instantly without reading the boards. None
+        until the filter has seen a sample.
+        """
+        if self.filters is None or self.filters[index].value is None:
+            return None
+        return (self.filters[index].value - self.offsets[index]) / float(self.reference_units[index])
+
+    def is_settled(self, index):
+        return self.filters is not None and self.filters[index].settled
+
+    def tare(self, times=15):
+        self.offsets = self.read_average(times)
+
+    def power_down(self):
+        self.GPIO.output(self.PD_SCK, False)
+        self.GPIO.output(self.PD_SCK, True)
+        time.sleep(0.0001)
+
+    def power_up(self):
+        self.GPIO.output(self.PD_SCK, False)
+        time.sleep(0.0001)
+        # After a power up the boards convert at gain 128 on channel A
+        self.current_gain = 128
+
+    def reset(self):
+        self.power_down()
+        self.power_up()
@@ -0,0 +1,127 @@
+import time
+import json
+import sqlite3
+import threading
+
+import metrics
+
+PENDING = metrics.gauge('keg_journal_pending_records', 'Journaled records the API has not acknowledged yet')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    created REAL NOT NULL,
+    payload TEXT NOT NULL,
+    acknowledged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS records_pending ON records (kind, id) WHERE acknowledged = 0;
+"""
+
+
+class Journal(object):
+    """
+    Append-only local journal of every pour and temperature reading, kept in SQLite so nothing is lost
+    to a power cut or an API outage. Records stay pending until the API acknowledges them, and pending
+    records are handed back in bulk for replay.
+
+    The database runs in WAL mode with `synchronous=NORMAL`, so an append is a sequential write to the
+    log without an fsync per record, which keeps it cheap on SD cards while surviving process crashes.
+
+    Acknowledged records are only kept for a while, `prune` deletes the old ones (the keg server does it
+    hourly).
+
+    Parameters
+    ----------
+    path<optional>: String
+        Location of the SQLite database file.
+    """
+    def __init__(self, path='keg-journal.db'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        PENDING.bind(self.pending_count)
+
+    def append(self, kind, record, acknowledged=False):
+        """
+        Stores a record.
+
+        :param kind: Type of record, i.e. `pour` or `temperature`
+        :param record: JSON serializable dictionary. Datetimes are stored as strings.
+        :param acknowledged: Store the record as already delivered, for readings that aren't posted.
+        :return: The id of the stored record
+        """
+        payload = json.dumps(record, default=str)
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO records (kind, created, payload, acknowledged) VALUES (?, ?, ?, ?)',
+                (kind, time.time(), payload, 1 if acknowledged else 0))
+            self.connection.commit()
+            return cursor.lastrowid
+
+    def append_many(self, kind, records):
+        """
+        Stores records in a single transaction.
+
+        :return: The ids of the stored records, in order
+        """
+        payloads = [json.dumps(record, default=str) for record in records]
+        created = time.time()
+        with self.lock:
+            ids = [self.connection.execute(
+                'INSERT INTO records (kind, created, payload, acknowledged) VALUES (?, ?, ?, 0)',
+                (kind, created, payload)).lastrowid for payload in payloads]
+            self.connection.commit()
+            return ids
+
+    def acknowledge(self, ids):
+        """
+        Marks records as delivered to the API.
+        """
+        if not ids:
+            return
+        with self.lock:
+            self.connection.executemany('UPDATE records SET acknowledged = 1 WHERE id = ?', [(i,) for i in ids])
+            self.connection.commit()
+
+    def pending(self, kind, limit=500, exclude=()):
+        """
+        Oldest records of `kind` that haven't been acknowledged yet.
+
+        :param exclude: Ids to skip, i.e. the records already queued for delivery
+        :return: List of (id, record) pairs
+        """
+        exclude = set(exclude)
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, payload FROM records WHERE kind = ? AND acknowledged = 0 ORDER BY id LIMIT ?',
+                (kind, limit + len(exclude))).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows if row[0] not in exclude][:limit]
+
+    def pending_count(self, kind=None):
+        with self.lock:
+            if kind is None:
+                row = self.connection.execute('SELECT COUNT(*) FROM records WHERE acknowledged = 0').fetchone()
+            else:
+                row = self.connection.execute(
+                    'SELECT COUNT(*) FROM records WHERE kind = ? AND acknowledged = 0', (kind,)).fetchone()
+        return row[0]
+
+    def prune(self, max_age=30 * 24 * 3600):
+        """
+        Deletes acknowledged records older than `max_age` seconds to bound the size of the journal.
+
+        :return: Number of records deleted
+        """
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM records WHERE acknowledged = 1 AND created < ?',
+                                             (time.time() - max_age,))
+            self.connection.commit()
+            return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
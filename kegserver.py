@@ -0,0 +1,511 @@
+"""
+Runs every sensor of the keg server from one process, configured by a JSON file:
+
+    python kegserver.py [kegserver.json]
+
+Only the subsystems present in the config are imported and started, and the taps come first so pours are
+captured as soon as possible after boot. Everything needing the network connects in the background.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+STARTED = time.time()
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kegserver.json')
+
+
+def load_config(path=DEFAULT_CONFIG):
+    with open(path) as f:
+        return json.load(f)
+
+
+class KegServer(object):
+    """
+    Starts and stops the taps, temperature probes, scales and relays described by a config dictionary.
+    See `kegserver.example.json` for the available keys.
+
+    Parameters
+    ----------
+    config: Dictionary
+        The parsed configuration.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API. Defaults to `gpio_backend.get_gpio()`.
+    """
+    def __init__(self, config, gpio=None):
+        self.config = config
+        self.gpio = gpio
+        self.journal = None
+        self.taps = None
+        self.probes = None
+        self.scales = []
+        self.stream = None
+        self.progress = None
+        self.timeseries = None
+        self.ledger = None
+        self.sampler = None
+        self.trace = None
+        # (scale config, function returning its settled weight or None) of every scale
+        self.weighers = []
+        self.threads = []
+
+    def start(self):
+        from gpio_backend import get_gpio
+
+        if self.gpio is None:
+            self.gpio = get_gpio(self.config.get('gpio'))
+        # Forked before any other thread or connection exists. The expanders are sampled by it too.
+        if self.config.get('sampler'):
+            self.start_sampler()
+        elif self.config.get('expanders'):
+            self.start_expanders()
+        # Wraps whichever backend the pulses come through, so the edges keep their timestamps
+        if self.config.get('trace'):
+            self.start_trace()
+
+        if self.config.get('journal', True):
+            from journal import Journal
+
+            path = self.config.get('journal_path') or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                   'keg-journal.db')
+            self.journal = Journal(path)
+            self.spawn(prune_journal, 'journal-prune', self.journal,
+                       self.config.get('journal_max_age', 30 * 24 * 3600))
+
+        if self.config.get('timeseries'):
+            self.start_timeseries()
+        if self.config.get('ledger'):
+            self.start_ledger()
+
+        # Cheap to start, and the sensors publish to it from their first event
+        if self.config.get('stream'):
+            self.start_stream()
+
+        if self.config.get('taps'):
+            self.start_taps()
+            logging.info("\n\tready to pour %.2f seconds after startup" % (time.time() - STARTED))
+
+        if self.config.get('relays'):
+            self.start_relays()
+        if self.config.get('probes'):
+            self.start_probes()
+        if self.config.get('scales'):
+            self.start_scales()
+        if self.ledger is not None and any('keg' in scale for scale in self.config.get('scales', [])):
+            self.spawn(reconcile_kegs, 'ledger-reconcile', self.ledger, self.weighers, self.taps,
+                       self.config['ledger'].get('reconcile_interval', 300.0))
+        if self.config.get('metrics'):
+            self.start_metrics()
+
+        # Load what's left of the heavy dependencies while the sensors are already running, instead of
+        # on the first pour or reading
+        self.spawn(warm_up, 'warm-up')
+        logging.info("\n\tstarted in %.2f seconds" % (time.time() - STARTED))
+
+    def spawn(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def start_taps(self):
+        from flowmeter import FlowMeter
+        from tap_manager import TapManager
+
+        # Live pour progress is on unless the config sets `progress` to false
+        config = self.config.get('progress', True)
+        if config:
+            from progress import ProgressEmitter
+
+            config = config if isinstance(config, dict) else {}
+            self.progress = ProgressEmitter(config.get('interval', 0.25), config.get('every_ounces'))
+            self.progress.start()
+
+        endpoint = self.config.get('endpoint')
+        local = self.config.get('local', True)
+        meters = [FlowMeter(tap['keg'], tap['pin'], local, gpio=self.gpio, kFactor=tap.get('k_factor', 450.0),
+                            journal=self.journal, endpoint=endpoint, debounce=tap.get('debounce', 0),
+                            stream=self.stream, progress=self.progress, ledger=self.ledger,
+                            wireFormat=self.config.get('wire', 'auto'))
+                  for tap in self.config['taps']]
+
+        self.taps = TapManager(meters, capture=self.config.get('capture', 'edge'), gpio=self.gpio)
+        self.taps.daemon = True
+        self.taps.start()
+
+    def start_relays(self):
+        """
+        Sets up every relay as an output and switches it off. The relay boards are active low.
+        """
+        gpio = self.gpio
+        gpio.setmode(gpio.BCM)
+        for relay in self.config['relays']:
+            gpio.setup(relay['pin'], gpio.OUT)
+            gpio.output(relay['pin'], gpio.HIGH)
+
+    def start_probes(self):
+        from TemperatureMonitor.TempMonitor import TempMonitor, scan_bus, target_host
+        from TemperatureMonitor.w1bus import W1BusScanner
+
+        probes = self.config['probes']
+        scanner = W1BusScanner(probes.get('basepath', '/sys/bus/w1/devices/'),
+                               resolution=probes.get('resolution'))
+        if self.trace is not None:
+            from sensor_trace import record_w1
+            record_w1(scanner, self.trace)
+
+        # The same API and credentials as the taps, the settings only without an endpoint in the config
+        endpoint = self.config.get('endpoint') or {}
+        delivery = None
+        post_data = probes.get('post', False)
+        if probes.get('bulk'):
+            from api_client import get_client
+            from TemperatureMonitor import settings
+            from TemperatureMonitor.batch import TemperatureBatcher
+
+            bulk = probes['bulk']
+            host = target_host(endpoint)
+            client = get_client('%s/api-auth-token/' % host, endpoint.get('user', settings.USER),
+                                endpoint.get('password', settings.PASSWORD))
+            url = '%s/temperatures/' % host if 'host' in endpoint else settings.BULK_URL
+            batcher = TemperatureBatcher(client, bulk.get('url', url),
+                                         window=bulk.get('window', settings.BULK_WINDOW),
+                                         max_readings=bulk.get('max_readings', settings.BULK_MAX_READINGS),
+                                         compress=bulk.get('compress', settings.BULK_COMPRESS),
+                                         journal=self.journal,
+                                         wire_format=self.config.get('wire', settings.BULK_WIRE))
+            delivery = batcher.delivery
+            post_data = True
+
+        self.probes = {}
+        for device in scanner.devices():
+            self.probes[os.path.basename(device)] = TempMonitor(device, probes['fan_pin'], post_data=post_data,
+                                                                delivery=delivery, journal=self.journal,
+                                                                gpio=self.gpio, stream=self.stream,
+                                                                timeseries=self.timeseries, endpoint=endpoint)
+
+        self.spawn(scan_bus, 'w1-scan', self.probes, scanner, probes.get('read_interval', 10))
+
+    def start_scales(self):
+        """
+        Scales sharing a clock pin are read together by a MultiHX711, a scale with a clock of its own
+        streams from an HX711. With a sampling process the scales are read there.
+        """
+        if self.sampler is not None:
+            scales = self.config['scales']
+            for index, scale in enumerate(scales):
+                self.weighers.append((scale, lambda index=index:
+                                      self.gpio.weight(index) if self.gpio.is_settled(index) else None))
+            if self.stream is not None or self.timeseries is not None:
+                self.spawn(publish_sampled_weights, 'sampled-weights', self.gpio,
+                           [scale_name(scale) for scale in scales], self.stream, scales[0].get('interval', 1.0),
+                           self.timeseries)
+            return
+
+        from hx711 import HX711TimeoutError
+
+        groups = {}
+        for scale in self.config['scales']:
+            groups.setdefault(scale['sck'], []).append(scale)
+
+        for sck, scales in sorted(groups.items()):
+            # A disconnected load cell times out while the gain is programmed, don't let it take the taps down
+            try:
+                self.start_scale_group(sck, scales)
+            except HX711TimeoutError as e:
+                logging.error("\n\tSkipping the scales on clock pin %s" % sck)
+                logging.error(e)
+
+    def start_scale_group(self, sck, scales):
+        """
+        Starts the scales sharing the clock pin `sck`.
+        """
+        if len(scales) == 1:
+            from hx711 import HX711
+            from weight_filter import WeightFilter
+
+            scale = scales[0]
+            hx = HX711(scale['dout'], sck, gain=scale.get('gain', 128), gpio=self.gpio)
+            self.record_scale(hx)
+            hx.set_reference_unit(scale.get('reference_unit', 1))
+            hx.set_offset(scale.get('offset', 0))
+            hx.start_stream(rate=scale.get('rate', 10), filter=WeightFilter())
+            self.scales.append(hx)
+            self.weighers.append((scale, lambda hx=hx: hx.get_filtered_weight() if hx.is_settled() else None))
+            if self.stream is not None or self.timeseries is not None:
+                self.spawn(publish_weight, 'hx711-%s' % scale['dout'], hx, scale_name(scale), self.stream,
+                           scale.get('interval', 1.0), self.timeseries)
+        else:
+            from hx711_multi import MultiHX711
+            from weight_filter import WeightFilter
+
+            multi = MultiHX711([scale['dout'] for scale in scales], sck,
+                               gains=[scale.get('gain', 128) for scale in scales], gpio=self.gpio,
+                               filters=[WeightFilter() for scale in scales])
+            self.record_scale(multi)
+            for index, scale in enumerate(scales):
+                multi.set_reference_unit(index, scale.get('reference_unit', 1))
+                multi.set_offset(index, scale.get('offset', 0))
+            self.scales.append(multi)
+            for index, scale in enumerate(scales):
+                self.weighers.append((scale, lambda multi=multi, index=index:
+                                      multi.get_filtered_weight(index) if multi.is_settled(index) else None))
+            self.spawn(poll_scales, 'hx711-sck-%s' % sck, multi, scales[0].get('interval', 1.0),
+                       [scale_name(scale) for scale in scales], self.stream, self.timeseries)
+
+    def start_sampler(self):
+        """
+        Moves the sampling of the taps and scales to a process of its own, and reads what it samples from
+        shared memory.
+        """
+        from sampler import SamplerProcess, SampledGPIO
+
+        config = self.config['sampler']
+        self.sampler = SamplerProcess([tap['pin'] for tap in self.config.get('taps', [])],
+                                      self.config.get('scales'), gpio=self.gpio,
+                                      expanders=self.config.get('expanders'),
+                                      capacity=config.get('capacity', 65536), nice=config.get('nice'))
+        self.sampler.start()
+        self.gpio = SampledGPIO(self.gpio, self.sampler, interval=config.get('interval', 0.005))
+        # Read the ring from now on, the weights come in even without taps
+        self.gpio.start()
+
+    def start_expanders(self):
+        """
+        Adds the pins of the MCP23017 expanders on the I2C bus to the GPIO backend, numbered from `base`, so
+        taps can use them like any other pin.
+        """
+        from gpio_mcp23017 import ExpanderGPIO, open_bus
+
+        config = self.config['expanders']
+        self.gpio = ExpanderGPIO(self.gpio, open_bus(config.get('bus', 1)), config.get('addresses', [0x20]),
+                                 interrupt=config.get('interrupt'), base=config.get('base', 100),
+                                 poll_interval=config.get('poll_interval', 0.05))
+
+    def start_trace(self):
+        """
+        Records the raw edges, hx711 conversions and one-wire readings into a new trace file in `directory`,
+        for `sensor_trace` to replay. The scales read by a sampling process aren't recorded.
+        """
+        from sensor_trace import TraceRecorder, RecordingGPIO
+
+        config = self.config['trace']
+        directory = config.get('directory') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, time.strftime('trace-%Y%m%d-%H%M%S.bin'))
+
+        # What replaying the pours needs to rebuild the flowmeters
+        taps = [dict((key, tap[key]) for key in ('keg', 'pin', 'k_factor', 'debounce') if key in tap)
+                for tap in self.config.get('taps', [])]
+        self.trace = TraceRecorder(path, info={'taps': taps}, max_bytes=config.get('max_bytes'))
+        self.gpio = RecordingGPIO(self.gpio, self.trace, pins=config.get('pins'))
+        logging.info("\n\trecording the sensors to %s" % path)
+
+    def record_scale(self, hx):
+        if self.trace is not None:
+            from sensor_trace import record_hx711
+            record_hx711(hx, self.trace)
+
+    def start_timeseries(self):
+        """
+        Opens the local store the temperature and weight readings are recorded in.
+        """
+        from timeseries import TimeSeriesStore, RAW_CAPACITY, MINUTE_CAPACITY, HOUR_CAPACITY
+
+        config = self.config['timeseries']
+        path = config.get('path') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timeseries')
+        self.timeseries = TimeSeriesStore(path, capacity=config.get('capacity', RAW_CAPACITY),
+                                          minute_capacity=config.get('minute_capacity', MINUTE_CAPACITY),
+                                          hour_capacity=config.get('hour_capacity', HOUR_CAPACITY))
+
+    def start_ledger(self):
+        """
+        Opens the keg inventory, taps the kegs it doesn't know yet as full and serves the levels on `port`.
+        """
+        from ledger import KegLedger, DEFAULT_CAPACITY
+
+        config = self.config['ledger']
+        path = config.get('path') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keg-ledger.db')
+        self.ledger = KegLedger(path, tolerance=config.get('tolerance', 8.0), settle=config.get('settle', 30.0))
+        for tap in self.config.get('taps', []):
+            self.ledger.ensure(tap['keg'], tap.get('capacity', DEFAULT_CAPACITY), tap.get('name'))
+        if config.get('port'):
+            self.ledger.serve(config['port'], config.get('host', '0.0.0.0'))
+
+    def start_stream(self):
+        """
+        Starts the event stream the displays on the LAN subscribe to.
+        """
+        from stream_server import PourStream
+
+        config = self.config['stream']
+        self.stream = PourStream(config.get('port', 8081), config.get('host', '0.0.0.0'),
+                                 buffer_size=config.get('buffer_size', 256))
+        self.stream.start()
+
+    def start_metrics(self):
+        """
+        Serves the metrics over HTTP on `port`, and dumps them to `file` every `interval` seconds if set.
+        """
+        import metrics
+
+        config = self.config['metrics']
+        if config.get('port'):
+            metrics.serve(config['port'], config.get('host', '127.0.0.1'))
+        if config.get('file'):
+            metrics.start_dump(config['file'], config.get('interval', 15))
+
+    def stop(self):
+        if self.taps is not None:
+            self.taps.stop()
+        if self.progress is not None:
+            self.progress.stop()
+        for scale in self.scales:
+            if hasattr(scale, 'stop_stream'):
+                scale.stop_stream()
+        if self.stream is not None:
+            self.stream.stop()
+        if self.timeseries is not None:
+            self.timeseries.flush()
+        if self.ledger is not None:
+            self.ledger.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.sampler is not None:
+            self.gpio.stop()
+            self.sampler.stop()
+        if self.trace is not None:
+            self.trace.close()
+
+
+def scale_name(scale):
+    return scale.get('name') or 'dout-%s' % scale['dout']
+
+
+def poll_scales(multi, interval=1.0, names=None, stream=None, timeseries=None):
+    """
+    Feeds the filter of every cell of `multi` with one sweep every `interval` seconds, publishing every
+    filtered weight to `stream` and recording it in `timeseries` if given.
+    """
+    while True:
+        try:
+            multi.update()
+        except Exception as e:
+            logging.error("\n\tCould not read the scales on pin %s" % multi.PD_SCK)
+            logging.error(e)
+        else:
+            now = time.time()
+            for index, name in enumerate(names):
+                weight = multi.get_filtered_weight(index)
+                if weight is None:
+                    continue
+                if stream is not None:
+                    stream.publish('weight', {'scale': name, 'weight': weight, 'settled': multi.is_settled(index),
+                                              'time': now})
+                if timeseries is not None:
+                    timeseries.append(name, weight, now)
+        time.sleep(interval)
+
+
+def publish_weight(hx, name, stream, interval=1.0, timeseries=None):
+    """
+    Publishes the filtered weight of a streaming HX711 to `stream` and records it in `timeseries` every
+    `interval` seconds.
+    """
+    while True:
+        weight = hx.get_filtered_weight()
+        if weight is not None:
+            now = time.time()
+            if stream is not None:
+                stream.publish('weight', {'scale': name, 'weight': weight, 'settled': hx.is_settled(),
+                                          'time': now})
+            if timeseries is not None:
+                timeseries.append(name, weight, now)
+        time.sleep(interval)
+
+
+def publish_sampled_weights(sampled, names, stream=None, interval=1.0, timeseries=None):
+    """
+    Publishes the weights read by the sampling process to `stream` and records them in `timeseries` as
+    they come in, checking every `interval` seconds.
+    """
+    published = {}
+    while True:
+        for index, name in enumerate(names):
+            reading = sampled.weights.get(index)
+            if reading is None or published.get(index) == reading[0]:
+                continue
+            published[index] = reading[0]
+            if stream is not None:
+                stream.publish('weight', {'scale': name, 'weight': reading[1], 'settled': reading[2],
+                                          'time': reading[0]})
+            if timeseries is not None:
+                timeseries.append(name, reading[1], reading[0])
+        time.sleep(interval)
+
+
+def reconcile_kegs(ledger, weighers, taps=None, interval=300.0):
+    """
+    Corrects the ledger of every keg standing on a scale with its weighed volume every `interval` seconds,
+    skipping the kegs being poured from.
+
+    :param weighers: List of (scale config, function returning its weight or None) pairs. The config gives
+        the `keg` on the scale, the `empty_weight` of the keg and the `weight_per_ounce` of the beer.
+    """
+    from ledger import GRAMS_PER_OUNCE
+
+    while True:
+        time.sleep(interval)
+        pouring = set(tap.meter.kegId for tap in taps.taps if tap.meter.pour.pouring) if taps is not None else ()
+        for scale, read in weighers:
+            if 'keg' not in scale or scale['keg'] in pouring:
+                continue
+            weight = read()
+            if weight is None:
+                continue
+            ounces = (weight - scale.get('empty_weight', 0)) / float(scale.get('weight_per_ounce', GRAMS_PER_OUNCE))
+            ledger.reconcile(scale['keg'], ounces)
+
+
+def prune_journal(journal, max_age, interval=3600.0):
+    """
+    Deletes the acknowledged journal records older than `max_age` seconds every `interval` seconds, so the
+    journal of the readings that are never posted doesn't fill the SD card.
+    """
+    while True:
+        try:
+            deleted = journal.prune(max_age)
+            if deleted:
+                logging.info("\n\tpruned %s acknowledged records from the journal" % deleted)
+        except Exception as e:
+            logging.error(e)
+        time.sleep(interval)
+
+
+def warm_up():
+    for name in ('numpy', 'requests', 'socketIO_client'):
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    server = KegServer(load_config(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CONFIG))
+    try:
+        server.start()
+        while True:
+            time.sleep(60)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception as e:
+        print e
+    finally:
+        server.stop()
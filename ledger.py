@@ -0,0 +1,393 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+REMAINING = metrics.gauge('keg_remaining_ounces', 'Ounces left in the keg according to the ledger', ['keg'])
+
+# A US half barrel
+DEFAULT_CAPACITY = 1984.0
+# Weight of a fluid ounce of beer, a little denser than water
+GRAMS_PER_OUNCE = 29.87
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kegs (
+    keg_id INTEGER PRIMARY KEY,
+    name TEXT,
+    capacity REAL NOT NULL,
+    remaining REAL NOT NULL,
+    tapped REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    keg_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    volume REAL NOT NULL,
+    remaining REAL NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS entries_keg ON entries (keg_id, kind, time);
+CREATE INDEX IF NOT EXISTS entries_time ON entries (kind, time);
+"""
+
+
+class KegLedger(object):
+    """
+    Local inventory of the kegs on tap: how much each one held when it was tapped, every pour taken from
+    it and how much is left, kept in SQLite next to the journal.
+
+    The remaining volume of every keg is also kept in memory and reloaded from its row with each pour or
+    correction, so `remaining` and `levels` never touch the database. Every change is written as an entry of the ledger (`tap`, `pour` or
+    `reconcile`), indexed by keg and by time, so the pours of a keg or of a time range are found without
+    scanning the whole history.
+
+    Pours from the taps are handed over with `put` and written by the ledger thread, so the tap sampling
+    thread never waits on SQLite or on an HTTP query holding the lock.
+
+    Parameters
+    ----------
+    path<optional>: String
+        Location of the SQLite database file.
+    tolerance<optional>: Float
+        Ounces the weighed volume of a keg has to differ by from the ledger before `reconcile` corrects it.
+    settle<optional>: Float
+        Seconds after a pour during which a keg isn't reconciled, while its scale settles.
+    """
+    def __init__(self, path='keg-ledger.db', tolerance=8.0, settle=30.0):
+        self.path = path
+        self.tolerance = tolerance
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        # keg id -> dictionary of the kegs row, the source of every lookup
+        self.kegs = {}
+        self.last_pour = {}
+        rows = self.connection.execute('SELECT keg_id, name, capacity, remaining, tapped, updated FROM kegs')
+        for row in rows.fetchall():
+            self.load(*row)
+
+        # (pour dictionary, callback) pairs waiting for the ledger thread, None to stop it
+        self.pours = deque()
+        self.condition = threading.Condition()
+        self.writer = None
+
+    def load(self, keg_id, name, capacity, remaining, tapped, updated):
+        keg = self.kegs[keg_id] = {'kegid': keg_id, 'name': name, 'capacity': capacity, 'remaining': remaining,
+                                   'tapped': tapped, 'updated': updated}
+        REMAINING.labels(keg_id).bind(lambda: keg['remaining'])
+        return keg
+
+    def tap(self, keg_id, capacity=DEFAULT_CAPACITY, name=None):
+        """
+        Records a new, full keg on `keg_id`, replacing the previous one.
+
+        :param capacity: Ounces in the full keg
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO kegs (keg_id, name, capacity, remaining, tapped, '
+                                    'updated) VALUES (?, ?, ?, ?, ?, ?)', (keg_id, name, capacity, capacity, now, now))
+            self.add_entry(keg_id, 'tap', now, capacity, capacity)
+            self.connection.commit()
+            self.load(keg_id, name, capacity, capacity, now, now)
+        logging.info("\n\ttapped keg %s with %.1f oz" % (keg_id, capacity))
+
+    def ensure(self, keg_id, capacity=DEFAULT_CAPACITY, name=None):
+        """
+        Taps `keg_id` as a full keg unless the ledger already knows it.
+        """
+        if keg_id not in self.kegs:
+            self.tap(keg_id, capacity, name)
+
+    def record_pour(self, pour_data):
+        """
+        Takes a finished pour off the remaining volume of its keg. The volume is subtracted from the row in
+        the database, not from the copy in memory, so a keg tapped by `python ledger.py tap` from another
+        process isn't overwritten.
+
+        :param pour_data: Pour dictionary with the keg id, volume in ounces and duration in seconds
+        :return: Ounces left in the keg
+        """
+        keg_id = pour_data['kegid']
+        volume = pour_data['volume']
+        now = time.time()
+
+        with self.lock:
+            if self.connection.execute('UPDATE kegs SET remaining = remaining - ?, updated = ? WHERE keg_id = ?',
+                                       (volume, now, keg_id)).rowcount:
+                keg = self.refresh(keg_id)
+                self.add_entry(keg_id, 'pour', now, -volume, keg['remaining'], pour_data.get('duration'))
+                self.connection.commit()
+                self.last_pour[keg_id] = now
+                return keg['remaining']
+
+        # A keg the ledger doesn't know yet starts full
+        self.tap(keg_id)
+        return self.record_pour(pour_data)
+
+    def refresh(self, keg_id):
+        """
+        Reloads a keg from its row, which another process may have changed. Called with the lock held.
+
+        :return: The keg dictionary, None if it isn't in the database
+        """
+        row = self.connection.execute('SELECT keg_id, name, capacity, remaining, tapped, updated FROM kegs '
+                                      'WHERE keg_id = ?', (keg_id,)).fetchone()
+        if row is None:
+            return None
+        keg = self.kegs.get(keg_id)
+        if keg is None:
+            return self.load(*row)
+        keg.update(name=row[1], capacity=row[2], remaining=row[3], tapped=row[4], updated=row[5])
+        return keg
+
+    def put(self, pour_data, recorded=None):
+        """
+        Queues a finished pour for `record_pour` on the ledger thread, without blocking.
+
+        :param recorded: Called on the ledger thread with the `level` of the keg once the pour is recorded
+        """
+        with self.condition:
+            self.pours.append((pour_data, recorded))
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_pours, name='ledger')
+                self.writer.daemon = True
+                self.writer.start()
+            self.condition.notify()
+
+    def write_pours(self):
+        while True:
+            with self.condition:
+                while not self.pours:
+                    self.condition.wait()
+                item = self.pours.popleft()
+            if item is None:
+                return
+
+            pour_data, recorded = item
+            try:
+                self.record_pour(pour_data)
+                if recorded is not None:
+                    recorded(self.level(pour_data['kegid']))
+            except Exception as e:
+                logging.error("\n\tCould not record the pour of keg %s in the ledger" % pour_data.get('kegid'))
+                logging.error(e)
+
+    def reconcile(self, keg_id, ounces):
+        """
+        Corrects the remaining volume of a keg with the volume weighed by its scale, when they differ by
+        more than `tolerance` ounces and the keg hasn't been poured from for `settle` seconds.
+
+        :return: True if the ledger was corrected
+        """
+        now = time.time()
+        if now - self.last_pour.get(keg_id, 0) < self.settle:
+            return False
+
+        with self.lock:
+            # compared with the row, the keg may have been tapped from another process
+            keg = self.refresh(keg_id)
+            if keg is None:
+                return False
+            difference = ounces - keg['remaining']
+            if abs(difference) <= self.tolerance:
+                return False
+
+            self.connection.execute('UPDATE kegs SET remaining = ?, updated = ? WHERE keg_id = ?',
+                                    (ounces, now, keg_id))
+            self.add_entry(keg_id, 'reconcile', now, difference, ounces)
+            self.connection.commit()
+            keg['remaining'] = ounces
+            keg['updated'] = now
+        logging.info("\n\tkeg %s corrected by %.1f oz from its scale" % (keg_id, difference))
+        return True
+
+    def add_entry(self, keg_id, kind, when, volume, remaining, duration=None):
+        # Called with the lock held, committed by the caller
+        self.connection.execute('INSERT INTO entries (keg_id, kind, time, volume, remaining, duration) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (keg_id, kind, when, volume, remaining, duration))
+
+    def remaining(self, keg_id):
+        """
+        Ounces left in the keg, None for a keg the ledger doesn't know. A dictionary lookup.
+        """
+        keg = self.kegs.get(keg_id)
+        return keg['remaining'] if keg is not None else None
+
+    def level(self, keg_id):
+        keg = self.kegs.get(keg_id)
+        if keg is None:
+            return None
+        level = dict(keg)
+        level['fraction'] = max(keg['remaining'], 0.0) / keg['capacity'] if keg['capacity'] else 0.0
+        return level
+
+    def levels(self):
+        """
+        The level of every keg, without touching the database.
+        """
+        return [self.level(keg_id) for keg_id in sorted(self.kegs)]
+
+    def history(self, keg_id=None, start=None, end=None, kind='pour', limit=1000):
+        """
+        Ledger entries with `start <= time < end`, newest first, from the keg or time index.
+
+        :param keg_id: Only the entries of this keg, all kegs by default
+        :param kind: `pour`, `tap`, `reconcile`, or None for every kind
+        :return: List of dictionaries
+        """
+        where = []
+        args = []
+        if keg_id is not None:
+            where.append('keg_id = ?')
+            args.append(keg_id)
+        if kind is not None:
+            where.append('kind = ?')
+            args.append(kind)
+        if start is not None:
+            where.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('time < ?')
+            args.append(end)
+        query = 'SELECT keg_id, kind, time, volume, remaining, duration FROM entries'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY time DESC LIMIT ?'
+        args.append(limit)
+
+        with self.lock:
+            rows = self.connection.execute(query, args).fetchall()
+        return [{'kegid': row[0], 'kind': row[1], 'time': row[2], 'volume': row[3], 'remaining': row[4],
+                 'duration': row[5]} for row in rows]
+
+    def poured(self, keg_id=None, start=None, end=None):
+        """
+        Total ounces poured, from the keg or time index.
+        """
+        where = ["kind = 'pour'"]
+        args = []
+        if keg_id is not None:
+            where.append('keg_id = ?')
+            args.append(keg_id)
+        if start is not None:
+            where.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('time < ?')
+            args.append(end)
+        with self.lock:
+            row = self.connection.execute('SELECT -SUM(volume) FROM entries WHERE ' + ' AND '.join(where),
+                                          args).fetchone()
+        return row[0] or 0.0
+
+    def serve(self, port=8082, host='0.0.0.0'):
+        """
+        Serves the keg levels and pour history as JSON from a daemon thread, for tap lists and displays on
+        the LAN:
+
+            GET /kegs                                   the level of every keg
+            GET /kegs/<id>                              the level of one keg
+            GET /kegs/<id>/pours?start=<t>&end=<t>      its pours, times in seconds since the epoch
+            GET /pours?start=<t>&end=<t>                the pours of every keg
+
+        :return: The HTTP server, `shutdown()` stops it
+        """
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+            from urlparse import urlparse, parse_qs
+        except ImportError:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+            from urllib.parse import urlparse, parse_qs
+
+        ledger = self
+
+        class LedgerHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+                parts = [part for part in url.path.split('/') if part]
+                try:
+                    start = float(query['start']) if 'start' in query else None
+                    end = float(query['end']) if 'end' in query else None
+                    limit = int(query.get('limit', 1000))
+                    keg_id = int(parts[1]) if len(parts) > 1 else None
+                except ValueError:
+                    self.send_error(400)
+                    return
+
+                if parts == ['kegs']:
+                    body = ledger.levels()
+                elif len(parts) == 2 and parts[0] == 'kegs':
+                    body = ledger.level(keg_id)
+                elif len(parts) == 3 and parts[0] == 'kegs' and parts[2] == 'pours':
+                    body = ledger.history(keg_id, start, end, limit=limit)
+                elif parts == ['pours']:
+                    body = ledger.history(None, start, end, limit=limit)
+                else:
+                    body = None
+                if body is None:
+                    self.send_error(404)
+                    return
+
+                data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        class LedgerServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        server = LedgerServer((host, port), LedgerHandler)
+        thread = threading.Thread(target=server.serve_forever, name='ledger-http')
+        thread.daemon = True
+        thread.start()
+        logging.info("\n\tserving keg levels on http://%s:%s/kegs" % (host, server.server_address[1]))
+        return server
+
+    def close(self, timeout=5.0):
+        """
+        Writes the pours still queued, then closes the database.
+        """
+        with self.condition:
+            writer = self.writer
+            if writer is not None:
+                self.pours.append(None)
+                self.condition.notify()
+        if writer is not None:
+            writer.join(timeout)
+        with self.lock:
+            self.connection.close()
+
+
+if __name__ == '__main__':
+    # python ledger.py tap <keg id> [ounces] [name]    records a new keg on a tap
+    # python ledger.py                                 prints the level of every keg
+    ledger = KegLedger(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keg-ledger.db'))
+    if len(sys.argv) > 2 and sys.argv[1] == 'tap':
+        ledger.tap(int(sys.argv[2]), float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_CAPACITY,
+                   sys.argv[4] if len(sys.argv) > 4 else None)
+    for level in ledger.levels():
+        print('keg %(kegid)s: %(remaining).1f of %(capacity).1f oz' % level)
+    ledger.close()
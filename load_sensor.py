@@ -1,7 +1,11 @@
-import RPi.GPIO as gpio
+import os
 import time
 import sys
 
+from gpio_backend import get_gpio
+from timeseries import TimeSeriesStore
+from weight_filter import WeightFilter
+
 # from hx711 import HX711
 
 # Hx711 signal pins
@@ -70,29 +74,47 @@ print "Starting up"
 #         cleanAndExit()
 
 
+gpio = get_gpio()
+
 HIGH = 1
 LOW = 0
 val = 0
+
+# Milliseconds to wait for the hx711 to signal data ready before giving up on a sample
+TIMEOUT = 1000
+# Timeouts in a row after which the hx711 is power cycled
+MAX_TIMEOUTS = 3
+
 gpio.setwarnings(False)
 gpio.setmode(gpio.BCM)
 gpio.setup(SCK, gpio.OUT)
+gpio.setup(DT, gpio.IN)
+
+
+def waitReady():
+    """
+    Waits for the falling edge of DT that signals data ready, raising IOError after TIMEOUT milliseconds.
+    """
+    if gpio.input(DT) == 0:
+        return
+    gpio.wait_for_edge(DT, gpio.FALLING, timeout=TIMEOUT)
+    # DT stays low until read, so the edge may have come before we started waiting
+    if gpio.input(DT) == 1:
+        raise IOError("hx711 did not signal data ready within {0} ms, check the load cell".format(TIMEOUT))
+
+
+def powerCycle():
+    # Holding SCK high for more than 60 microseconds powers the hx711 down
+    gpio.output(SCK, 1)
+    time.sleep(0.0001)
+    gpio.output(SCK, 0)
 
 
 def readCount():
 
     Count = 0
-    # print Count
-    # time.sleep(0.001)
-    gpio.setup(DT, gpio.OUT)
-    gpio.output(DT, 1)
     gpio.output(SCK, 0)
-    gpio.setup(DT, gpio.IN)
-    waiting_time = 0
-    while gpio.input(DT) == 1:
-        print "waiting {0} secs".format(waiting_time)
-        i = 0
-        waiting_time += 1
-        time.sleep(1)
+    waitReady()
     for i in range(24):
         gpio.output(SCK, 1)
         Count = Count << 1
@@ -110,12 +132,39 @@ def readCount():
 
 
 time.sleep(3)
-sample = readCount()
 flag = 0
+timeouts = 0
+# The first reading is the zero, wait for the load cell instead of dying on a timeout
+sample = None
+while sample is None:
+    try:
+        sample = readCount()
+    except IOError as e:
+        print e
+        timeouts += 1
+        if timeouts >= MAX_TIMEOUTS:
+            powerCycle()
+            timeouts = 0
+timeouts = 0
+# Rejects spikes and smooths the raw counts so the printed weight doesn't jump around
+weight_filter = WeightFilter()
+# Every weight is kept locally, with minute and hour rollups, instead of only being printed
+store = TimeSeriesStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timeseries'))
 
 while 1:
-    count = readCount()
+    try:
+        count = readCount()
+    except IOError as e:
+        print e
+        timeouts += 1
+        if timeouts >= MAX_TIMEOUTS:
+            powerCycle()
+            timeouts = 0
+        continue
+    timeouts = 0
+    count = weight_filter.add(count)
     w = (count - sample) / 106  # is this the calibration value?
     w = w / 453.592  # grams to lbs
-    print w, "lbs"
+    print w, "lbs", "(settled)" if weight_filter.settled else ""
+    store.append('load-sensor', w)
     time.sleep(0.175)
@@ -0,0 +1,371 @@
+"""
+Counters, gauges and histograms for the running daemon, exposed in the Prometheus text format over a local
+HTTP port and optionally dumped to a file:
+
+    metrics.serve(9105)
+    metrics.start_dump('/var/lib/node_exporter/keg-server.prom')
+
+Updating a metric is a plain attribute increment with no lock, cheap enough for the sampling loops. Each
+labeled value is meant to be written by one thread; concurrent writers may very rarely lose an update.
+Counts already kept by an object can be exposed without touching its hot path at all by binding a function
+that reads them when the metrics are rendered.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast GPIO read up to a slow HTTP request
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+
+class Value(object):
+    """
+    The value of a metric for one set of label values. `bind` makes it read `function()` when rendered
+    instead of keeping a value of its own, or `function(exporter)` for a `Rate`.
+    """
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def bind(self, function):
+        self.function = function
+        return self
+
+    def get(self, exporter=None):
+        function = self.function
+        if function is None:
+            return self.value
+        if isinstance(function, Rate):
+            return function(exporter)
+        return function()
+
+
+class HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf, made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """
+        Context manager observing the seconds its block took.
+        """
+        return Timer(self)
+
+
+class Timer(object):
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started)
+
+
+class Metric(object):
+    """
+    A named metric with a value per set of label values.
+
+    Parameters
+    ----------
+    name: String
+    help: String
+    labelnames<optional>: List of String
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        # Metrics without labels have a single value the metric itself forwards to
+        self.default = None if self.labelnames else self.labels()
+
+    def make_value(self):
+        return Value()
+
+    def labels(self, *values):
+        """
+        The value for these label values, created on first use. Look it up once, outside of the hot loop.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s takes the labels %s" % (self.name, ', '.join(self.labelnames)))
+        key = tuple(str(value) for value in values)
+        value = self.values.get(key)
+        if value is None:
+            with self.lock:
+                value = self.values.setdefault(key, self.make_value())
+        return value
+
+    def remove(self, *values):
+        with self.lock:
+            self.values.pop(tuple(str(value) for value in values), None)
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def set(self, value):
+        self.default.set(value)
+
+    def bind(self, function):
+        return self.default.bind(function)
+
+    def header(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+
+    def render(self, lines, exporter=None):
+        self.header(lines)
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            try:
+                sample = value.get(exporter)
+            except Exception as e:
+                logging.error("\n\tCould not read metric %s: %s" % (self.name, e))
+                continue
+            lines.append('%s%s %s' % (self.name, format_labels(self.labelnames, key), format_value(sample)))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self.default.dec(amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labelnames)
+
+    def make_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def time(self):
+        return self.default.time()
+
+    def render(self, lines, exporter=None):
+        self.header(lines)
+        names = self.labelnames + ('le',)
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            counts = list(value.counts)
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(names, key + (format_value(bound),)),
+                                                 total))
+            labels = format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(value.sum)))
+            lines.append('%s_count%s %d' % (self.name, labels, total))
+
+
+class Registry(object):
+    """
+    The metrics of the process. Asking twice for the same name returns the same metric, so every
+    instance of a sensor class shares it with its own label values.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labelnames=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError("Metric %s already exists with another type or labels" % name)
+            return metric
+
+    def render(self, exporter=None):
+        """
+        The metrics in the Prometheus text format.
+
+        :param exporter: Name of the exporter asking, every exporter gets rates over the time since its own
+            previous render
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            metric.render(lines, exporter)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=(), registry=REGISTRY):
+    return registry.get(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=(), registry=REGISTRY):
+    return registry.get(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+    return registry.get(Histogram, name, help, labelnames, buckets=buckets)
+
+
+class Rate(object):
+    """
+    The change per second of a growing count since the previous render by the same exporter, so a scrape
+    doesn't shorten the interval the file dump measures over and the other way around. See `rate_of`.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.lock = threading.Lock()
+        self.created = (time.time(), function())
+        # exporter -> (time, count) of its previous render
+        self.last = {}
+
+    def __call__(self, exporter=None):
+        now, count = time.time(), self.function()
+        with self.lock:
+            then, previous = self.last.get(exporter, self.created)
+            elapsed = now - then
+            if elapsed <= 0:
+                return 0.0
+            self.last[exporter] = (now, count)
+        return (count - previous) / elapsed
+
+
+def rate_of(function):
+    """
+    Wraps a function returning a growing count into a `Rate`, its change per second since the previous
+    render, for gauges like loop iterations per second.
+    """
+    return Rate(function)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    return '{%s}' % ','.join(pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def serve(port=9105, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread. Binds to localhost by default,
+    the scraper is expected to run on the Pi or reach it through a tunnel.
+
+    :return: The HTTP server, `shutdown()` stops it
+    """
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render('http').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the log
+            pass
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logging.info("\n\tserving metrics on http://%s:%s/metrics" % (host, server.server_address[1]))
+    return server
+
+
+def dump(path, registry=REGISTRY):
+    """
+    Writes the metrics to `path` atomically, in the format of the node exporter textfile collector.
+    """
+    temporary = '%s.%s.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(registry.render('dump:%s' % path))
+    os.rename(temporary, path)
+
+
+def start_dump(path, interval=15.0, registry=REGISTRY):
+    """
+    Dumps the metrics to `path` every `interval` seconds from a daemon thread.
+    """
+    def run():
+        while True:
+            try:
+                dump(path, registry)
+            except Exception as e:
+                logging.error("\n\tCould not write the metrics to %s" % path)
+                logging.error(e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='metrics-dump')
+    thread.daemon = True
+    thread.start()
+    return thread
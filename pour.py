@@ -0,0 +1,184 @@
+import array
+from datetime import datetime
+import pytz
+
+TIMEZONE = pytz.timezone('America/Los_Angeles')
+
+OUNCES_PER_LITER = 33.814
+
+
+class PourState(object):
+    """
+    Compact per-tap pour state. All the bookkeeping needed to turn flowmeter pulses into pours lives
+    here so a single sampler can keep one of these per tap instead of one thread per tap.
+
+    Every pulse timestamp is stored in a preallocated ring buffer, which is all the per-pulse work there
+    is. Volume comes straight from the pulse count and the K-factor of the meter, the flow rate from the
+    two ends of its window of timestamps, while the pour duration is computed over the buffered timestamps
+    in vectorized batches, when the buffer fills up and when the pour ends. numpy is only imported for those
+    batches, so creating taps doesn't pay for it at startup.
+
+    Parameters
+    ----------
+    kegId: Integer
+        The id of the keg the pulses belong to.
+    kFactor<optional>: Float
+        Pulses per liter of the flowmeter. 450 is the rating of the common YF-S201 hall effect meters.
+    pourTimeout<optional>: Integer
+        Milliseconds without a pulse after which the pour is considered finished.
+    maxGap<optional>: Integer
+        Gaps between pulses longer than this many milliseconds don't count towards the pour duration.
+    minOunces<optional>: Float
+        Pours smaller than this are discarded as false positives.
+    capacity<optional>: Integer
+        Number of pulse timestamps the ring buffer holds.
+    """
+    __slots__ = ('kegId', 'kFactor', 'pourTimeout', 'maxGap', 'minOunces', 'pouring', 'startTime',
+                 'pourStart', 'lastPinChange', 'pulses', 'capacity', 'times', 'timesView', 'index',
+                 'foldedDuration', 'foldedLast')
+
+    def __init__(self, kegId, kFactor=450.0, pourTimeout=3000, maxGap=1000, minOunces=0.2, capacity=4096):
+        self.kegId = kegId
+        self.kFactor = float(kFactor)
+        self.pourTimeout = pourTimeout
+        self.maxGap = maxGap
+        self.minOunces = minOunces
+
+        self.pouring = False
+        self.startTime = 0
+        self.pourStart = None
+        self.lastPinChange = 0
+        self.pulses = 0
+
+        # The array owns the memory so single stores stay cheap, numpy only gets a view of it
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.timesView = None
+        self.index = 0
+
+        # Duration already accumulated from timestamps that were flushed out of the ring buffer
+        self.foldedDuration = 0.0
+        self.foldedLast = None
+
+    def pulse(self, currentTime):
+        """
+        Adds a single pulse to the current pour, starting a new pour if needed.
+
+        :param currentTime: Time of the rising edge in milliseconds on the monotonic clock
+        :return: True if this pulse started a new pour
+        """
+        started = False
+        if not self.pouring:
+            self.startTime = currentTime
+            self.pourStart = datetime.now(TIMEZONE)
+            self.pulses = 0
+            self.index = 0
+            self.foldedDuration = 0.0
+            self.foldedLast = None
+            self.pouring = True
+            started = True
+
+        self.times[self.index] = currentTime
+        self.index += 1
+        self.pulses += 1
+        self.lastPinChange = currentTime
+
+        if self.index == self.capacity:
+            self.fold()
+
+        return started
+
+    def expired(self, currentTime):
+        """
+        True when pouring and there hasn't been a change in the pin for `pourTimeout` milliseconds.
+        """
+        return self.pouring and (currentTime - self.lastPinChange) > self.pourTimeout
+
+    def volume(self):
+        """
+        Ounces poured so far in the current pour.
+        """
+        return self.pulses / self.kFactor * OUNCES_PER_LITER
+
+    def flowRate(self, window=32):
+        """
+        Flow rate in liters per minute over the last `window` pulses of the current pour. `fold` leaves the
+        timestamps in the ring buffer, so the window wraps around to the pulses from before the last fold.
+        """
+        count = min(window, self.pulses, self.capacity)
+        if count < 2:
+            return 0.0
+
+        end = self.index
+        elapsed = self.times[(end - 1) % self.capacity] - self.times[(end - count) % self.capacity]
+        if elapsed <= 0:
+            return 0.0
+        return (count - 1) / self.kFactor / (elapsed / 60000.0)
+
+    def duration(self):
+        """
+        Seconds the tap has been flowing in the current pour, ignoring gaps longer than `maxGap`.
+        """
+        return (self.foldedDuration + self.activeTime(self.view()[:self.index], self.foldedLast)) / 1000
+
+    def view(self):
+        """
+        numpy view of the ring buffer, sharing its memory.
+        """
+        if self.timesView is None:
+            import numpy
+            self.timesView = numpy.frombuffer(self.times, dtype=numpy.float64)
+        return self.timesView
+
+    def activeTime(self, times, previous=None):
+        """
+        Sums the gaps between consecutive timestamps that are short enough to count as flowing.
+
+        :param times: Numpy array of pulse timestamps in milliseconds
+        :param previous: Timestamp of the pulse preceding `times`, if any
+        """
+        import numpy
+
+        if previous is not None and len(times):
+            times = numpy.concatenate(([previous], times))
+        if len(times) < 2:
+            return 0.0
+
+        gaps = numpy.diff(times)
+        return float(gaps[(gaps > 0) & (gaps < self.maxGap)].sum())
+
+    def fold(self):
+        """
+        Accumulates the duration of the buffered timestamps and empties the ring buffer. The timestamps stay
+        in place until they're overwritten, for `flowRate`.
+        """
+        self.foldedDuration += self.activeTime(self.view()[:self.index], self.foldedLast)
+        if self.index:
+            self.foldedLast = self.times[self.index - 1]
+        self.index = 0
+
+    def finish(self):
+        """
+        Closes the current pour and resets the state for the next one.
+
+        :return: Dictionary with the keg id, volume in ounces, duration in seconds and the start/end
+            datetimes, or None when the pour was too small to be a real pour.
+        """
+        # set pouring back to false to set up for the next pour capture
+        self.pouring = False
+
+        pourTime = self.duration()
+        ouncesPoured = self.volume()
+
+        # when the flow meter gets jostled, the impeller can sometimes trip the pin state, creating a
+        # 'false positive' read. `minOunces` helps to capture only what are perceived to be legit pours.
+        if ouncesPoured <= self.minOunces:
+            return None
+
+        return {
+            'kegid': self.kegId,
+            'volume': ouncesPoured,
+            'pourstart': self.pourStart,
+            'pourend': datetime.now(TIMEZONE),
+            'duration': pourTime
+        }
@@ -0,0 +1,106 @@
+import logging
+import threading
+
+import metrics
+from pour import OUNCES_PER_LITER
+
+UPDATES = metrics.counter('keg_progress_updates_total', 'Live pour progress updates sent', ['keg'])
+COALESCED = metrics.counter('keg_progress_coalesced_total',
+                            'Live pour progress updates replaced by a newer one before being sent', ['keg'])
+
+
+class Progress(object):
+    """
+    Progress bookkeeping of one tap: when and at how many pulses the last update was triggered.
+    """
+    __slots__ = ('lastTime', 'lastPulses', 'updates', 'coalesced')
+
+    def __init__(self, kegId):
+        self.lastTime = 0
+        self.lastPulses = 0
+        self.updates = UPDATES.labels(kegId)
+        self.coalesced = COALESCED.labels(kegId)
+
+
+class ProgressEmitter(threading.Thread):
+    """
+    Sends the running volume and flow rate of every open tap to the displays, so they can show the glass
+    filling up instead of waiting for the end of the pour.
+
+    `pulse` is called by the flowmeters for every pulse. It only compares the pulse against the last update
+    and, when a new one is due, takes a snapshot of the pulses, volume and flow rate of the pour, marks the
+    tap as pending and wakes the emitter thread, so the capture path never waits on the network. The
+    emitter thread sends the snapshot and never reads the pour state while the sampling loop changes it.
+    When the link is slow the updates that piled up are coalesced into the most recent one.
+
+    Parameters
+    ----------
+    interval<optional>: Float
+        Seconds between two updates of a tap while it's pouring, the maximum update rate.
+    everyOunces<optional>: Float
+        Also send an update as soon as this many ounces were poured since the last one, if it comes
+        before `interval`. None only sends updates on the timer.
+    """
+    def __init__(self, interval=0.25, everyOunces=None):
+        super(ProgressEmitter, self).__init__(name='pour-progress')
+        self.daemon = True
+        self.interval = int(interval * 1000)
+        self.everyOunces = everyOunces
+
+        self.taps = {}
+        # kegId -> (meter, (pulses, volume, flow rate)), only ever holds the latest request per tap
+        self.pending = {}
+        self.event = threading.Event()
+        self.running = True
+
+    def pulse(self, meter, currentTime):
+        """
+        Called from the sampling loop for every pulse of `meter`. Cheap and never blocks.
+
+        :param currentTime: Time of the pulse in milliseconds
+        """
+        progress = self.taps.get(meter.kegId)
+        if progress is None:
+            progress = self.taps[meter.kegId] = Progress(meter.kegId)
+
+        pour = meter.pour
+        if pour.pulses == 1:
+            # A new pour, its first update comes after a full interval
+            progress.lastTime = currentTime
+            progress.lastPulses = 0
+            return
+
+        due = currentTime - progress.lastTime >= self.interval
+        if not due and self.everyOunces is not None:
+            due = (pour.pulses - progress.lastPulses) / pour.kFactor * OUNCES_PER_LITER >= self.everyOunces
+        if not due:
+            return
+
+        progress.lastTime = currentTime
+        progress.lastPulses = pour.pulses
+        if meter.kegId in self.pending:
+            progress.coalesced.inc()
+        self.pending[meter.kegId] = (meter, (pour.pulses, pour.volume(), pour.flowRate()))
+        self.event.set()
+
+    def run(self):
+        while self.running:
+            self.event.wait()
+            self.event.clear()
+
+            while self.pending:
+                kegId, (meter, (pulses, volume, flowRate)) = self.pending.popitem()
+                pour = meter.pour
+                # The pour ended while the update waited, the total has been sent instead
+                if not pour.pouring or pour.pulses < pulses:
+                    continue
+                try:
+                    meter.emitPourInterval(volume, flowRate)
+                except Exception as e:
+                    logging.error("\n\tCould not send the pour progress of keg %s" % kegId)
+                    logging.error(e)
+                self.taps[kegId].updates.inc()
+
+    def stop(self):
+        self.running = False
+        self.event.set()
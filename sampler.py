@@ -0,0 +1,405 @@
+"""
+Runs the GPIO sampling of the flowmeters and load cells in a process of its own, so nothing the rest of the
+keg server does (JSON, HTTP requests, the web socket, SQLite, logging) can hold the interpreter lock while a
+pulse comes in:
+
+    "sampler": {"capacity": 65536, "interval": 0.005, "nice": -10}
+
+The sampling process only timestamps pulses and reads the scales, and writes them as fixed-size records into a
+ring buffer in memory shared with the main process. It never blocks on the main process, and the main process
+reads the ring at its own pace: a pulse keeps the time it was captured at however late it's read. Both processes
+use the monotonic clock, which is system wide.
+
+In the main process `SampledGPIO` stands in for the GPIO backend: the pins of the taps get the pulses read from
+the ring as edge callbacks, so the `TapManager` and the flowmeters run unchanged, and every other pin goes to the
+native backend.
+"""
+import os
+import mmap
+import time
+import struct
+import signal
+import logging
+import threading
+import multiprocessing
+
+import metrics
+from gpio_backend import monotonic_ns
+
+DEPTH = metrics.gauge('keg_sampler_ring_depth', 'Records written by the sampling process not read yet')
+LOST = metrics.counter('keg_sampler_lost_total', 'Records overwritten before the main process read them')
+ALIVE = metrics.gauge('keg_sampler_alive', 'Whether the sampling process is running')
+
+PULSE = 1
+# filtered weight of a scale, and the same once its filter has settled
+WEIGHT = 2
+SETTLED_WEIGHT = 3
+# Scale reading intervals after which a scale that stopped answering has no weight anymore
+STALE_INTERVALS = 3
+
+MAGIC = b'KEGRING1'
+# magic, capacity, head
+HEADER = struct.Struct('=8sQQ')
+HEADER_SIZE = 64
+HEAD_OFFSET = 16
+HEAD = struct.Struct('=Q')
+# sequence number, kind, channel, timestamp in nanoseconds on the monotonic clock, value
+RECORD = struct.Struct('=QBxH4xqd')
+
+
+class SharedRing(object):
+    """
+    Ring buffer of records in a shared memory mapping, written by one process and read by another.
+
+    The writer fills a record, then its sequence number, then moves the head forward. The reader only takes
+    records whose sequence number is the one it expects, so it never sees one being written, and it detects
+    the records the writer went over before they were read. Neither side takes a lock shared with the other.
+
+    Parameters
+    ----------
+    capacity<optional>: Integer
+        Records kept before the oldest unread ones are overwritten.
+    path<optional>: String
+        File to map, i.e. under `/dev/shm`, for a reader that isn't forked from the writer. By default the
+        mapping is anonymous and shared with the processes forked after it was made.
+    """
+    def __init__(self, capacity=65536, path=None):
+        self.capacity = capacity
+        self.path = path
+        size = HEADER_SIZE + capacity * RECORD.size
+        if path is None:
+            self.map = mmap.mmap(-1, size)
+        else:
+            exists = os.path.exists(path)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                if not exists:
+                    os.ftruncate(fd, size)
+                elif os.fstat(fd).st_size != size:
+                    raise ValueError("%s is not a ring of %d records" % (path, capacity))
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        if self.map[:len(MAGIC)] != MAGIC:
+            HEADER.pack_into(self.map, 0, MAGIC, capacity, 0)
+        elif HEADER.unpack_from(self.map, 0)[1] != capacity:
+            raise ValueError("%s is not a ring of %d records" % (path, capacity))
+
+        # Only the writer moves the head, the reader keeps its tail to itself
+        self.head = HEAD.unpack_from(self.map, HEAD_OFFSET)[0]
+        self.tail = self.head
+        self.lock = threading.Lock()
+
+    def append(self, kind, channel, timestamp, value=0.0):
+        """
+        Writes a record. Safe to call from several threads of the writing process.
+        """
+        with self.lock:
+            head = self.head
+            offset = HEADER_SIZE + (head % self.capacity) * RECORD.size
+            RECORD.pack_into(self.map, offset, 0, kind, channel, timestamp, value)
+            HEAD.pack_into(self.map, offset, head + 1)
+            self.head = head + 1
+            HEAD.pack_into(self.map, HEAD_OFFSET, self.head)
+
+    def read(self, limit=4096):
+        """
+        Takes the records written since the last read.
+
+        :return: (list of (kind, channel, timestamp, value) tuples, number of records lost)
+        """
+        head = HEAD.unpack_from(self.map, HEAD_OFFSET)[0]
+        tail = self.tail
+        lost = 0
+        if head - tail > self.capacity:
+            lost = head - tail - self.capacity
+            tail = head - self.capacity
+
+        records = []
+        capacity = self.capacity
+        unpack = RECORD.unpack_from
+        while tail < head and len(records) < limit:
+            offset = HEADER_SIZE + (tail % capacity) * RECORD.size
+            record = unpack(self.map, offset)
+            sequence = record[0]
+            if sequence == tail + 1 and HEAD.unpack_from(self.map, offset)[0] == sequence:
+                records.append(record[1:])
+            elif sequence > tail + 1 or sequence == 0 and head - tail >= capacity:
+                # The writer went around the ring over this one while we were reading
+                lost += 1
+            else:
+                # Not finished yet, it's there next time
+                break
+            tail += 1
+        self.tail = tail
+        return records, lost
+
+    def depth(self):
+        return HEAD.unpack_from(self.map, HEAD_OFFSET)[0] - self.tail
+
+    def close(self):
+        self.map.close()
+
+
+class SamplerProcess(multiprocessing.Process):
+    """
+    The sampling process: captures the pulses of the tap pins with edge detection and reads the scales, and
+    writes both into `ring`. Create and start it before any other thread, it's forked from the main process.
+
+    Parameters
+    ----------
+    pins: List of Integer
+        Pins of the flowmeters.
+    scales<optional>: List of Dictionary
+        Scale configs, as in the `scales` section of the config. Scales sharing a clock pin are read together by
+        a `MultiHX711` feeding a `WeightFilter` per cell. Filtered weights are written with the index of their
+        scale in this list as channel.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API in the sampling process. Defaults to
+        `gpio_backend.get_gpio()`.
+    expanders<optional>: Dictionary
+        The `expanders` config, to sample tap pins on I2C expanders from this process too.
+    capacity<optional>: Integer
+        Records in the ring.
+    nice<optional>: Integer
+        Niceness of the sampling process, negative values need root.
+    """
+    def __init__(self, pins, scales=None, gpio=None, expanders=None, capacity=65536, nice=None):
+        super(SamplerProcess, self).__init__(name='keg-sampler')
+        self.daemon = True
+        self.pins = list(pins)
+        self.scales = scales or []
+        self.gpio = gpio
+        self.expanders = expanders
+        self.nice = nice
+        self.ring = SharedRing(capacity)
+        self.stopped = multiprocessing.Event()
+
+        ALIVE.bind(lambda: self.is_alive())
+        DEPTH.bind(lambda: self.ring.depth())
+
+    def stop(self):
+        self.stopped.set()
+        self.join(1)
+        if self.is_alive():
+            self.terminate()
+
+    # Sampling process
+
+    def run(self):
+        # Ctrl-C is for the main process, which stops this one
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.nice:
+            try:
+                os.nice(self.nice)
+            except OSError as e:
+                logging.warning("\n\tCould not change the niceness of the sampling process: %s" % e)
+
+        gpio = self.gpio
+        if gpio is None:
+            from gpio_backend import get_gpio
+            gpio = get_gpio()
+        if self.expanders:
+            from gpio_mcp23017 import ExpanderGPIO, open_bus
+
+            config = self.expanders
+            gpio = ExpanderGPIO(gpio, open_bus(config.get('bus', 1)), config.get('addresses', [0x20]),
+                                interrupt=config.get('interrupt'), base=config.get('base', 100),
+                                poll_interval=config.get('poll_interval', 0.05))
+
+        gpio.setmode(gpio.BCM)
+        for pin in self.pins:
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+            gpio.add_event_detect(pin, gpio.RISING, callback=self.on_edge)
+
+        groups = {}
+        for index, scale in enumerate(self.scales):
+            groups.setdefault(scale['sck'], []).append(index)
+        for sck, indexes in sorted(groups.items()):
+            thread = threading.Thread(target=self.read_scales, name='hx711-sck-%s' % sck, args=(gpio, sck, indexes))
+            thread.daemon = True
+            thread.start()
+
+        logging.info("\n\tsampling %s taps and %s scales in process %s" % (len(self.pins), len(self.scales),
+                                                                           os.getpid()))
+        parent = os.getppid()
+        # Also gone with the main process, even when it was killed
+        while not self.stopped.wait(0.5) and os.getppid() == parent:
+            pass
+        gpio.cleanup()
+
+    def on_edge(self, channel, timestamp=None):
+        self.ring.append(PULSE, channel, timestamp if timestamp is not None else monotonic_ns())
+
+    def read_scales(self, gpio, sck, indexes):
+        from hx711_multi import MultiHX711
+        from weight_filter import WeightFilter
+
+        scales = [self.scales[index] for index in indexes]
+        multi = MultiHX711([scale['dout'] for scale in scales], sck,
+                           gains=[scale.get('gain', 128) for scale in scales], gpio=gpio,
+                           filters=[WeightFilter() for scale in scales])
+        for position, scale in enumerate(scales):
+            multi.set_reference_unit(position, scale.get('reference_unit', 1))
+            multi.set_offset(position, scale.get('offset', 0))
+
+        interval = scales[0].get('interval', 1.0)
+        while True:
+            try:
+                multi.update()
+            except Exception as e:
+                logging.error("\n\tCould not read the scales on pin %s" % sck)
+                logging.error(e)
+            else:
+                now = monotonic_ns()
+                for position, index in enumerate(indexes):
+                    weight = multi.get_filtered_weight(position)
+                    if weight is not None:
+                        kind = SETTLED_WEIGHT if multi.is_settled(position) else WEIGHT
+                        self.ring.append(kind, index, now, weight)
+            time.sleep(interval)
+
+
+class SampledGPIO(object):
+    """
+    GPIO backend of the main process while a `SamplerProcess` samples the taps. Edge detection on the pins of
+    the sampler is fed from its ring, calling the callbacks from one reader thread with the capture time of
+    the pulse in nanoseconds on the monotonic clock, `callback(channel, timestamp_ns)`. Every other pin goes to
+    the native backend.
+
+    Parameters
+    ----------
+    gpio: GPIO backend
+        Native backend, for the pins the sampler doesn't own.
+    sampler: SamplerProcess
+    interval<optional>: Float
+        Seconds the reader sleeps once it has emptied the ring. Only delays the pour logic, not pulse timing.
+    """
+    EVENT_TIMESTAMPS = True
+
+    def __init__(self, gpio, sampler, interval=0.005):
+        self.gpio = gpio
+        self.sampler = sampler
+        self.ring = sampler.ring
+        self.interval = interval
+        self.pins = set(sampler.pins)
+        self.callbacks = {}
+        # scale index -> (time.time() it was read, filtered weight, settled)
+        self.weights = {}
+        # scale index -> seconds after which its last weight is too old to use
+        self.max_ages = dict((index, scale.get('interval', 1.0) * STALE_INTERVALS)
+                             for index, scale in enumerate(sampler.scales))
+        self.lost = 0
+        self.thread = None
+        self.running = False
+
+        LOST.bind(lambda: self.lost)
+
+    def __getattr__(self, name):
+        # Constants and anything else not overridden come from the native backend
+        return getattr(self.gpio, name)
+
+    def setmode(self, mode):
+        self.gpio.setmode(mode)
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        if channel in self.pins:
+            return
+        if pull_up_down is None:
+            pull_up_down = self.gpio.PUD_OFF
+        self.gpio.setup(channel, direction, pull_up_down=pull_up_down, initial=initial)
+
+    def input(self, channel):
+        # The level of a sampled pin is only known to the sampler, the taps only need its edges
+        return 0 if channel in self.pins else self.gpio.input(channel)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        """
+        The sampler detects the rising edges of its pins, `edge` and `bouncetime` don't apply to them.
+        """
+        if channel not in self.pins:
+            return self.gpio.add_event_detect(channel, edge, callback=callback, bouncetime=bouncetime)
+        self.callbacks[channel] = [callback] if callback is not None else []
+        self.start()
+
+    def add_event_callback(self, channel, callback):
+        if channel not in self.pins:
+            return self.gpio.add_event_callback(channel, callback)
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    def remove_event_detect(self, channel):
+        if channel not in self.pins:
+            return self.gpio.remove_event_detect(channel)
+        self.callbacks.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        if channel is None:
+            self.stop()
+        if channel is None or channel not in self.pins:
+            self.gpio.cleanup(channel)
+
+    def reading(self, index):
+        """
+        The last (time, filtered weight, settled) the sampler read from the scale at `index`. None before the
+        first one, or once the scale hasn't answered for `STALE_INTERVALS` of its intervals.
+        """
+        reading = self.weights.get(index)
+        if reading is None or time.time() - reading[0] > self.max_ages.get(index, STALE_INTERVALS):
+            return None
+        return reading
+
+    def weight(self, index):
+        """
+        The current filtered weight of the scale at `index`, None without a recent one.
+        """
+        reading = self.reading(index)
+        return reading[1] if reading is not None else None
+
+    def is_settled(self, index):
+        reading = self.reading(index)
+        return reading is not None and reading[2]
+
+    # Reader thread
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sampler-reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the reader thread, the sampling process keeps running.
+        """
+        thread, self.thread, self.running = self.thread, None, False
+        if thread is not None:
+            thread.join(1)
+
+    def run(self):
+        while self.running:
+            if not self.drain():
+                time.sleep(self.interval)
+
+    def drain(self):
+        """
+        Hands the records in the ring to the callbacks and the weights.
+
+        :return: Number of records read
+        """
+        records, lost = self.ring.read()
+        if lost:
+            self.lost += lost
+            logging.warning("\n\t%s samples were overwritten before they were read" % lost)
+
+        callbacks = self.callbacks
+        now = None
+        for kind, channel, timestamp, value in records:
+            if kind == PULSE:
+                for callback in callbacks.get(channel, ()):
+                    callback(channel, timestamp)
+            elif kind == WEIGHT or kind == SETTLED_WEIGHT:
+                now = now or time.time()
+                self.weights[channel] = (now, value, kind == SETTLED_WEIGHT)
+        return len(records)
@@ -0,0 +1,599 @@
+"""
+Records what the sensors actually did, raw, so a miscounting tap or a misbehaving probe can be replayed through
+the real processing code on a dev box:
+
+    "trace": {"directory": "/var/lib/keg-server/traces", "pins": null, "max_bytes": 268435456}
+
+A trace is an append-only file of fixed-size records in the order they were seen, after a header:
+
+    magic       8 bytes, `KEGTRC01`
+    record size 4 bytes, 16
+    header size 4 bytes, 4096
+    origin      8 bytes, monotonic clock in nanoseconds when the recording started
+    started     8 bytes, wall clock (`time.time()`) when the recording started
+    metadata    JSON, NUL padded up to the header size: the probe `names` and the `info` of the recorder
+
+    time        8 bytes, signed, monotonic clock in nanoseconds
+    kind        1 byte, 1 for a GPIO edge, 2 for an hx711 conversion, 3 for a one-wire reading
+    level       1 byte, signed, the level after an edge, 0 for a one-wire reading that failed its CRC check
+    channel     2 bytes, the BCM pin of the edge or the hx711 DOUT, the index of the probe in `names`
+    value       4 bytes, signed, the raw 24 bit hx711 count or the temperature in millidegrees Celsius
+
+All little endian. Edges are timestamped by the backend where it can (the kernel with the character device, the
+sampler), so a pulse keeps the time it happened at. The sidecar `.idx` file indexes the trace by time, with the
+number of the first record of every `index_interval`, so a window of a long trace is found without reading it.
+Records of different sensors can be slightly out of time order; reading a window sorts it.
+
+Replaying goes through the simulated devices the benchmarks already use, so the code under test is the real one:
+`ReplayGPIO` fires the recorded edges at the `TapManager` or a `FlowMeter` in real time or faster, `replay_pours`
+runs them through the pour logic on the recorded clock as fast as it can, `replay_hx711` shifts the recorded
+counts out of a `SimulatedHX711` for `HX711` or `MultiHX711` to read, and `W1Replay` writes the recorded
+temperatures into a `FakeW1Bus` for the `W1BusScanner` or `TempMonitor.main`.
+
+    python sensor_trace.py info trace.bin
+    python sensor_trace.py pours trace.bin [start] [end]
+"""
+import os
+import sys
+import json
+import time
+import struct
+import logging
+import threading
+
+import metrics
+from gpio_backend import SimulatedGPIO, monotonic_ns, wait_until
+
+RECORDS = metrics.counter('keg_trace_records_total', 'Sensor events written to the trace', ['kind'])
+DROPPED = metrics.counter('keg_trace_dropped_total', 'Sensor events not written as the trace reached its maximum size')
+
+EDGE = 1
+HX711 = 2
+W1 = 3
+KINDS = {EDGE: 'edge', HX711: 'hx711', W1: 'w1'}
+
+MAGIC = b'KEGTRC01'
+# magic, record size, header size, origin, started
+HEADER = struct.Struct('<8sIIqd')
+HEADER_SIZE = 4096
+METADATA_OFFSET = 64
+RECORD = struct.Struct('<qBbHi')
+RECORD_DTYPE = [('time', '<i8'), ('kind', 'u1'), ('level', 'i1'), ('channel', '<u2'), ('value', '<i4')]
+INDEX = struct.Struct('<qQ')
+INDEX_DTYPE = [('time', '<i8'), ('record', '<u8')]
+
+
+class TraceRecorder(object):
+    """
+    Appends sensor events to a new trace file. Safe to call from every sensor thread.
+
+    Parameters
+    ----------
+    path: String
+        The trace file, which must not exist yet. The index is written next to it, to `path + '.idx'`.
+    info<optional>: Dictionary
+        Anything replaying needs to know, stored in the header, i.e. the taps and scales config.
+    index_interval<optional>: Float
+        Seconds between two entries of the index.
+    max_bytes<optional>: Integer
+        Size the trace stops growing at, events past it are counted and dropped. None for no limit.
+    flush_interval<optional>: Float
+        Seconds records can stay buffered before they are written out.
+    """
+    def __init__(self, path, info=None, index_interval=1.0, max_bytes=None, flush_interval=1.0):
+        if os.path.exists(path):
+            raise ValueError("%s already exists, traces are never appended to" % path)
+
+        self.path = path
+        self.info = info or {}
+        self.names = []
+        self.ids = {}
+        self.index_interval = int(index_interval * 1e9)
+        self.max_records = None if max_bytes is None else max(max_bytes - HEADER_SIZE, 0) // RECORD.size
+        self.flush_interval = int(flush_interval * 1e9)
+        self.lock = threading.Lock()
+        # Looked up once, so recording an edge is a single increment
+        self.counters = dict((kind, RECORDS.labels(name)) for kind, name in KINDS.items())
+
+        self.origin = monotonic_ns()
+        self.started = time.time()
+        self.count = 0
+        self.dropped = 0
+        self.next_index = self.origin
+        self.flushed = self.origin
+
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, RECORD.size, HEADER_SIZE, self.origin, self.started))
+        self.file.write(b'\0' * (HEADER_SIZE - HEADER.size))
+        self.write_metadata()
+        self.index = open(path + '.idx', 'wb')
+        self.closed = False
+
+    def write_metadata(self):
+        """
+        Rewrites the metadata in the header, in place. Must be called holding `lock` once recording started.
+        """
+        metadata = json.dumps({'names': self.names, 'info': self.info}, separators=(',', ':')).encode('utf-8')
+        if len(metadata) > HEADER_SIZE - METADATA_OFFSET:
+            raise ValueError("The trace metadata doesn't fit in %d bytes" % (HEADER_SIZE - METADATA_OFFSET))
+        position = self.file.tell()
+        self.file.seek(METADATA_OFFSET)
+        self.file.write(metadata + b'\0' * (HEADER_SIZE - METADATA_OFFSET - len(metadata)))
+        self.file.seek(position)
+
+    def record(self, kind, channel, value=0, level=0, timestamp=None):
+        """
+        Appends one event.
+
+        :param timestamp: Monotonic clock in nanoseconds when the event happened, now if None
+        """
+        if timestamp is None:
+            timestamp = monotonic_ns()
+        with self.lock:
+            if self.closed:
+                return
+            if self.max_records is not None and self.count >= self.max_records:
+                self.dropped += 1
+                DROPPED.inc()
+                return
+            if timestamp >= self.next_index:
+                self.index.write(INDEX.pack(timestamp, self.count))
+                self.next_index = timestamp - timestamp % self.index_interval + self.index_interval
+            self.file.write(RECORD.pack(timestamp, kind, level, channel, value))
+            self.count += 1
+            if timestamp - self.flushed >= self.flush_interval:
+                self.file.flush()
+                self.index.flush()
+                self.flushed = timestamp
+        self.counters[kind].inc()
+
+    def edge(self, channel, level, timestamp=None):
+        self.record(EDGE, channel, level=level, timestamp=timestamp)
+
+    def hx711(self, dout, value, timestamp=None):
+        self.record(HX711, dout, value=value, timestamp=timestamp)
+
+    def w1(self, name, temperature, timestamp=None):
+        """
+        :param temperature: Degrees Celsius, None for a reading that failed its CRC check
+        """
+        channel = self.ids.get(name)
+        if channel is None:
+            with self.lock:
+                channel = self.ids.get(name)
+                if channel is None:
+                    self.names.append(name)
+                    self.write_metadata()
+                    channel = self.ids[name] = len(self.names) - 1
+        if temperature is None:
+            self.record(W1, channel, level=0, timestamp=timestamp)
+        else:
+            self.record(W1, channel, value=int(round(temperature * 1000)), level=1, timestamp=timestamp)
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+                self.index.flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.close()
+            self.index.close()
+        if self.dropped:
+            logging.warning("\n\tThe trace %s reached its maximum size, %d events were not recorded"
+                            % (self.path, self.dropped))
+
+
+class RecordingGPIO(object):
+    """
+    Wraps a GPIO backend and records the edges of the pins with event detection, and the level changes
+    `input` sees on `pins`, before handing them on. Every callback gets the timestamp of its edge.
+
+    Parameters
+    ----------
+    gpio: GPIO backend
+    recorder: TraceRecorder
+    pins<optional>: List
+        Pins whose level changes seen by `input` are recorded too, for taps captured with `capture='poll'`.
+    """
+    EVENT_TIMESTAMPS = True
+
+    def __init__(self, gpio, recorder, pins=None):
+        self.gpio = gpio
+        self.recorder = recorder
+        self.pins = set(pins or ())
+        self.levels = {}
+        self.edges = {}
+
+    def __getattr__(self, name):
+        return getattr(self.gpio, name)
+
+    def input(self, channel):
+        level = self.gpio.input(channel)
+        if channel in self.pins and self.levels.get(channel) != level:
+            self.levels[channel] = level
+            self.recorder.edge(channel, level)
+        return level
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        self.edges[channel] = edge
+        kwargs = {} if bouncetime is None else {'bouncetime': bouncetime}
+        self.gpio.add_event_detect(channel, edge, callback=self.recording(channel, callback), **kwargs)
+
+    def add_event_callback(self, channel, callback):
+        self.gpio.add_event_callback(channel, self.wrap(callback))
+
+    def remove_event_detect(self, channel):
+        self.edges.pop(channel, None)
+        self.gpio.remove_event_detect(channel)
+
+    def recording(self, channel, callback):
+        """
+        The callback registered first on a pin, which records its edges once whatever else listens to them.
+        """
+        edge = self.edges[channel]
+        gpio = self.gpio
+        recorder = self.recorder
+        timestamps = getattr(gpio, 'EVENT_TIMESTAMPS', False)
+
+        def record(channel, timestamp=None):
+            if not timestamps or timestamp is None:
+                timestamp = monotonic_ns()
+            level = 1 if edge == gpio.RISING else 0 if edge == gpio.FALLING else gpio.input(channel)
+            recorder.edge(channel, level, timestamp)
+            if callback is not None:
+                callback(channel, timestamp)
+        return record
+
+    def wrap(self, callback):
+        # Callbacks of backends without timestamps are called without one, the ones here always get one
+        def call(channel, timestamp=None):
+            callback(channel, timestamp if timestamp is not None else monotonic_ns())
+        return call
+
+
+def record_hx711(hx, recorder):
+    """
+    Records every conversion `hx` reads, an `HX711` or a `MultiHX711`.
+    """
+    if hasattr(hx, 'DOUTS'):
+        sweep = hx.sweep
+
+        def recorded_sweep(next_gain):
+            values = sweep(next_gain)
+            timestamp = monotonic_ns()
+            for dout, value in zip(hx.DOUTS, values):
+                recorder.hx711(dout, value, timestamp)
+            return values
+        hx.sweep = recorded_sweep
+    else:
+        read_raw = hx.read_raw
+
+        def recorded_read_raw():
+            value = read_raw()
+            recorder.hx711(hx.DOUT, value)
+            return value
+        hx.read_raw = recorded_read_raw
+    return hx
+
+
+def record_w1(scanner, recorder):
+    """
+    Records every probe reading of a `W1BusScanner` sweep, CRC failures included.
+    """
+    scan = scanner.scan
+
+    def recorded_scan():
+        readings = scan()
+        timestamp = monotonic_ns()
+        for name, temperature in sorted(readings.items()):
+            recorder.w1(name, temperature, timestamp)
+        return readings
+    scanner.scan = recorded_scan
+    return scanner
+
+
+class TraceReader(object):
+    """
+    A trace, memory-mapped. Times are in seconds from the start of the recording.
+
+    Parameters
+    ----------
+    path: String
+    """
+    def __init__(self, path):
+        import numpy
+
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a sensor trace" % path)
+        magic, record_size, header_size, self.origin, self.started = HEADER.unpack_from(header)
+        if record_size != RECORD.size or header_size != HEADER_SIZE:
+            raise ValueError("%s has records of %d bytes, expected %d" % (path, record_size, RECORD.size))
+        metadata = json.loads(header[METADATA_OFFSET:].rstrip(b'\0').decode('utf-8'))
+        self.names = metadata['names']
+        self.info = metadata['info']
+
+        # A record cut short by a crash is left out
+        self.count = (os.path.getsize(path) - HEADER_SIZE) // RECORD.size
+        if self.count:
+            self.records = numpy.memmap(path, RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(self.count,))
+        else:
+            self.records = numpy.zeros(0, RECORD_DTYPE)
+
+        self.index = numpy.zeros(0, INDEX_DTYPE)
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+            index = numpy.frombuffer(data[:len(data) // INDEX.size * INDEX.size], INDEX_DTYPE)
+            self.index = index[index['record'] < self.count]
+
+    def __len__(self):
+        return self.count
+
+    def duration(self):
+        if not self.count:
+            return 0.0
+        return (int(self.records['time'].max()) - self.origin) / 1e9
+
+    def range(self, start=None, end=None, kind=None, channel=None):
+        """
+        The records with `start <= time < end`, of one `kind` and `channel` if given, in time order.
+
+        :return: numpy structured array of records
+        """
+        import numpy
+
+        low, high = 0, self.count
+        if len(self.index):
+            # Entries are a whole interval apart, and records of other sensors may be a little out of order
+            slack = int(2e9)
+            times = self.index['time']
+            if start is not None:
+                position = numpy.searchsorted(times, self.origin + int(start * 1e9) - slack, 'right') - 1
+                low = int(self.index['record'][position]) if position >= 0 else 0
+            if end is not None:
+                position = numpy.searchsorted(times, self.origin + int(end * 1e9) + slack, 'right')
+                high = int(self.index['record'][position]) if position < len(times) else self.count
+
+        records = self.records[low:high]
+        mask = numpy.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= records['time'] >= self.origin + int(start * 1e9)
+        if end is not None:
+            mask &= records['time'] < self.origin + int(end * 1e9)
+        if kind is not None:
+            mask &= records['kind'] == kind
+        if channel is not None:
+            mask &= records['channel'] == channel
+        records = records[mask]
+        return records[numpy.argsort(records['time'], kind='mergesort')]
+
+    def summary(self):
+        """
+        Number of records per kind and channel, with probe names for the one-wire readings.
+        """
+        import numpy
+
+        counts = {}
+        for kind in (EDGE, HX711, W1):
+            channels = self.records['channel'][self.records['kind'] == kind]
+            for channel, count in zip(*numpy.unique(channels, return_counts=True)):
+                name = self.names[channel] if kind == W1 else int(channel)
+                counts[(KINDS[kind], name)] = int(count)
+        return counts
+
+
+class ReplayGPIO(SimulatedGPIO):
+    """
+    Simulated pins driven by the edges of a trace, for the `TapManager` or a `FlowMeter` to capture with their
+    real threads. The edges are timestamped on the monotonic clock of the replay, keeping their recorded
+    spacing divided by `speed`.
+
+    Faster than real time, the durations and flow rates of the pours shrink by `speed` (their volumes don't),
+    and the pour timeout stretches by `speed` in recorded time. `replay_pours` keeps both exact.
+    """
+    EVENT_TIMESTAMPS = True
+
+    def replay(self, trace, speed=1.0, start=None, end=None, pins=None):
+        """
+        Fires the recorded edges, blocking until they're all out.
+
+        :param trace: TraceReader
+        :param pins: Pins replayed, all of them if None
+        :return: Number of edges fired
+        """
+        records = trace.range(start, end, kind=EDGE)
+        if not len(records):
+            return 0
+        first = int(records['time'][0])
+        started = time.time()
+        origin = monotonic_ns()
+        fired = 0
+        for timestamp, channel, level in zip(records['time'].tolist(), records['channel'].tolist(),
+                                             records['level'].tolist()):
+            if pins is not None and channel not in pins:
+                continue
+            offset = (timestamp - first) / speed
+            wait_until(started + offset / 1e9)
+            # Both levels are fired, so a falling edge recorded on its own still makes the next one rise
+            if self.levels.get(channel, self.LOW) == level:
+                self._set_level(channel, 1 - level)
+            self._set_level(channel, level, origin + int(offset))
+            fired += 1
+        return fired
+
+
+def replay_pours(trace, meters, start=None, end=None):
+    """
+    Runs the recorded rising edges of the meters' pins through their pour logic (`recordPulse` and
+    `checkPourEnd`) on the recorded clock, as fast as it goes, ending pours exactly like the flowmeter thread
+    would have. The finished pours go wherever the meters send them, their `delivery` queue.
+
+    :param meters: FlowMeters, they don't need to be started
+    :return: Number of pulses replayed
+    """
+    pins = dict((meter.pin, meter) for meter in meters)
+    records = trace.range(start, end, kind=EDGE)
+    pulses = 0
+    for timestamp, channel, level in zip(records['time'].tolist(), records['channel'].tolist(),
+                                         records['level'].tolist()):
+        meter = pins.get(channel)
+        if meter is None or level != 1:
+            continue
+        currentTime = timestamp / 1000000.0
+        expire_pours(meters, currentTime)
+        meter.recordPulse(currentTime)
+        pulses += 1
+    expire_pours(meters, float('inf'))
+    return pulses
+
+
+def expire_pours(meters, currentTime):
+    for meter in meters:
+        pour = meter.pour
+        if pour.pouring and currentTime - pour.lastPinChange > pour.pourTimeout:
+            # What the flowmeter thread sees waking up at the timeout: the pulses, then no new ones
+            expired = pour.lastPinChange + pour.pourTimeout + 1
+            meter.checkPourEnd(expired)
+            meter.checkPourEnd(expired)
+
+
+def replay_hx711(trace, gpio, dout, pd_sck, speed=None, start=None, end=None):
+    """
+    A `SimulatedHX711` on `gpio` converting the counts recorded for `dout`, for an `HX711` or `MultiHX711` to
+    read. Without a `speed` every conversion is the next recorded count, as soon as the previous one was read.
+    With one the chip converts at the recorded rate times `speed`, the latest count recorded by then.
+    """
+    from simulation import SimulatedHX711
+
+    records = trace.range(start, end, kind=HX711, channel=dout)
+    values = records['value'].tolist()
+    if speed is None or len(values) < 2:
+        # The conversion their constructors read and discard was never recorded, the first count stands in
+        return SimulatedHX711(gpio, dout, pd_sck, values=values[:1] + values or 0, rate=None)
+
+    import numpy
+
+    times = records['time'].tolist()
+    rate = speed * 1e9 / float(numpy.median(numpy.diff(records['time'])))
+    started = time.time()
+
+    def latest():
+        recorded = times[0] + (time.time() - started) * speed * 1e9
+        return values[max(numpy.searchsorted(times, recorded, 'right') - 1, 0)]
+    return SimulatedHX711(gpio, dout, pd_sck, values=latest, rate=rate)
+
+
+class W1Replay(object):
+    """
+    A `FakeW1Bus` with the probes of a trace, set to their recorded readings one sweep at a time, for the
+    `W1BusScanner` or `TempMonitor.main` to read.
+
+    Parameters
+    ----------
+    trace: TraceReader
+    basepath<optional>: String
+        Directory to create the fake bus in, a temporary one by default.
+    """
+    def __init__(self, trace, basepath=None, start=None, end=None):
+        from simulation import FakeW1Bus
+
+        self.trace = trace
+        self.bus = FakeW1Bus(basepath)
+        for name in trace.names:
+            self.bus.add_probe(name)
+        self.records = trace.range(start, end, kind=W1)
+
+    def sweeps(self):
+        """
+        Generator setting the probes to each recorded sweep in turn, yielding the seconds it was recorded at.
+        """
+        records = self.records
+        times = records['time'].tolist()
+        position = 0
+        while position < len(times):
+            sweep = times[position]
+            while position < len(times) and times[position] == sweep:
+                channel, value, level = (int(records['channel'][position]), int(records['value'][position]),
+                                         int(records['level'][position]))
+                self.bus.set_temperature(self.trace.names[channel], value / 1000.0, crc_ok=bool(level))
+                position += 1
+            yield (sweep - self.trace.origin) / 1e9
+
+    def play(self, speed=1.0):
+        """
+        Sets every sweep at its recorded time divided by `speed`, blocking until the last one.
+        """
+        started = time.time()
+        first = None
+        for recorded in self.sweeps():
+            if first is None:
+                first = recorded
+            wait_until(started + (recorded - first) / speed)
+
+    def cleanup(self):
+        self.bus.cleanup()
+
+
+class PourCollector(object):
+    """
+    Stands in for the delivery queue of replayed meters, keeping their pours.
+    """
+    def __init__(self):
+        self.pours = []
+
+    def put(self, record):
+        self.pours.append(record)
+        return True
+
+
+def replay_meters(trace, start=None, end=None):
+    """
+    FlowMeters for the taps recorded in the trace info, or one per recorded pin, replayed with
+    `replay_pours`.
+
+    :return: List of (meter, PourCollector)
+    """
+    from flowmeter import FlowMeter
+
+    taps = trace.info.get('taps') or [{'keg': pin, 'pin': pin} for pin in
+                                      sorted(set(trace.range(kind=EDGE)['channel'].tolist()))]
+    gpio = SimulatedGPIO()
+    meters = []
+    for tap in taps:
+        collector = PourCollector()
+        meter = FlowMeter(tap['keg'], tap['pin'], gpio=gpio, kFactor=tap.get('k_factor', 450.0),
+                          delivery=collector, debounce=tap.get('debounce', 0))
+        meters.append((meter, collector))
+    replay_pours(trace, [meter for meter, collector in meters], start, end)
+    return meters
+
+
+def main(command, path, start=None, end=None):
+    trace = TraceReader(path)
+    start = float(start) if start is not None else None
+    end = float(end) if end is not None else None
+
+    if command == 'info':
+        print('%s: %d records over %.1f seconds, recorded from %s' % (path, len(trace), trace.duration(),
+                                                                     time.ctime(trace.started)))
+        for (kind, channel), count in sorted(trace.summary().items()):
+            print('  %-6s %-20s %10d' % (kind, channel, count))
+    elif command == 'pours':
+        for meter, collector in replay_meters(trace, start, end):
+            for pour in collector.pours:
+                print('keg %-4s %8.2f oz %7.2f s' % (pour['kegid'], pour['volume'], pour['duration']))
+    else:
+        raise ValueError("Unknown command `%s`, expected `info` or `pours`" % command)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(*sys.argv[1:5])
@@ -0,0 +1,508 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from gpio_backend import monotonic_ns, wait_until
+
+
+class PulseTrain(object):
+    """
+    The level of a pin carrying `count` pulses at `frequency` Hz from `started` on, computed from the clock
+    whenever it's read. Fed to a `SimulatedGPIO` with `feed`, it lets a polling sampler be measured without a
+    thread driving the pin and competing with it for the interpreter.
+    """
+    def __init__(self, frequency, count, duty=0.5, started=None):
+        self.frequency = frequency
+        self.count = count
+        self.duty = duty
+        self.started = time.time() if started is None else started
+
+    def __call__(self):
+        position = (time.time() - self.started) * self.frequency
+        if position < 0 or position >= self.count:
+            return 0
+        return 1 if position % 1 < self.duty else 0
+
+    def done(self):
+        return (time.time() - self.started) * self.frequency >= self.count
+
+
+class SimulatedHX711(object):
+    """
+    An hx711 wired to the pins of a `SimulatedGPIO`. It follows the PD_SCK clock driven by the code under
+    test and shifts its conversions out on DOUT, MSB first in two's complement, like the real chip.
+
+    With a `rate`, a background thread completes a conversion every 1/rate seconds and pulls DOUT low, so
+    `wait_for_edge` and streaming behave like on the Pi. A conversion that completes before the previous
+    one was read replaces it and is counted in `overwritten`. Without a rate, a new conversion is ready as
+    soon as the previous one has been read, to measure how fast the reading code itself is.
+
+    Parameters
+    ----------
+    gpio: SimulatedGPIO
+        The simulated pins.
+    dout: Integer
+    pd_sck: Integer
+    values<optional>: Integer, iterable or callable
+        The raw value of every conversion. An iterable repeats its last value once exhausted, a callable is
+        called once per conversion.
+    rate<optional>: Integer
+        Conversions per second, 10 or 80 on the real chip, None for no delay.
+    """
+    def __init__(self, gpio, dout, pd_sck, values=0, rate=80):
+        self.gpio = gpio
+        self.dout = dout
+        self.pd_sck = pd_sck
+        self.rate = rate
+
+        if callable(values):
+            self.source = values
+        elif isinstance(values, int):
+            self.source = lambda: values
+        else:
+            iterator = iter(values)
+            last = [0]
+
+            def source():
+                last[0] = next(iterator, last[0])
+                return last[0]
+            self.source = source
+
+        self.lock = threading.Lock()
+        self.word = 0
+        self.ready = False
+        self.pulses = 0
+        self.connected = True
+
+        self.conversions = 0
+        self.reads = 0
+        self.overwritten = 0
+
+        self.running = False
+        self.thread = None
+
+        gpio.drive(dout, 1)
+        gpio.watch(pd_sck, self.on_clock)
+        if rate is None:
+            gpio.feed(dout, self.level)
+        else:
+            self.start()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.convert_loop, name='sim-hx711-%s' % self.dout)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def disconnect(self):
+        """
+        Stops converting and holds DOUT high, like a chip that lost power or its load cell.
+        """
+        with self.lock:
+            self.connected = False
+            self.ready = False
+        self.gpio.drive(self.dout, 1)
+
+    def connect(self):
+        self.connected = True
+
+    def convert(self):
+        """
+        Latches a new conversion and signals data ready. Must be called holding `lock`.
+        """
+        if self.ready:
+            self.overwritten += 1
+        self.word = self.source() & 0xFFFFFF
+        self.conversions += 1
+        self.pulses = 0
+        self.ready = True
+
+    def convert_loop(self):
+        period = 1.0 / self.rate
+        deadline = time.time() + period
+        while self.running:
+            wait_until(deadline)
+            deadline += period
+            with self.lock:
+                # Never start a conversion halfway through shifting one out
+                if not self.connected or 0 < self.pulses < 25:
+                    continue
+                self.convert()
+            self.gpio.drive(self.dout, 0)
+
+    def level(self):
+        """
+        DOUT without a rate: a read is ready whenever the previous one is done.
+        """
+        with self.lock:
+            if not self.ready and self.connected and (self.pulses == 0 or self.pulses >= 25):
+                self.convert()
+            if self.ready and self.pulses == 0:
+                return 0
+        return self.gpio.levels.get(self.dout, 1)
+
+    def on_clock(self, channel, level):
+        if not level:
+            return
+        with self.lock:
+            if not self.ready and self.pulses < 25:
+                return
+            self.pulses += 1
+            if self.pulses <= 24:
+                bit = (self.word >> (24 - self.pulses)) & 1
+            elif self.pulses == 25:
+                # The 25th pulse ends the read, the ones after it only select the gain
+                bit = 1
+                self.ready = False
+                self.reads += 1
+            else:
+                return
+        self.gpio.drive(self.dout, bit)
+
+
+class FakeChip(object):
+    """
+    Stand-in for a GPIO character device, for `gpio_cdev.CdevGPIO`. Each requested line is a pipe the edge
+    events are written to in the kernel's binary format, so the backend reads and parses them exactly like on
+    the Pi. Edges carry the timestamps given by the test code, letting it deliver a whole pulse train at
+    once, as if the process had been descheduled while the kernel kept timestamping.
+    """
+    path = 'fake'
+
+    def __init__(self):
+        from gpio_cdev import FLAG_EDGE_RISING, FLAG_EDGE_FALLING, FLAG_BIAS_PULL_UP
+
+        self.rising, self.falling, self.pull_up = FLAG_EDGE_RISING, FLAG_EDGE_FALLING, FLAG_BIAS_PULL_UP
+        # offset -> [read fd, write fd, flags, level, seqno]
+        self.lines = {}
+        self.offsets = {}
+        self.lock = threading.Lock()
+
+    def request(self, offset, flags, value=None, debounce_us=0, consumer=''):
+        with self.lock:
+            if offset in self.lines:
+                raise IOError(16, "Device or resource busy")
+            read, write = os.pipe()
+            level = value if value is not None else (1 if flags & self.pull_up else 0)
+            self.lines[offset] = [read, write, flags, level, 0]
+            self.offsets[read] = offset
+        return read
+
+    def configure(self, fd, flags, value=None, debounce_us=0):
+        line = self.lines[self.offsets[fd]]
+        line[2] = flags
+        if value is not None:
+            line[3] = value
+
+    def get_value(self, fd):
+        return self.lines[self.offsets[fd]][3]
+
+    def set_value(self, fd, value):
+        self.lines[self.offsets[fd]][3] = 1 if value else 0
+
+    def release(self, fd):
+        with self.lock:
+            line = self.lines.pop(self.offsets.pop(fd))
+        os.close(line[1])
+        os.close(line[0])
+
+    def close(self):
+        for fd in list(self.offsets):
+            self.release(fd)
+
+    # Simulation controls
+
+    def edges(self, offset, levels, timestamps):
+        """
+        Sets the level of a line through `levels`, queueing an event stamped with the matching entry of
+        `timestamps` (nanoseconds on the monotonic clock) for every edge the line watches, in one write.
+        """
+        from gpio_cdev import EVENT, EVENT_RISING_EDGE, EVENT_FALLING_EDGE
+
+        line = self.lines[offset]
+        events = []
+        for level, timestamp in zip(levels, timestamps):
+            if level == line[3]:
+                continue
+            line[3] = level
+            if line[2] & (self.rising if level else self.falling):
+                line[4] += 1
+                events.append(EVENT.pack(timestamp, EVENT_RISING_EDGE if level else EVENT_FALLING_EDGE, offset,
+                                         line[4], line[4]))
+        data = b''.join(events)
+        while data:
+            data = data[os.write(line[1], data):]
+        return len(events)
+
+    def drive(self, offset, value, timestamp=None):
+        return self.edges(offset, [1 if value else 0], [monotonic_ns() if timestamp is None else timestamp])
+
+    def pulses(self, offset, count, frequency, started=None, duty=0.5):
+        """
+        Queues a train of `count` pulses at `frequency` Hz that started at `started` (now by default) at once.
+
+        :return: Timestamp of the last edge
+        """
+        started = monotonic_ns() if started is None else started
+        period = 1e9 / frequency
+        levels = []
+        timestamps = []
+        for i in range(count):
+            levels.extend((1, 0))
+            timestamps.extend((int(started + i * period), int(started + (i + duty) * period)))
+        # Every pulse of the train starts with a rising edge
+        self.lines[offset][3] = 0
+        self.edges(offset, levels, timestamps)
+        return timestamps[-1]
+
+
+class SimulatedMCP23017(object):
+    """
+    Register model of an MCP23017 on a `FakeI2CBus`, enough for `gpio_mcp23017.ExpanderGPIO`: direction,
+    pull-ups, polarity, output latches, interrupt on change with INTF/INTCAP per port, cleared by reading INTCAP
+    or GPIO, and a sequential register pointer in BANK = 0. The INTA and INTB outputs are always mirrored.
+
+    Input levels are driven from test code with `drive`, or from the bus with `FakeI2CBus.play`.
+    """
+    def __init__(self, bus, address):
+        from gpio_mcp23017 import IODIR, IPOL, GPINTEN, DEFVAL, INTCON, INTF, INTCAP, GPIO, OLAT
+
+        self.IODIR, self.IPOL, self.GPINTEN, self.DEFVAL, self.INTCON = IODIR, IPOL, GPINTEN, DEFVAL, INTCON
+        self.INTF, self.INTCAP, self.GPIO, self.OLAT = INTF, INTCAP, GPIO, OLAT
+        self.bus = bus
+        self.address = address
+        self.registers = bytearray(0x16)
+        self.registers[IODIR] = self.registers[IODIR + 1] = 0xff
+        # Level on every pin from outside, a word with GPA0 as bit 0
+        self.levels = 0
+
+    def word(self, register):
+        return self.registers[register] | self.registers[register + 1] << 8
+
+    def port(self):
+        """
+        The value of the GPIO registers: input levels through the polarity, output latches.
+        """
+        inputs = self.word(self.IODIR)
+        return ((self.levels ^ self.word(self.IPOL)) & inputs) | (self.word(self.OLAT) & ~inputs & 0xffff)
+
+    def drive(self, bit, value):
+        """
+        Sets the level on an input pin, raising the interrupt when it's enabled. Called with the bus lock held.
+        """
+        previous = self.port()
+        self.levels = self.levels | (1 << bit) if value else self.levels & ~(1 << bit)
+        current = self.port()
+        compare = self.word(self.INTCON)
+        # Pins compared to DEFVAL interrupt on every level other than it, the others on every change
+        changed = ((previous ^ current) & ~compare) | ((current ^ self.word(self.DEFVAL)) & compare)
+        changed &= self.word(self.GPINTEN) & self.word(self.IODIR)
+        for port in (0, 1):
+            flags = changed >> (8 * port) & 0xff
+            # INTCAP keeps the state of the first change until the interrupt is cleared
+            if flags and not self.registers[self.INTF + port]:
+                self.registers[self.INTF + port] = flags
+                self.registers[self.INTCAP + port] = current >> (8 * port) & 0xff
+
+    def asserted(self):
+        return bool(self.registers[self.INTF] or self.registers[self.INTF + 1])
+
+    def read(self, register, length):
+        data = []
+        for i in range(length):
+            address = (register + i) % len(self.registers)
+            if address in (self.GPIO, self.GPIO + 1):
+                value = self.port() >> (8 * (address - self.GPIO)) & 0xff
+            else:
+                value = self.registers[address]
+            if address in (self.INTCAP, self.INTCAP + 1, self.GPIO, self.GPIO + 1):
+                self.registers[self.INTF + address % 2] = 0
+            data.append(value)
+        return data
+
+    def write(self, register, values):
+        for i, value in enumerate(values):
+            address = (register + i) % len(self.registers)
+            if address in (self.INTF, self.INTF + 1, self.INTCAP, self.INTCAP + 1):
+                continue
+            # Writing GPIO writes the output latch
+            if address in (self.GPIO, self.GPIO + 1):
+                address += self.OLAT - self.GPIO
+            self.registers[address] = value & 0xff
+
+
+class FakeI2CBus(object):
+    """
+    An I2C bus with simulated MCP23017 expanders, providing the `smbus` methods used by `gpio_mcp23017`. A
+    transaction holds the bus for the time it takes at `clock` Hz, 9 bits per byte, so reads cost what they
+    would on the Pi. Addresses without a device fail like the real bus.
+
+    Parameters
+    ----------
+    clock<optional>: Integer
+        Bus clock in Hz, 400 kHz fast mode by default. None makes transactions instant.
+    """
+    def __init__(self, clock=400000):
+        self.clock = clock
+        self.devices = {}
+        # The state of the devices, and the bus itself, held for the duration of a transaction
+        self.lock = threading.Lock()
+        self.wire = threading.Lock()
+        self.gpio = None
+        self.pin = None
+        self.transactions = 0
+
+    def add_mcp23017(self, address=0x20):
+        device = self.devices[address] = SimulatedMCP23017(self, address)
+        return device
+
+    def interrupt(self, gpio, pin):
+        """
+        Wires the interrupt outputs of every device, open drain and active low, to `pin` of a `SimulatedGPIO`.
+        """
+        self.gpio, self.pin = gpio, pin
+        self.update()
+
+    def update(self):
+        # Called with the lock held
+        if self.gpio is not None:
+            self.gpio.drive(self.pin, 0 if any(device.asserted() for device in self.devices.values()) else 1)
+
+    def transfer(self, address, length):
+        """
+        Holds the bus for a transaction of `length` data bytes. Called with the wire held.
+        """
+        device = self.devices.get(address)
+        if device is None:
+            raise IOError(121, "Remote I/O error")
+        self.transactions += 1
+        if self.clock:
+            # Address and register, a repeated start and address for reads, then the data. Slept rather than
+            # spun, the ioctl of the real bus releases the interpreter too
+            time.sleep((length + 3) * 9.0 / self.clock)
+        return device
+
+    # smbus API
+
+    def read_i2c_block_data(self, address, register, length=32):
+        with self.wire:
+            device = self.transfer(address, length)
+            with self.lock:
+                data = device.read(register, length)
+                self.update()
+        return data
+
+    def read_byte_data(self, address, register):
+        return self.read_i2c_block_data(address, register, 1)[0]
+
+    def write_i2c_block_data(self, address, register, data):
+        with self.wire:
+            device = self.transfer(address, len(data))
+            with self.lock:
+                device.write(register, data)
+
+    def write_byte_data(self, address, register, value):
+        self.write_i2c_block_data(address, register, [value])
+
+    def close(self):
+        pass
+
+    # Simulation controls
+
+    def drive(self, address, bit, value):
+        with self.lock:
+            self.devices[address].drive(bit, value)
+            self.update()
+
+    def play(self, frequencies, seconds, duty=0.5):
+        """
+        Drives pulse trains onto many expander pins at once in real time, from the calling thread, blocking
+        until they're done.
+
+        :param frequencies: Dictionary of (address, bit) -> pulses per second
+        :return: Dictionary of (address, bit) -> pulses driven
+        """
+        edges = []
+        counts = {}
+        for pin, frequency in frequencies.items():
+            counts[pin] = int(seconds * frequency)
+            period = 1.0 / frequency
+            for i in range(counts[pin]):
+                edges.append((i * period, pin, 1))
+                edges.append(((i + duty) * period, pin, 0))
+        edges.sort()
+
+        for pin in frequencies:
+            self.drive(pin[0], pin[1], 0)
+        started = time.time()
+        for offset, pin, level in edges:
+            # Slept, not spun, so the driver doesn't starve the service thread of the interpreter the way an
+            # outside signal never would. The edges are at most a few hundred microseconds late.
+            remaining = started + offset - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.drive(pin[0], pin[1], level)
+        return counts
+
+
+class FakeW1Bus(object):
+    """
+    A fake `/sys/bus/w1/devices` tree with DS18B20 probes, to run `W1BusScanner` and `TempMonitor` without a
+    one-wire bus. Each probe gets a `w1_slave` file, a `temperature` attribute and a `resolution` attribute,
+    and the bus master a `therm_bulk_read` attribute unless `bulk` is False.
+
+    Parameters
+    ----------
+    basepath<optional>: String
+        Directory to create the tree in, a temporary directory by default.
+    bulk<optional>: Boolean
+        Whether the bus master supports bulk conversions.
+    """
+    def __init__(self, basepath=None, bulk=True):
+        self.temporary = basepath is None
+        self.basepath = basepath or tempfile.mkdtemp(prefix='w1-')
+        self.master = os.path.join(self.basepath, 'w1_bus_master1')
+        if not os.path.isdir(self.master):
+            os.makedirs(self.master)
+        if bulk:
+            self.write(os.path.join(self.master, 'therm_bulk_read'), '0\n')
+        self.probes = []
+
+    def add_probe(self, device_id=None, temperature=20.0):
+        """
+        :return: The id of the new probe, i.e. `28-000000000001`
+        """
+        device_id = device_id or '28-%012x' % (len(self.probes) + 1)
+        os.makedirs(os.path.join(self.basepath, device_id))
+        self.write(os.path.join(self.basepath, device_id, 'resolution'), '12\n')
+        self.probes.append(device_id)
+        self.set_temperature(device_id, temperature)
+        return device_id
+
+    def set_temperature(self, device_id, temperature, crc_ok=True):
+        """
+        Sets the next reading of a probe, in degrees Celsius. With `crc_ok=False` the reading fails its CRC
+        check like a probe with a bad connection.
+        """
+        millis = int(round(temperature * 1000))
+        raw = '%02x %02x 4b 46 7f ff 0c 10 1c' % (millis & 0xff, (millis >> 8) & 0xff)
+        device = os.path.join(self.basepath, device_id)
+        self.write(os.path.join(device, 'w1_slave'),
+                   '%s : crc=1c %s\n%s t=%d\n' % (raw, 'YES' if crc_ok else 'NO', raw, millis))
+        self.write(os.path.join(device, 'temperature'), '%d\n' % millis if crc_ok else '')
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def cleanup(self):
+        if self.temporary:
+            shutil.rmtree(self.basepath, ignore_errors=True)
@@ -0,0 +1,275 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+CONNECTED = metrics.gauge('keg_socket_connected', 'Whether the web socket to the API server is up', ['host'])
+DEPTH = metrics.gauge('keg_socket_queue_depth', 'Events waiting to be sent on the web socket', ['host'])
+SENT = metrics.counter('keg_socket_sent_total', 'Events sent on the web socket', ['host'])
+DROPPED = metrics.counter('keg_socket_dropped_total',
+                          'Events dropped from a full queue or for being stale when the socket came back', ['host'])
+COALESCED = metrics.counter('keg_socket_coalesced_total',
+                            'Updates replaced by a newer one of the same key before being sent', ['host'])
+LOST = metrics.counter('keg_socket_events_lost_total',
+                       'Events like pour totals dropped because max_events were already waiting', ['host'])
+RECONNECTS = metrics.counter('keg_socket_reconnects_total', 'Attempts to open the web socket', ['host'])
+
+_sockets = {}
+_sockets_lock = threading.Lock()
+
+
+def get_socket(host, port, **kwargs):
+    """
+    Returns the connection manager shared by every sensor streaming to `host:port`, so they all go through
+    one web socket.
+    """
+    key = (host, port)
+    with _sockets_lock:
+        manager = _sockets.get(key)
+        if manager is None:
+            manager = _sockets[key] = SocketManager(host, port, **kwargs)
+        return manager
+
+
+class SocketManager(threading.Thread):
+    """
+    Owns the Socket.IO connection to the API server on a thread of its own.
+
+    `emit` and `emit_latest` only append to a bounded queue and never block, so they are safe to call from
+    the sampling loops. The thread sends the queue out while the socket is up. A failed send or a socket that
+    reports itself closed is reconnected with exponential backoff and jitter, while events keep queueing.
+
+    Events sent with `emit`, like pour totals, are kept until they are sent, up to `max_events` of them: only
+    an outage long enough to pile up that many pours loses the oldest ones, counted in
+    `keg_socket_events_lost_total`. Progress updates sent with `emit_latest` replace the update of the same key
+    still waiting in the queue, the oldest one goes when `maxsize` are waiting, and they are dropped when they
+    waited more than `stale_after` seconds.
+
+    Parameters
+    ----------
+    host: String
+    port: Integer
+    maxsize<optional>: Integer
+        Maximum number of `emit_latest` updates waiting to be sent.
+    max_events<optional>: Integer
+        Maximum number of `emit` events waiting to be sent.
+    backoff<optional>: Float
+        Seconds to wait before the first reconnect, doubling on every failed attempt up to `max_backoff`.
+    stale_after<optional>: Float
+        Seconds after which a waiting `emit_latest` update isn't worth sending anymore.
+    check_interval<optional>: Float
+        Seconds between checks of an idle socket.
+    """
+    def __init__(self, host, port, maxsize=256, max_events=10000, backoff=1.0, max_backoff=60.0, stale_after=5.0,
+                 check_interval=5.0):
+        super(SocketManager, self).__init__(name='socket-%s' % port)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.max_events = max_events
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stale_after = stale_after
+        self.check_interval = check_interval
+
+        # [key, event, args, queued time] lists, key is None for events that must not be dropped
+        self.outbound = deque()
+        # key -> its waiting entry, so a newer update replaces it in place
+        self.latest = {}
+        # number of waiting entries with a None key
+        self.events = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.socket = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lost = 0
+        self.reconnects = 0
+
+        label = '%s:%s' % (host, port)
+        CONNECTED.labels(label).bind(lambda: self.socket is not None)
+        DEPTH.labels(label).bind(lambda: len(self.outbound))
+        SENT.labels(label).bind(lambda: self.sent)
+        DROPPED.labels(label).bind(lambda: self.dropped)
+        COALESCED.labels(label).bind(lambda: self.coalesced)
+        LOST.labels(label).bind(lambda: self.lost)
+        RECONNECTS.labels(label).bind(lambda: self.reconnects)
+
+    def start(self):
+        """
+        Starts the connection thread. Calling it more than once is harmless.
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        super(SocketManager, self).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def emit(self, event, *args):
+        """
+        Queues an event that is sent once the socket is up, however long that takes. Never blocks.
+        """
+        with self.condition:
+            if self.events >= self.max_events:
+                self.drop_oldest_event()
+            self.outbound.append([None, event, args, time.time()])
+            self.events += 1
+            self.condition.notify()
+
+    def emit_latest(self, key, event, *args):
+        """
+        Queues an update that replaces the one of the same `key` still waiting, if any. Never blocks.
+
+        :param key: Identifies the updates superseding each other, i.e. `('pourInterval', kegId)`
+        """
+        with self.condition:
+            entry = self.latest.get(key)
+            if entry is not None:
+                entry[1], entry[2], entry[3] = event, args, time.time()
+                self.coalesced += 1
+                return
+            if len(self.latest) >= self.maxsize:
+                self.drop_oldest_update()
+            entry = self.latest[key] = [key, event, args, time.time()]
+            self.outbound.append(entry)
+            self.condition.notify()
+
+    def drop_oldest_update(self):
+        """
+        Drops the update that has waited the longest. Called with the condition held.
+        """
+        for entry in self.outbound:
+            if entry[0] is not None:
+                self.outbound.remove(entry)
+                del self.latest[entry[0]]
+                self.dropped += 1
+                return
+
+    def drop_oldest_event(self):
+        """
+        Drops the event that has waited the longest, logging it since it's a pour the server won't hear of.
+        Called with the condition held.
+        """
+        for entry in self.outbound:
+            if entry[0] is None:
+                self.outbound.remove(entry)
+                self.events -= 1
+                self.lost += 1
+                logging.warning("\n\t%s events waiting for %s:%s, dropped the oldest %s" % (
+                    self.max_events, self.host, self.port, entry[1]))
+                return
+
+    def take(self):
+        """
+        Waits for the next event to send.
+
+        :return: The entry, or None when the socket should be checked or the manager stopped
+        """
+        with self.condition:
+            if not self.outbound and self.running:
+                self.condition.wait(self.check_interval)
+            if not self.outbound or not self.running:
+                return None
+            entry = self.outbound.popleft()
+            if entry[0] is not None:
+                del self.latest[entry[0]]
+            else:
+                self.events -= 1
+            return entry
+
+    def open(self):
+        """
+        Creates a web socket connection to the target host. Imported here so it's only loaded when streaming.
+        """
+        from socketIO_client import SocketIO, LoggingNamespace
+
+        logging.getLogger('requests').setLevel(logging.WARNING)
+        # Fail right away when the server is unreachable, the backoff is handled here
+        return SocketIO(self.host, self.port, LoggingNamespace, wait_for_connection=False)
+
+    def close(self):
+        socket, self.socket = self.socket, None
+        if socket is not None:
+            try:
+                socket.disconnect()
+            except Exception:
+                pass
+
+    def connect(self):
+        """
+        Opens the socket, retrying with exponential backoff and jitter until it's up or the manager stops.
+        """
+        attempt = 0
+        while self.running:
+            self.reconnects += 1
+            try:
+                logging.info("\n\tGetting socket connection...")
+                self.socket = self.open()
+                logging.info("\n\tConnected to %s:%s" % (self.host, self.port))
+                return
+            except Exception as e:
+                attempt += 1
+                delay = min(self.backoff * (2 ** (attempt - 1)), self.max_backoff)
+                delay *= random.uniform(0.5, 1.0)
+                logging.warning("\n\tCould not connect to %s:%s, retrying in %.1f seconds: %s" % (
+                    self.host, self.port, delay, e))
+                with self.condition:
+                    if self.running:
+                        self.condition.wait(delay)
+
+    def send(self, entry):
+        """
+        Sends one event, putting it back at the head of the queue when the socket fails.
+
+        :return: False if the socket is down
+        """
+        key, event, args, queued = entry
+        if key is not None and time.time() - queued > self.stale_after:
+            self.dropped += 1
+            return True
+
+        try:
+            self.socket.emit(event, *args)
+            self.sent += 1
+            return True
+        except Exception as e:
+            logging.error("\n\tThe web socket failed while emitting %s" % event)
+            logging.error(e)
+            # Updates are superseded by the time the socket is back, only keep the events
+            if key is None:
+                with self.condition:
+                    self.outbound.appendleft(entry)
+                    self.events += 1
+            else:
+                self.dropped += 1
+            return False
+
+    def run(self):
+        while self.running:
+            if self.socket is None:
+                self.connect()
+                continue
+
+            entry = self.take()
+            if entry is None:
+                # Idle, see whether the server closed the socket in the meantime
+                if not getattr(self.socket, 'connected', True):
+                    logging.warning("\n\tThe web socket to %s:%s was closed" % (self.host, self.port))
+                    self.close()
+                continue
+
+            if not self.send(entry):
+                self.close()
+
+        self.close()
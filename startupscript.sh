@@ -16,4 +16,4 @@ then
     touch /home/pi/keg-server/flowmeter.log
 fi
 
-python /home/pi/keg-server/flowmeter.py >> /home/pi/keg-server/flowmeter.log 2>&1
+python /home/pi/keg-server/kegserver.py /home/pi/keg-server/kegserver.json >> /home/pi/keg-server/flowmeter.log 2>&1
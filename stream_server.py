@@ -0,0 +1,217 @@
+import json
+import socket
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+CLIENTS = metrics.gauge('keg_stream_clients', 'Displays connected to the event stream')
+PUBLISHED = metrics.counter('keg_stream_events_total', 'Events published to the event stream', ['event'])
+DROPPED = metrics.counter('keg_stream_dropped_events_total',
+                          'Events dropped from the buffer of a client that was too slow to read them')
+
+
+class StreamClient(object):
+    """
+    A connected display and the events waiting to be written to it. The buffer is bounded, so a client
+    that stops reading loses its oldest events instead of holding up the sensors.
+    """
+    __slots__ = ('address', 'buffer', 'condition', 'closed')
+
+    def __init__(self, address, buffer_size):
+        self.address = address
+        self.buffer = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def push(self, message):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                DROPPED.inc()
+            self.buffer.append(message)
+            self.condition.notify()
+
+    def take(self, timeout):
+        """
+        Waits up to `timeout` seconds for events and returns all of them, an empty list if none came.
+        """
+        with self.condition:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            messages = list(self.buffer)
+            self.buffer.clear()
+            return messages
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class PourStream(object):
+    """
+    Server-Sent Events server broadcasting pour, temperature and weight events straight to the displays on
+    the LAN, without going through the API server and back.
+
+    `publish` serializes an event once and appends it to the buffer of every connected client, it never
+    touches a socket, so the sampling loop calling it isn't slowed down by slow or dead clients. Each client
+    has its own thread writing its buffer out as soon as an event arrives, with Nagle's algorithm disabled so
+    small events go out right away.
+
+    A display subscribes with `new EventSource('http://<pi>:8081/events')`. The last `history` events are
+    kept, and a display that reconnects with a `Last-Event-ID` gets the ones it missed.
+
+    Parameters
+    ----------
+    port<optional>: Integer
+    host<optional>: String
+        Address to listen on, all interfaces by default so the displays can connect.
+    buffer_size<optional>: Integer
+        Maximum number of events waiting to be written to a client.
+    history<optional>: Integer
+        Number of past events kept for reconnecting clients.
+    keepalive<optional>: Float
+        Seconds of silence after which a comment is sent, so proxies and clients keep the connection open.
+    send_buffer<optional>: Integer
+        Bytes the kernel may hold for a client, so a stalled one starts dropping from `buffer_size` events
+        instead of piling up in the socket.
+    """
+    def __init__(self, port=8081, host='0.0.0.0', buffer_size=256, history=64, keepalive=15.0, send_buffer=32768):
+        self.port = port
+        self.host = host
+        self.buffer_size = buffer_size
+        self.keepalive = keepalive
+        self.send_buffer = send_buffer
+
+        self.lock = threading.Lock()
+        self.clients = []
+        self.history = deque(maxlen=history)
+        self.last_id = 0
+        self.server = None
+
+        CLIENTS.bind(lambda: len(self.clients))
+
+    def publish(self, event, data):
+        """
+        Queues an event for every connected client. Never blocks on the network.
+
+        :param event: Name of the event, i.e. `pourStart`
+        :param data: JSON serializable payload. Datetimes are sent as strings.
+        """
+        payload = json.dumps(data, default=str, separators=(',', ':'))
+        with self.lock:
+            self.last_id += 1
+            message = 'id: %d\nevent: %s\ndata: %s\n\n' % (self.last_id, event, payload)
+            self.history.append((self.last_id, message))
+            clients = list(self.clients)
+        PUBLISHED.labels(event).inc()
+
+        for client in clients:
+            client.push(message)
+
+    def subscribe(self, address, last_id=None):
+        """
+        Registers a client, queueing the events it missed since `last_id`.
+        """
+        client = StreamClient(address, self.buffer_size)
+        with self.lock:
+            if last_id is not None:
+                for event_id, message in self.history:
+                    if event_id > last_id:
+                        client.buffer.append(message)
+            self.clients.append(client)
+        logging.info("\n\t%s subscribed to the pour stream" % (address,))
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def stream(self, client, wfile):
+        """
+        Writes the events of a client to its connection until it goes away.
+        """
+        while not client.closed:
+            messages = client.take(self.keepalive)
+            if client.closed:
+                return
+            wfile.write((''.join(messages) if messages else ':\n\n').encode('utf-8'))
+            wfile.flush()
+
+    def start(self):
+        """
+        Starts serving from a daemon thread.
+        """
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        except ImportError:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+
+        stream = self
+
+        class StreamHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/events':
+                    self.send_error(404)
+                    return
+
+                last_id = self.headers.get('Last-Event-ID')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, stream.send_buffer)
+
+                client = stream.subscribe(self.client_address,
+                                          int(last_id) if last_id and last_id.isdigit() else None)
+                try:
+                    stream.stream(client, self.wfile)
+                except (socket.error, IOError):
+                    pass
+                finally:
+                    stream.unsubscribe(client)
+                    logging.info("\n\t%s left the pour stream" % (self.client_address,))
+
+            # A display going away leaves unsent data behind, so don't let the final flushes complain
+            def handle(self):
+                try:
+                    BaseHTTPRequestHandler.handle(self)
+                except (socket.error, IOError):
+                    pass
+
+            def finish(self):
+                try:
+                    BaseHTTPRequestHandler.finish(self)
+                except (socket.error, IOError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        class StreamServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = StreamServer((self.host, self.port), StreamHandler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever, name='pour-stream')
+        thread.daemon = True
+        thread.start()
+        logging.info("\n\tstreaming pours on http://%s:%s/events" % (self.host, self.port))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
@@ -0,0 +1,176 @@
+import logging
+import threading
+from collections import deque
+
+import metrics
+from flowmeter import LOOP_PASSES, LOOP_RATE
+from gpio_backend import get_gpio, monotonic_ms
+
+STALLS = metrics.counter('keg_sampler_stalls_total',
+                         'Polling passes that came later than the max pass gap after the previous one, during '
+                         'which a pulse may have been missed', ['loop'])
+EDGE_BACKLOG = metrics.gauge('keg_edge_queue_depth', 'Edges captured by the GPIO callbacks and not yet sampled')
+
+
+class Tap(object):
+    """
+    Compact record of a tap the manager is sampling: the flowmeter that owns the pour logic plus the
+    last level seen on its pin when polling.
+    """
+    __slots__ = ('pin', 'meter', 'level')
+
+    def __init__(self, meter):
+        self.pin = meter.pin
+        self.meter = meter
+        self.level = False
+
+
+class TapManager(threading.Thread):
+    """
+    Samples every configured flowmeter from a single thread, so adding taps doesn't add threads
+    fighting over the GIL.
+
+    Parameters
+    ----------
+    meters: List of FlowMeter
+        The flowmeters to sample. They are not started as threads, the manager feeds their pour logic.
+    capture<optional>: String
+        `edge` (default) registers a GPIO callback per pin that pushes pulse timestamps onto one shared
+        queue, `poll` reads every pin once per scheduler pass.
+    gpio<optional>: GPIO backend
+        The module/object providing the `RPi.GPIO` API. Defaults to `gpio_backend.get_gpio()`.
+    connect<optional>: Boolean
+        Whether to authenticate and open the socket connection of each flowmeter on startup.
+    maxPassGap<optional>: Integer
+        Milliseconds between two polling passes above which the pass is counted as a stall. A flowmeter
+        at full flow pulses every few milliseconds, so a longer gap may swallow a pulse.
+    """
+    def __init__(self, meters, capture='edge', gpio=None, connect=True, maxPassGap=2):
+        super(TapManager, self).__init__()
+        self.capture = capture
+        self.gpio = gpio if gpio is not None else get_gpio()
+        self.connectMeters = connect
+
+        self.taps = [Tap(meter) for meter in meters]
+        self.tapsByPin = dict((tap.pin, tap) for tap in self.taps)
+
+        # (pin, timestamp) pairs pushed by the GPIO callback thread
+        self.edges = deque()
+        self.edgeEvent = threading.Event()
+        self.running = True
+
+        # Number of scheduler passes, exposed for benchmarking the sampling rate
+        self.passes = 0
+        self.maxPassGap = maxPassGap
+        self.stalls = 0
+
+        loop = 'tap-manager'
+        LOOP_PASSES.labels(loop).bind(lambda: self.passes)
+        LOOP_RATE.labels(loop).bind(metrics.rate_of(lambda: self.passes))
+        STALLS.labels(loop).bind(lambda: self.stalls)
+        EDGE_BACKLOG.bind(lambda: len(self.edges))
+
+        # A pour ends after the shortest timeout of all the taps
+        self.pourTimeout = min([tap.meter.POUR_TIMEOUT for tap in self.taps] or [3000])
+
+    def run(self):
+        self.startup()
+
+    def startup(self):
+        """
+        Sets up all the pins, connects the flowmeters in the background and starts the scheduler loop.
+        """
+        gpio = self.gpio
+        gpio.setmode(gpio.BCM)
+
+        for tap in self.taps:
+            gpio.setup(tap.pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+            if self.capture == 'edge':
+                gpio.add_event_detect(tap.pin, gpio.RISING, callback=self.onEdge)
+            tap.level = bool(gpio.input(tap.pin))
+
+        # Pours can be captured right away, a slow or unreachable API only delays streaming and posting
+        if self.connectMeters:
+            connector = threading.Thread(target=self.connect, name='tap-connect')
+            connector.daemon = True
+            connector.start()
+
+        logging.info("\n\twe're ready to pour on %s taps!" % len(self.taps))
+
+        if self.capture == 'edge':
+            self.edgeLoop()
+        else:
+            self.pollLoop()
+
+    def connect(self):
+        for tap in self.taps:
+            try:
+                tap.meter.connect()
+            except Exception as e:
+                logging.error("\n\tCould not connect the flowmeter of keg %s" % tap.meter.kegId)
+                logging.error(e)
+
+    def stop(self):
+        """
+        Makes the scheduler loop return after its current pass.
+        """
+        self.running = False
+        self.edgeEvent.set()
+
+    def onEdge(self, channel, timestamp=None):
+        """
+        GPIO event callback shared by every pin. It only queues the pulse for the scheduler thread.
+
+        :param timestamp: Kernel timestamp of the edge in nanoseconds on the monotonic clock, from backends
+            that have one. Otherwise the pulse is timestamped now.
+        """
+        self.edges.append((channel, timestamp / 1000000.0 if timestamp is not None else monotonic_ms()))
+        self.edgeEvent.set()
+
+    def edgeLoop(self):
+        """
+        Drains the shared edge queue into the pour state of each tap. Sleeps while no tap is pouring.
+        """
+        taps = self.tapsByPin
+        edges = self.edges
+        while self.running:
+            pouring = any(tap.meter.pour.pouring for tap in self.taps)
+            self.edgeEvent.wait(self.pourTimeout / 1000.0 if pouring else None)
+            self.edgeEvent.clear()
+            self.passes += 1
+
+            while edges:
+                pin, timestamp = edges.popleft()
+                taps[pin].meter.recordPulse(timestamp)
+
+            self.checkPourEnds(monotonic_ms())
+
+    def pollLoop(self):
+        """
+        Reads every pin once per pass and feeds rising edges into the pour state of each tap.
+        """
+        taps = self.taps
+        read = self.gpio.input
+        lastTime = monotonic_ms()
+        while self.running:
+            currentTime = monotonic_ms()
+            if currentTime - lastTime > self.maxPassGap:
+                self.stalls += 1
+            lastTime = currentTime
+
+            for tap in taps:
+                level = bool(read(tap.pin))
+                if level != tap.level:
+                    tap.level = level
+                    if level:
+                        tap.meter.recordPulse(currentTime)
+            self.passes += 1
+
+            # Checking for finished pours is far cheaper than the pin reads, but there's no point
+            # in doing it on every pass
+            if self.passes & 0xff == 0:
+                self.checkPourEnds(currentTime)
+
+    def checkPourEnds(self, currentTime):
+        for tap in self.taps:
+            tap.meter.checkPourEnd(currentTime)
@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import delivery
+from delivery import DeliveryQueue
+from journal import Journal
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Clock(object):
+    """
+    Stands in for the `time` module in `delivery`, recording the backoff sleeps instead of sleeping.
+    """
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class NoJitter(object):
+    @staticmethod
+    def uniform(low, high):
+        return high
+
+
+class Flaky(object):
+    """
+    Fails the first `failures` calls, then returns the records in `rejected` as undelivered once.
+    """
+    def __init__(self, failures=0, rejected=()):
+        self.failures = failures
+        self.rejected = list(rejected)
+        self.calls = []
+
+    def __call__(self, records):
+        self.calls.append(list(records))
+        if len(self.calls) <= self.failures:
+            raise IOError('API unreachable')
+        undelivered, self.rejected = [record for record in records if record in self.rejected], []
+        return undelivered
+
+
+class DeliveryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.original = delivery.time, delivery.random
+        delivery.time, delivery.random = self.clock, NoJitter
+
+    def tearDown(self):
+        delivery.time, delivery.random = self.original
+
+    def batch(self, records, journal_ids=None):
+        return [(time.time(), record, journal_id)
+                for record, journal_id in zip(records, journal_ids or [None] * len(records))]
+
+    def test_retries_with_exponential_backoff(self):
+        send = Flaky(failures=4)
+        queue = DeliveryQueue(send, backoff=1.0, max_backoff=5.0)
+        queue.running = True
+        queue.deliver(self.batch([{'volume': 12}]))
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0, 5.0])
+        self.assertEqual(len(send.calls), 5)
+        self.assertEqual((queue.delivered, queue.retries, queue.failed), (1, 4, 0))
+
+    def test_gives_up_after_max_retries(self):
+        queue = DeliveryQueue(Flaky(failures=100), max_retries=2)
+        queue.running = True
+        queue.deliver(self.batch([{'volume': 12}, {'volume': 8}]))
+        self.assertEqual((queue.delivered, queue.retries, queue.failed), (0, 2, 2))
+
+    def test_only_retries_the_undelivered_records(self):
+        first, second = {'volume': 12}, {'volume': 8}
+        send = Flaky(rejected=[second])
+        queue = DeliveryQueue(send)
+        queue.running = True
+        queue.deliver(self.batch([first, second]))
+        self.assertEqual(send.calls, [[first, second], [second]])
+        self.assertEqual((queue.delivered, queue.retries), (2, 1))
+
+    def test_acknowledges_what_was_delivered(self):
+        directory = tempfile.mkdtemp()
+        journal = Journal(os.path.join(directory, 'journal.db'))
+        try:
+            first, second = {'volume': 12}, {'volume': 8}
+            ids = journal.append_many('pour-1', [first, second])
+            queue = DeliveryQueue(Flaky(failures=1, rejected=[second]), journal=journal, kind='pour-1',
+                                  max_retries=1)
+            queue.running = True
+            queue.inflight.update(ids)
+            queue.deliver(self.batch([first, second], ids))
+
+            # The rejected record stays in the journal for a replay
+            self.assertEqual(journal.pending('pour-1'), [(ids[1], second)])
+            self.assertEqual(queue.inflight, set())
+            self.assertTrue(queue.backlog)
+        finally:
+            journal.close()
+            shutil.rmtree(directory)
+
+    def test_drops_the_oldest_record_when_full(self):
+        queue = DeliveryQueue(Flaky(), maxsize=2)
+        self.assertTrue(queue.put({'volume': 1}))
+        self.assertTrue(queue.put({'volume': 2}))
+        self.assertFalse(queue.put({'volume': 3}))
+        self.assertEqual([item[1] for item in queue.records], [{'volume': 2}, {'volume': 3}])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_workers_send_in_batches(self):
+        delivery.time = time
+        send = Flaky()
+        queue = DeliveryQueue(send, batch_size=3, linger_time=0.2)
+        for volume in range(5):
+            queue.put({'volume': volume})
+        queue.start()
+        self.assertTrue(wait_for(lambda: queue.delivered == 5))
+        queue.stop(1)
+        self.assertEqual([len(call) for call in send.calls], [3, 2])
+        self.assertEqual(queue.stats()['depth'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
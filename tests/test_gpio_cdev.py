@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gpio_cdev
+from gpio_cdev import CdevGPIO, GpioChip
+from simulation import FakeChip
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class RecordingChip(FakeChip):
+    """
+    A fake chip that also keeps every configuration of a line, debounce period included.
+    """
+    def __init__(self):
+        super(RecordingChip, self).__init__()
+        self.configs = []
+
+    def request(self, offset, flags, value=None, debounce_us=0, consumer=''):
+        fd = super(RecordingChip, self).request(offset, flags, value, debounce_us, consumer)
+        self.configs.append((offset, flags, value, debounce_us))
+        return fd
+
+    def configure(self, fd, flags, value=None, debounce_us=0):
+        super(RecordingChip, self).configure(fd, flags, value, debounce_us)
+        self.configs.append((self.offsets[fd], flags, value, debounce_us))
+
+
+class PackingTest(unittest.TestCase):
+    def test_struct_sizes_match_the_uapi(self):
+        # sizeof() of the linux/gpio.h v2 structs
+        self.assertEqual(gpio_cdev.EVENT.size, 48)
+        self.assertEqual(gpio_cdev.ATTRIBUTE.size, 24)
+        self.assertEqual(gpio_cdev.CONFIG_SIZE, 272)
+        self.assertEqual(gpio_cdev.REQUEST_SIZE, 592)
+        self.assertEqual(gpio_cdev.GET_LINE_IOCTL, 0xc250b407)
+
+    def test_config_with_output_value_and_debounce(self):
+        flags = gpio_cdev.FLAG_OUTPUT
+        config = gpio_cdev.pack_config(flags, value=1, debounce_us=5000)
+        self.assertEqual(len(config), gpio_cdev.CONFIG_SIZE)
+        self.assertEqual(gpio_cdev.CONFIG.unpack_from(config), (flags, 2))
+
+        first = gpio_cdev.ATTRIBUTE.unpack_from(config, gpio_cdev.CONFIG.size)
+        self.assertEqual((first[0], struct.unpack('=Q', first[2])[0], first[3]), (gpio_cdev.ATTR_OUTPUT_VALUES, 1, 1))
+        second = gpio_cdev.ATTRIBUTE.unpack_from(config, gpio_cdev.CONFIG.size + gpio_cdev.ATTRIBUTE.size)
+        self.assertEqual((second[0], struct.unpack('=I4x', second[2])[0], second[3]),
+                         (gpio_cdev.ATTR_DEBOUNCE, 5000, 1))
+
+    def test_config_without_attributes(self):
+        config = gpio_cdev.pack_config(gpio_cdev.FLAG_INPUT)
+        self.assertEqual(gpio_cdev.CONFIG.unpack_from(config), (gpio_cdev.FLAG_INPUT, 0))
+        self.assertEqual(config[gpio_cdev.CONFIG.size:], b'\0' * (gpio_cdev.CONFIG_SIZE - gpio_cdev.CONFIG.size))
+
+    def test_line_request(self):
+        calls = []
+
+        def ioctl(fd, request, buffer, mutate):
+            calls.append((request, bytes(buffer)))
+            # The kernel hands back the line's file descriptor in the request
+            gpio_cdev.REQUEST_TAIL.pack_into(buffer, gpio_cdev.REQUEST_HEAD.size + gpio_cdev.CONFIG_SIZE, 1, 16, 42)
+
+        original = gpio_cdev.fcntl.ioctl
+        gpio_cdev.fcntl.ioctl = ioctl
+        chip = GpioChip(os.devnull, event_buffer=16)
+        try:
+            flags = gpio_cdev.FLAG_INPUT | gpio_cdev.FLAG_BIAS_PULL_UP | gpio_cdev.FLAG_EDGE_RISING
+            self.assertEqual(chip.request(17, flags, debounce_us=2000, consumer='taps'), 42)
+        finally:
+            gpio_cdev.fcntl.ioctl = original
+            chip.close()
+
+        (request, data), = calls
+        self.assertEqual(request, gpio_cdev.GET_LINE_IOCTL)
+        self.assertEqual(len(data), gpio_cdev.REQUEST_SIZE)
+        head = gpio_cdev.REQUEST_HEAD.unpack_from(data)
+        self.assertEqual(head[0], 17)
+        self.assertEqual(head[-1].rstrip(b'\0'), b'taps')
+        config = data[gpio_cdev.REQUEST_HEAD.size:gpio_cdev.REQUEST_HEAD.size + gpio_cdev.CONFIG_SIZE]
+        self.assertEqual(config, gpio_cdev.pack_config(flags, debounce_us=2000))
+        tail = gpio_cdev.REQUEST_TAIL.unpack_from(data, gpio_cdev.REQUEST_HEAD.size + gpio_cdev.CONFIG_SIZE)
+        self.assertEqual(tail[:2], (1, 16))
+
+
+class CdevGPIOTest(unittest.TestCase):
+    def setUp(self):
+        self.chip = RecordingChip()
+        self.gpio = CdevGPIO(self.chip)
+        self.gpio.setmode(CdevGPIO.BCM)
+
+    def tearDown(self):
+        self.gpio.cleanup()
+
+    def test_setup_requests_the_line(self):
+        self.gpio.setup(17, CdevGPIO.IN, pull_up_down=CdevGPIO.PUD_UP)
+        self.gpio.setup(27, CdevGPIO.OUT, initial=CdevGPIO.HIGH)
+        self.assertEqual(self.chip.configs, [
+            (17, gpio_cdev.FLAG_INPUT | gpio_cdev.FLAG_BIAS_PULL_UP, None, 0),
+            (27, gpio_cdev.FLAG_OUTPUT, CdevGPIO.HIGH, 0)])
+        self.assertEqual(self.gpio.input(17), 1)
+
+        self.gpio.output(27, False)
+        self.assertEqual(self.gpio.input(27), 0)
+
+    def test_edges_carry_kernel_timestamps(self):
+        edges = []
+        self.gpio.setup(17, CdevGPIO.IN, pull_up_down=CdevGPIO.PUD_UP)
+        self.gpio.add_event_detect(17, CdevGPIO.RISING, callback=lambda channel, timestamp:
+                                   edges.append((channel, timestamp)))
+        # Delivered at once, as if the process had been descheduled while the pulses came in
+        self.chip.pulses(17, 3, 100.0, started=1000000000)
+
+        self.assertTrue(wait_for(lambda: len(edges) == 3))
+        self.assertEqual(edges, [(17, 1000000000), (17, 1010000000), (17, 1020000000)])
+        self.assertTrue(self.gpio.event_detected(17))
+        self.assertFalse(self.gpio.event_detected(17))
+        self.assertEqual(self.gpio.lost, 0)
+
+    def test_counts_edges_dropped_by_the_kernel(self):
+        edges = []
+        self.gpio.setup(17, CdevGPIO.IN)
+        self.gpio.add_event_detect(17, CdevGPIO.RISING, callback=lambda channel, timestamp: edges.append(timestamp))
+        line = self.gpio.lines[17]
+        data = b''.join(gpio_cdev.EVENT.pack(timestamp, gpio_cdev.EVENT_RISING_EDGE, 17, seqno, seqno)
+                        for timestamp, seqno in ((10, 1), (20, 2), (50, 5)))
+        self.gpio.dispatch(line, data)
+        self.assertEqual(edges, [10, 20, 50])
+        self.assertEqual(self.gpio.lost, 2)
+
+    def test_debounce_is_configured_on_the_line(self):
+        self.gpio.setup(17, CdevGPIO.IN, pull_up_down=CdevGPIO.PUD_UP)
+        self.gpio.add_event_detect(17, CdevGPIO.BOTH, callback=lambda channel, timestamp: None, bouncetime=5)
+        flags = gpio_cdev.FLAG_INPUT | gpio_cdev.FLAG_BIAS_PULL_UP
+        self.assertEqual(self.chip.configs[-1],
+                         (17, flags | gpio_cdev.FLAG_EDGE_RISING | gpio_cdev.FLAG_EDGE_FALLING, None, 5000))
+
+        self.gpio.remove_event_detect(17)
+        self.assertEqual(self.chip.configs[-1], (17, flags, None, 0))
+
+    def test_conflicting_edge_detection(self):
+        self.gpio.setup(17, CdevGPIO.IN)
+        self.gpio.add_event_detect(17, CdevGPIO.RISING)
+        self.assertRaises(RuntimeError, self.gpio.add_event_detect, 17, CdevGPIO.FALLING)
+        self.assertRaises(RuntimeError, self.gpio.input, 18)
+
+    def test_cleanup_releases_the_lines(self):
+        self.gpio.setup(17, CdevGPIO.IN)
+        self.gpio.setup(27, CdevGPIO.OUT)
+        self.gpio.add_event_detect(17, CdevGPIO.RISING, callback=lambda channel, timestamp: None)
+        thread = self.gpio.thread
+
+        self.gpio.cleanup(27)
+        self.assertEqual(sorted(self.chip.lines), [17])
+
+        self.gpio.cleanup()
+        self.assertEqual(self.chip.lines, {})
+        self.assertEqual(self.gpio.lines, {})
+        self.assertFalse(thread.is_alive())
+        # A released line can be requested again
+        self.gpio.setup(17, CdevGPIO.IN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gpio_backend import SimulatedGPIO
+from gpio_mcp23017 import ExpanderGPIO, GPINTEN, GPPU, IODIR, IOCON, IOCON_MIRROR, IOCON_ODR, OLAT
+from simulation import FakeI2CBus
+
+INTERRUPT = 17
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class RecordingBus(FakeI2CBus):
+    """
+    A fake bus that also keeps every register write, as (address, register, bytes).
+    """
+    def __init__(self):
+        super(RecordingBus, self).__init__(clock=None)
+        self.writes = []
+
+    def write_i2c_block_data(self, address, register, data):
+        self.writes.append((address, register, list(data)))
+        super(RecordingBus, self).write_i2c_block_data(address, register, data)
+
+    def last_write(self, address, register):
+        return [data for written, target, data in self.writes if (written, target) == (address, register)][-1]
+
+
+class ExpanderGPIOTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = RecordingBus()
+        self.chips = [self.bus.add_mcp23017(0x20), self.bus.add_mcp23017(0x21)]
+        self.native = SimulatedGPIO()
+        self.bus.interrupt(self.native, INTERRUPT)
+        self.gpio = ExpanderGPIO(self.native, self.bus, addresses=[0x20, 0x21], interrupt=INTERRUPT, base=100,
+                                 poll_interval=1.0)
+        self.gpio.setmode(ExpanderGPIO.BCM)
+
+    def tearDown(self):
+        self.gpio.cleanup()
+
+    def test_reset_mirrors_open_drain_interrupts(self):
+        for address in (0x20, 0x21):
+            self.assertEqual(self.bus.last_write(address, IOCON), [IOCON_MIRROR | IOCON_ODR])
+            self.assertEqual(self.bus.last_write(address, IODIR), [0xff, 0xff])
+            self.assertEqual(self.bus.last_write(address, GPINTEN), [0, 0])
+
+    def test_setup_writes_direction_and_pullups(self):
+        self.gpio.setup(109, ExpanderGPIO.IN, pull_up_down=ExpanderGPIO.PUD_UP)
+        self.assertEqual(self.bus.last_write(0x20, GPPU), [0x00, 0x02])
+        self.assertEqual(self.bus.last_write(0x20, IODIR), [0xff, 0xff])
+
+        self.gpio.setup(102, ExpanderGPIO.OUT, initial=ExpanderGPIO.HIGH)
+        self.assertEqual(self.bus.last_write(0x20, OLAT), [0x04, 0x00])
+        self.assertEqual(self.bus.last_write(0x20, IODIR), [0xfb, 0xff])
+        self.assertEqual(self.bus.last_write(0x20, GPPU), [0x00, 0x02])
+        self.assertRaises(ValueError, self.gpio.setup, 103, ExpanderGPIO.IN, pull_up_down=ExpanderGPIO.PUD_DOWN)
+
+    def test_event_detection_enables_the_interrupt(self):
+        self.gpio.setup(109, ExpanderGPIO.IN, pull_up_down=ExpanderGPIO.PUD_UP)
+        self.gpio.add_event_detect(109, ExpanderGPIO.RISING, callback=lambda channel, timestamp: None)
+        self.assertEqual(self.bus.last_write(0x20, GPINTEN), [0x00, 0x02])
+
+        self.gpio.remove_event_detect(109)
+        self.assertEqual(self.bus.last_write(0x20, GPINTEN), [0x00, 0x00])
+
+    def test_pins_are_numbered_from_base_across_chips(self):
+        self.gpio.setup(100, ExpanderGPIO.IN)
+        self.gpio.setup(115, ExpanderGPIO.IN)
+        self.gpio.setup(116, ExpanderGPIO.IN)
+        self.gpio.setup(131, ExpanderGPIO.IN, pull_up_down=ExpanderGPIO.PUD_UP)
+        self.assertEqual([(pin.chip.address, pin.bit) for channel, pin in sorted(self.gpio.pins.items())],
+                         [(0x20, 0), (0x20, 15), (0x21, 0), (0x21, 15)])
+        self.assertEqual(self.bus.last_write(0x21, GPPU), [0x00, 0x80])
+        self.assertRaises(RuntimeError, self.gpio.setup, 132, ExpanderGPIO.IN)
+
+        # Lower numbers are the Pi's own pins
+        self.gpio.setup(4, ExpanderGPIO.IN)
+        self.assertEqual(self.native.directions[4], ExpanderGPIO.IN)
+        self.assertNotIn(4, self.gpio.pins)
+
+    def test_interrupt_dispatches_to_the_pin_of_its_chip(self):
+        edges = []
+        for channel in (101, 117):
+            self.gpio.setup(channel, ExpanderGPIO.IN)
+            self.gpio.add_event_detect(channel, ExpanderGPIO.RISING, callback=lambda channel, timestamp:
+                                       edges.append(channel))
+
+        # GPB1 of the second chip has no edge detection, GPA1 is pin 117
+        self.bus.drive(0x21, 9, 1)
+        self.bus.drive(0x21, 1, 1)
+        self.assertTrue(wait_for(lambda: len(edges) == 1))
+        self.bus.drive(0x20, 1, 1)
+        self.assertTrue(wait_for(lambda: len(edges) == 2))
+        time.sleep(0.05)
+        self.assertEqual(edges, [117, 101])
+
+    def test_interrupt_reads_intcap_and_clears_it(self):
+        edges = []
+        self.gpio.setup(101, ExpanderGPIO.IN)
+        self.gpio.setup(117, ExpanderGPIO.IN)
+        self.gpio.add_event_detect(101, ExpanderGPIO.RISING, callback=lambda channel, timestamp:
+                                   edges.append((channel, timestamp)))
+        self.gpio.add_event_detect(117, ExpanderGPIO.BOTH, callback=lambda channel, timestamp:
+                                   edges.append((channel, timestamp)))
+
+        self.bus.drive(0x21, 1, 1)
+        self.assertTrue(wait_for(lambda: len(edges) == 1))
+        self.assertEqual(edges[0][0], 117)
+        self.assertTrue(wait_for(lambda: not self.chips[1].asserted()))
+        self.assertEqual(self.native.input(INTERRUPT), 1)
+
+        # A falling edge doesn't reach a rising edge callback, but does reach a pin watching both
+        self.bus.drive(0x20, 1, 1)
+        self.assertTrue(wait_for(lambda: len(edges) == 2))
+        self.bus.drive(0x20, 1, 0)
+        self.bus.drive(0x21, 1, 0)
+        self.assertTrue(wait_for(lambda: len(edges) == 3))
+        time.sleep(0.05)
+        self.assertEqual([channel for channel, timestamp in edges], [117, 101, 117])
+        self.assertTrue(self.gpio.event_detected(101))
+        self.assertEqual(self.gpio.input(117), 0)
+        self.assertEqual(self.gpio.input(101), 0)
+
+    def test_intcap_keeps_an_edge_the_port_lost_before_the_read(self):
+        edges = []
+        self.gpio.setup(100, ExpanderGPIO.IN)
+        chip = self.gpio.chips[0]
+        self.gpio.pin(100).edge = ExpanderGPIO.RISING
+        self.gpio.pin(100).callbacks.append(lambda channel, timestamp: edges.append((channel, timestamp)))
+        chip.enable(0)
+
+        # High then low again before the service thread reads the chip: only INTCAP saw the pulse
+        self.bus.drive(0x20, 0, 1)
+        self.bus.drive(0x20, 0, 0)
+        self.gpio.service(chip, interrupted=1234)
+        self.assertEqual(edges, [(100, 1234)])
+        self.assertFalse(self.chips[0].asserted())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from delivery import DeliveryQueue
+from journal import Journal
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Recorder(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    def __call__(self, records):
+        if self.fail:
+            raise IOError('API unreachable')
+        self.sent.extend(records)
+
+
+class ReplayingJournal(Journal):
+    """
+    Replays `queue` right after committing, before `write_journal` gets to queue the new records.
+    """
+    queue = None
+
+    def append_many(self, kind, records):
+        ids = super(ReplayingJournal, self).append_many(kind, records)
+        self.queue.replay()
+        return ids
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.db')
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_pending_until_acknowledged(self):
+        ids = self.journal.append_many('pour-1', [{'volume': 12}, {'volume': 8}])
+        self.journal.append('temperature', {'temperature': 38.0}, acknowledged=True)
+        self.assertEqual(self.journal.pending('pour-1'), [(ids[0], {'volume': 12}), (ids[1], {'volume': 8})])
+
+        self.journal.acknowledge(ids[:1])
+        self.assertEqual(self.journal.pending('pour-1'), [(ids[1], {'volume': 8})])
+        self.assertEqual(self.journal.pending('pour-1', exclude=ids[1:]), [])
+        self.assertEqual(self.journal.pending_count(), 1)
+
+    def test_prune_keeps_pending_records(self):
+        self.journal.append('pour-1', {'volume': 12}, acknowledged=True)
+        self.journal.append('pour-1', {'volume': 8})
+        self.assertEqual(self.journal.prune(max_age=-1), 1)
+        self.assertEqual(self.journal.pending_count(), 1)
+
+    def test_replays_after_restart(self):
+        down = DeliveryQueue(Recorder(fail=True), name='pours-1', journal=self.journal, kind='pour-1',
+                             max_retries=0)
+        down.unjournaled.extend([{'volume': 12}, {'volume': 8}])
+        down.write_journal()
+        self.journal.close()
+
+        self.journal = Journal(self.path)
+        send = Recorder()
+        queue = DeliveryQueue(send, name='pours-1', journal=self.journal, kind='pour-1', linger_time=0)
+        queue.start()
+        self.assertTrue(wait_for(lambda: self.journal.pending_count() == 0))
+        queue.stop(1)
+        self.assertEqual(send.sent, [{'volume': 12}, {'volume': 8}])
+
+    def test_queues_only_replay_their_kind(self):
+        self.journal.append('pour-1', {'kegid': 1, 'volume': 12})
+        first, second = Recorder(), Recorder()
+        queues = [DeliveryQueue(first, name='pours-1', journal=self.journal, kind='pour-1', linger_time=0),
+                  DeliveryQueue(second, name='pours-2', journal=self.journal, kind='pour-2', linger_time=0)]
+        for queue in queues:
+            queue.start()
+        self.assertTrue(wait_for(lambda: self.journal.pending_count() == 0))
+        for queue in queues:
+            queue.stop(1)
+        self.assertEqual(first.sent, [{'kegid': 1, 'volume': 12}])
+        self.assertEqual(second.sent, [])
+
+    def test_replays_records_given_up_on(self):
+        send = Recorder(fail=True)
+        queue = DeliveryQueue(send, name='pours-1', journal=self.journal, kind='pour-1', linger_time=0,
+                              max_retries=0, replay_interval=0.05)
+        queue.start()
+        queue.put({'volume': 12})
+        self.assertTrue(wait_for(lambda: queue.failed == 1))
+
+        send.fail = False
+        self.assertTrue(wait_for(lambda: self.journal.pending_count() == 0))
+        queue.stop(1)
+        self.assertEqual(send.sent, [{'volume': 12}])
+
+    def test_replay_while_journaling_queues_once(self):
+        self.journal.close()
+        self.journal = ReplayingJournal(self.path)
+        queue = DeliveryQueue(Recorder(), name='pours-1', journal=self.journal, kind='pour-1')
+        self.journal.queue = queue
+        # A backlog makes workers replay, here it happens between the commit and the queueing
+        queue.backlog = True
+
+        queue.unjournaled.append({'volume': 12})
+        queue.write_journal()
+        self.assertEqual([item[1:] for item in queue.records], [({'volume': 12}, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pour import OUNCES_PER_LITER, PourState
+
+
+def pour(state, count, period, started=1000.0):
+    """
+    Feeds `count` pulses `period` milliseconds apart, returning the time of the last one.
+    """
+    for i in range(count):
+        state.pulse(started + i * period)
+    return started + (count - 1) * period
+
+
+class PourStateTest(unittest.TestCase):
+    def test_volume_from_pulses_and_k_factor(self):
+        state = PourState(1, kFactor=450.0)
+        pour(state, 450, 10.0)
+        self.assertAlmostEqual(state.volume(), OUNCES_PER_LITER)
+
+        state = PourState(1, kFactor=5600.0)
+        pour(state, 2800, 1.0)
+        self.assertAlmostEqual(state.volume(), OUNCES_PER_LITER / 2)
+
+    def test_first_pulse_starts_a_pour(self):
+        state = PourState(1)
+        self.assertTrue(state.pulse(1000.0))
+        self.assertFalse(state.pulse(1010.0))
+        self.assertFalse(state.expired(4000.0))
+        self.assertTrue(state.expired(4011.0))
+
+    def test_duration_skips_long_gaps(self):
+        state = PourState(1, maxGap=1000)
+        last = pour(state, 101, 20.0)
+        # A pause longer than maxGap, then the pour goes on
+        pour(state, 51, 20.0, started=last + 5000)
+        self.assertAlmostEqual(state.duration(), 3.0)
+
+    def test_duration_and_flow_rate_across_folds(self):
+        state = PourState(1, kFactor=450.0, capacity=64)
+        # 7.5 liters per minute, 56.25 pulses per second
+        period = 60000.0 / (7.5 * 450)
+        pour(state, 980, period)
+        self.assertAlmostEqual(state.duration(), 979 * period / 1000)
+        self.assertAlmostEqual(state.flowRate(), 7.5)
+        # The window wraps around to the pulses from before the last fold
+        self.assertLess(state.index, 32)
+        self.assertAlmostEqual(state.flowRate(window=60), 7.5)
+
+    def test_flow_rate_needs_two_pulses(self):
+        state = PourState(1)
+        self.assertEqual(state.flowRate(), 0.0)
+        state.pulse(1000.0)
+        self.assertEqual(state.flowRate(), 0.0)
+
+    def test_finish_returns_the_pour_and_resets(self):
+        state = PourState(7, kFactor=450.0)
+        pour(state, 225, 10.0)
+        finished = state.finish()
+        self.assertEqual(finished['kegid'], 7)
+        self.assertAlmostEqual(finished['volume'], OUNCES_PER_LITER / 2)
+        self.assertAlmostEqual(finished['duration'], 2.24)
+        self.assertLessEqual(finished['pourstart'], finished['pourend'])
+        self.assertFalse(state.pouring)
+
+        # The next pulse starts a new pour from scratch
+        self.assertTrue(state.pulse(90000.0))
+        self.assertEqual(state.pulses, 1)
+        self.assertEqual(state.duration(), 0.0)
+
+    def test_finish_discards_false_positives(self):
+        state = PourState(1, kFactor=450.0, minOunces=0.2)
+        pour(state, 2, 10.0)
+        self.assertIsNone(state.finish())
+        self.assertFalse(state.pouring)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from simulation import FakeW1Bus
+from TemperatureMonitor.w1bus import W1BusScanner, conversion_time, parse_w1_slave
+
+
+class W1BusScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = FakeW1Bus()
+        self.first = self.bus.add_probe(temperature=3.5)
+        self.second = self.bus.add_probe(temperature=18.25)
+
+    def tearDown(self):
+        self.bus.cleanup()
+
+    def scanner(self, **kwargs):
+        # 9 bits keeps the conversion wait of a sweep short
+        kwargs.setdefault('resolution', 9)
+        return W1BusScanner(self.bus.basepath, **kwargs)
+
+    def test_lists_the_probes_not_the_master(self):
+        devices = self.scanner().devices()
+        self.assertEqual([os.path.basename(device) for device in devices], [self.first, self.second])
+
+    def test_bulk_sweep_reads_every_probe(self):
+        scanner = self.scanner()
+        self.assertEqual(scanner.scan(), {self.first: 3.5, self.second: 18.25})
+
+        with open(os.path.join(self.bus.master, 'therm_bulk_read')) as f:
+            self.assertEqual(f.read(), 'trigger')
+
+    def test_sweep_without_bulk_reads_w1_slave(self):
+        self.bus.cleanup()
+        self.bus = FakeW1Bus(bulk=False)
+        probe = self.bus.add_probe(temperature=-1.5)
+        self.assertEqual(self.scanner().scan(), {probe: -1.5})
+
+    def test_crc_failure_is_none(self):
+        self.bus.set_temperature(self.second, 20.0, crc_ok=False)
+        scanner = self.scanner()
+        self.assertEqual(scanner.scan(), {self.first: 3.5, self.second: None})
+        self.assertEqual(scanner.crc_failures, 1)
+
+        self.bus.cleanup()
+        self.bus = FakeW1Bus(bulk=False)
+        probe = self.bus.add_probe()
+        self.bus.set_temperature(probe, 20.0, crc_ok=False)
+        self.assertEqual(self.scanner().scan(), {probe: None})
+
+    def test_configure_writes_the_resolution(self):
+        scanner = self.scanner(resolution=10, resolutions={self.second: 11})
+        scanner.configure()
+        for probe, resolution in ((self.first, '10'), (self.second, '11')):
+            with open(os.path.join(self.bus.basepath, probe, 'resolution')) as f:
+                self.assertEqual(f.read(), resolution)
+
+    def test_configure_rejects_invalid_resolution(self):
+        self.assertRaises(ValueError, self.scanner(resolution=13).configure)
+
+    def test_conversion_time_halves_per_bit(self):
+        self.assertEqual(conversion_time(12), 0.75)
+        self.assertEqual(conversion_time(9), 0.75 / 8)
+
+    def test_parse_w1_slave(self):
+        lines = ['72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n', '72 01 4b 46 7f ff 0e 10 57 t=23125\n']
+        self.assertEqual(parse_w1_slave(lines), 23.125)
+        self.assertIsNone(parse_w1_slave([lines[0].replace('YES', 'NO'), lines[1]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
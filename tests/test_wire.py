@@ -0,0 +1,98 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wire
+
+
+class Request(object):
+    def __init__(self, body):
+        self.body = body
+
+
+class Response(object):
+    def __init__(self, status_code=200, headers=None, body=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.request = Request(body)
+
+
+ADVERTISED = {'Accept-Post': '%s, application/json' % wire.MEDIA_TYPE}
+
+
+class EncodingTest(unittest.TestCase):
+    def test_pours_round_trip(self):
+        pours = [{'kegid': 2, 'volume': 12.346, 'duration': 5.5, 'pourstart': '2026-10-16 16:00:00.250000-07:00',
+                  'pourend': '2026-10-16 16:00:08.750000-07:00'},
+                 {'kegid': 1, 'volume': 8.0, 'duration': 3.25, 'pourstart': '2026-10-16T23:05:00.000Z',
+                  'pourend': '2026-10-16T23:05:04.000Z'}]
+        decoded = wire.decode_pours(wire.encode_pours(pours))
+
+        self.assertEqual([pour['kegid'] for pour in decoded], [2, 1])
+        self.assertEqual([pour['volume'] for pour in decoded], [12.35, 8.0])
+        self.assertEqual([pour['duration'] for pour in decoded], [5.5, 3.25])
+        self.assertEqual(decoded[0]['pourstart'], '2026-10-16T23:00:00.250Z')
+        self.assertEqual(decoded[0]['pourend'], '2026-10-16T23:00:08.750Z')
+        self.assertEqual(decoded[1]['pourstart'], '2026-10-16T23:05:00.000Z')
+
+    def test_temperatures_round_trip(self):
+        readings = [{'name': 'a', 'temperature': 38.1125, 'created_on': datetime(2026, 10, 16, 16, 0, 0, 123000)},
+                    {'name': 'b', 'temperature': 36.0, 'created_on': datetime(2026, 10, 16, 16, 0, 0, 500000)},
+                    {'name': 'a', 'temperature': 37.9, 'created_on': datetime(2026, 10, 16, 16, 0, 10, 100000)}]
+        decoded = wire.decode_temperatures(wire.encode_temperatures(readings))
+
+        self.assertEqual([(r['name'], r['temperature']) for r in decoded], [('a', 38.11), ('a', 37.9), ('b', 36.0)])
+        self.assertEqual([wire.to_millis(r['created_on']) for r in decoded],
+                         [wire.to_millis(readings[i]['created_on']) for i in (0, 2, 1)])
+
+    def test_rejects_other_payloads(self):
+        self.assertRaises(wire.WireError, wire.decode_pours, b'{"kegid": 1}')
+        self.assertRaises(wire.WireError, wire.decode_temperatures, wire.encode_pours([]))
+        self.assertRaises(wire.WireError, wire.decode_pours, wire.encode_pours([{
+            'kegid': 1, 'volume': 1.0, 'duration': 1.0, 'pourstart': 0, 'pourend': 1}])[:-1])
+
+
+class NegotiationTest(unittest.TestCase):
+    def test_auto_waits_for_the_advertisement(self):
+        negotiation = wire.Negotiation()
+        self.assertFalse(negotiation.compact())
+        self.assertTrue(negotiation.observe(Response(), 'pour', 'form', 1))
+        self.assertFalse(negotiation.compact())
+        negotiation.observe(Response(headers=ADVERTISED), 'pour', 'form', 1)
+        self.assertTrue(negotiation.compact())
+
+    def test_rejection_backs_off_then_retries(self):
+        negotiation = wire.Negotiation(retry_after=60)
+        negotiation.observe(Response(headers=ADVERTISED), 'pour', 'form', 1)
+
+        self.assertFalse(negotiation.observe(Response(415), 'pour', 'compact', 1))
+        self.assertFalse(negotiation.compact())
+        # Advertised again within retry_after, the rejection still stands
+        negotiation.observe(Response(headers=ADVERTISED), 'pour', 'form', 1)
+        self.assertFalse(negotiation.compact())
+
+        negotiation.rejected_at -= 61
+        self.assertFalse(negotiation.compact())
+        negotiation.observe(Response(headers=ADVERTISED), 'pour', 'form', 1)
+        self.assertTrue(negotiation.compact())
+        self.assertIsNone(negotiation.rejected_at)
+
+    def test_forced_modes(self):
+        forced = wire.Negotiation('compact', retry_after=60)
+        self.assertTrue(forced.compact())
+        self.assertFalse(forced.observe(Response(415), 'temperature', 'compact', 3))
+        self.assertFalse(forced.compact())
+        forced.rejected_at -= 61
+        self.assertTrue(forced.compact())
+
+        never = wire.Negotiation('json')
+        never.observe(Response(headers=ADVERTISED), 'temperature', 'json', 3)
+        self.assertFalse(never.compact())
+        self.assertRaises(ValueError, wire.Negotiation, 'msgpack')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+"""
+Local time-series store for the sensor readings, so they can be kept at full resolution on the Pi instead of
+being posted one by one or thrown away:
+
+    store = TimeSeriesStore('/var/lib/keg-server/timeseries')
+    store.append('28-0000075a8b2c', 38.2)
+    readings = store.query('28-0000075a8b2c', start=time.time() - 3600)
+    hourly = store.query('28-0000075a8b2c', resolution='hour')
+
+Every series is a set of ring files of fixed-size binary records, preallocated to their full size and
+memory-mapped: the raw readings, and one rollup per minute and per hour with the min, max, mean and count of
+the readings in the bucket. Once a ring is full the oldest records are overwritten, so the disk and memory
+used by a series never grow past the size of its files. The rollups are updated in place on every append, so
+no pass over the raw data is ever needed.
+
+Queries return numpy structured arrays that are views of the mapped files, with no copy, unless the range spans
+the point where a ring wraps around. Readings are expected to be appended in time order.
+"""
+import os
+import re
+import time
+import threading
+
+# 14 days of readings every second, 90 days of minutes and 2 years of hours
+RAW_CAPACITY = 14 * 24 * 3600
+MINUTE_CAPACITY = 90 * 24 * 60
+HOUR_CAPACITY = 2 * 365 * 24
+
+RAW_RECORD = [('time', '<f8'), ('value', '<f4')]
+ROLLUP_RECORD = [('time', '<f8'), ('min', '<f4'), ('max', '<f4'), ('mean', '<f8'), ('count', '<u4')]
+
+# Bucket width in seconds of every resolution, None for the raw readings
+RESOLUTIONS = {'raw': None, 'minute': 60, 'hour': 3600}
+
+MAGIC = b'KEGTS001'
+HEADER = [('magic', 'S8'), ('record_size', '<u4'), ('capacity', '<u8'), ('count', '<u8')]
+HEADER_SIZE = 64
+
+
+class RingFile(object):
+    """
+    A preallocated file of `capacity` fixed-size records, memory-mapped and written as a ring.
+
+    Parameters
+    ----------
+    path: String
+        Created with its full size if it doesn't exist.
+    dtype: numpy dtype description
+        Layout of a record, its first field must be the `time` of the record.
+    capacity: Integer
+        Number of records kept before the oldest ones are overwritten.
+    """
+    def __init__(self, path, dtype, capacity):
+        import numpy
+
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.capacity = capacity
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(HEADER_SIZE + capacity * self.dtype.itemsize)
+            self.header = numpy.memmap(path, HEADER, mode='r+', shape=(1,))
+            self.header[0] = (MAGIC, self.dtype.itemsize, capacity, 0)
+        else:
+            self.header = numpy.memmap(path, HEADER, mode='r+', shape=(1,))
+            magic, record_size, existing = self.header['magic'][0], self.header['record_size'][0], \
+                self.header['capacity'][0]
+            if magic != MAGIC or record_size != self.dtype.itemsize or existing != capacity:
+                raise ValueError("%s is not a ring of %d records of %d bytes" % (path, capacity,
+                                                                                self.dtype.itemsize))
+
+        self.records = numpy.memmap(path, self.dtype, mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+        # Kept in a plain attribute, the header is only written to
+        self.count = int(self.header['count'][0])
+
+    def append(self, record):
+        self.records[self.count % self.capacity] = record
+        self.count += 1
+        self.header['count'][0] = self.count
+
+    def last(self):
+        """
+        The most recent record, None if the ring is empty.
+        """
+        if not self.count:
+            return None
+        return self.records[(self.count - 1) % self.capacity]
+
+    def replace_last(self, record):
+        self.records[(self.count - 1) % self.capacity] = record
+
+    def segments(self):
+        """
+        The records in time order, as one or two views of the file.
+        """
+        if self.count <= self.capacity:
+            return [self.records[:self.count]]
+        position = self.count % self.capacity
+        return [self.records[position:], self.records[:position]]
+
+    def range(self, start=None, end=None):
+        """
+        The records with `start <= time < end`, found by bisection.
+
+        :return: A view of the file, or a copy when the range wraps around the end of the ring
+        """
+        import numpy
+
+        selected = []
+        for segment in self.segments():
+            times = segment['time']
+            low = 0 if start is None else numpy.searchsorted(times, start, 'left')
+            high = len(segment) if end is None else numpy.searchsorted(times, end, 'left')
+            if high > low:
+                selected.append(segment[low:high])
+
+        if not selected:
+            return self.records[:0]
+        if len(selected) == 1:
+            return selected[0]
+        return numpy.concatenate(selected)
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+
+
+class Rollup(object):
+    """
+    Min, max, mean and count of the readings per bucket of `width` seconds, kept in a ring file. The record
+    of the current bucket is updated in place by every reading.
+    """
+    def __init__(self, path, width, capacity):
+        self.width = width
+        self.ring = RingFile(path, ROLLUP_RECORD, capacity)
+
+        # Resume the bucket left open by the previous run
+        last = self.ring.last()
+        if last is None:
+            self.bucket = None
+        else:
+            self.bucket = float(last['time'])
+            self.min, self.max = float(last['min']), float(last['max'])
+            self.mean, self.count = float(last['mean']), int(last['count'])
+
+    def add(self, timestamp, value):
+        bucket = timestamp - timestamp % self.width
+        if bucket != self.bucket:
+            self.bucket = bucket
+            self.min = self.max = self.mean = value
+            self.count = 1
+            self.ring.append((bucket, value, value, value, 1))
+            return
+
+        self.count += 1
+        self.mean += (value - self.mean) / self.count
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.ring.replace_last((bucket, self.min, self.max, self.mean, self.count))
+
+
+class Series(object):
+    """
+    The raw readings of one sensor and their rollups, in files named after the sensor under `path`.
+    """
+    def __init__(self, path, name, capacity=RAW_CAPACITY, minute_capacity=MINUTE_CAPACITY,
+                 hour_capacity=HOUR_CAPACITY):
+        base = os.path.join(path, name)
+        self.name = name
+        self.raw = RingFile(base + '.raw', RAW_RECORD, capacity)
+        self.rollups = {
+            'minute': Rollup(base + '.1m', RESOLUTIONS['minute'], minute_capacity),
+            'hour': Rollup(base + '.1h', RESOLUTIONS['hour'], hour_capacity),
+        }
+
+    def append(self, timestamp, value):
+        value = float(value)
+        self.raw.append((timestamp, value))
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, value)
+
+    def range(self, start=None, end=None, resolution='raw'):
+        if resolution == 'raw':
+            return self.raw.range(start, end)
+        if resolution not in self.rollups:
+            raise ValueError("Unknown resolution %s, use one of %s" % (resolution, ', '.join(sorted(RESOLUTIONS))))
+        return self.rollups[resolution].ring.range(start, end)
+
+    def flush(self):
+        self.raw.flush()
+        for rollup in self.rollups.values():
+            rollup.ring.flush()
+
+
+class TimeSeriesStore(object):
+    """
+    The series of every sensor, each opened or created on first use.
+
+    Each series is meant to be appended to by a single thread, the one reading its sensor. Queries can come
+    from any thread.
+
+    Parameters
+    ----------
+    path: String
+        Directory the ring files are kept in, created if missing.
+    capacity<optional>: Integer
+        Raw readings kept per series.
+    minute_capacity<optional>: Integer
+        Minute rollups kept per series.
+    hour_capacity<optional>: Integer
+        Hour rollups kept per series.
+    """
+    def __init__(self, path, capacity=RAW_CAPACITY, minute_capacity=MINUTE_CAPACITY, hour_capacity=HOUR_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.minute_capacity = minute_capacity
+        self.hour_capacity = hour_capacity
+        self.series = {}
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, name):
+        series = self.series.get(name)
+        if series is None:
+            with self.lock:
+                series = self.series.get(name)
+                if series is None:
+                    # Sensor names end up in file names
+                    filename = re.sub(r'[^A-Za-z0-9_.-]', '_', str(name))
+                    series = self.series[name] = Series(self.path, filename, self.capacity,
+                                                        self.minute_capacity, self.hour_capacity)
+        return series
+
+    def append(self, name, value, timestamp=None):
+        """
+        Records a reading of sensor `name`.
+
+        :param timestamp: Seconds since the epoch, now by default
+        """
+        self.get(name).append(timestamp if timestamp is not None else time.time(), value)
+
+    def query(self, name, start=None, end=None, resolution='raw'):
+        """
+        The readings, or rollups, of sensor `name` with `start <= time < end`.
+
+        :param resolution: `raw`, `minute` or `hour`
+        :return: numpy structured array with a `time` and a `value` field for the raw readings, or `time`, `min`,
+            `max`, `mean` and `count` fields for the rollups
+        """
+        return self.get(name).range(start, end, resolution)
+
+    def names(self):
+        """
+        Names of the series on disk.
+        """
+        return sorted(filename[:-len('.raw')] for filename in os.listdir(self.path) if filename.endswith('.raw'))
+
+    def flush(self):
+        with self.lock:
+            series = list(self.series.values())
+        for item in series:
+            item.flush()
@@ -0,0 +1,129 @@
+import numpy
+
+
+class WeightFilter(object):
+    """
+    Streaming filter for load cell samples: outlier rejection, a running median and EMA or Kalman smoothing
+    over a numpy ring buffer, plus a detector telling when the weight has settled.
+
+    Samples are fed in one at a time with `add` as the hx711 produces them, and `value` always holds the
+    current filtered reading, so reading the weight never waits on a conversion.
+
+    All values are in raw hx711 counts.
+
+    Parameters
+    ----------
+    window<optional>: Integer
+        Number of samples the median and outlier rejection look at.
+    outlier_threshold<optional>: Float
+        Samples further than this many (MAD based) standard deviations from the median are rejected.
+    smoothing<optional>: String
+        `kalman` (default), `ema` or `none`.
+    alpha<optional>: Float
+        Weight of a new median in the EMA.
+    process_noise<optional>: Float
+        Kalman process noise, how much the real weight is expected to drift between two samples.
+    measurement_noise<optional>: Float
+        Kalman measurement noise, the variance of the hx711 readings.
+    settle_window<optional>: Integer
+        Number of filtered values that must stay within `settle_tolerance` of each other to be settled.
+    settle_tolerance<optional>: Float
+        Peak to peak spread of the filtered values below which the weight is settled.
+    """
+    def __init__(self, window=15, outlier_threshold=3.5, smoothing='kalman', alpha=0.2, process_noise=25.0,
+                 measurement_noise=2500.0, settle_window=10, settle_tolerance=100.0):
+        if smoothing not in ('kalman', 'ema', 'none'):
+            raise ValueError("Unknown smoothing `%s`" % smoothing)
+
+        self.window = window
+        self.outlier_threshold = outlier_threshold
+        self.smoothing = smoothing
+        self.alpha = alpha
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.settle_window = settle_window
+        self.settle_tolerance = settle_tolerance
+
+        self.samples = numpy.zeros(window, dtype=numpy.float64)
+        self.count = 0
+        self.history = numpy.zeros(settle_window, dtype=numpy.float64)
+        self.filtered = 0
+
+        self.value = None
+        self.variance = measurement_noise
+
+        self.rejected = 0
+        self.consecutive_rejections = 0
+
+    def reset(self):
+        self.count = 0
+        self.filtered = 0
+        self.value = None
+        self.variance = self.measurement_noise
+        self.consecutive_rejections = 0
+
+    def is_outlier(self, sample):
+        """
+        Hampel test of `sample` against the buffered samples. A run of rejections longer than half the
+        window is taken as a real change of weight (a keg put on or taken off), not noise.
+        """
+        n = min(self.count, self.window)
+        if n < 3 or self.consecutive_rejections >= self.window // 2:
+            return False
+
+        current = self.samples[:n]
+        median = numpy.median(current)
+        # 1.4826 scales the median absolute deviation to a standard deviation for normally distributed noise
+        deviation = max(numpy.median(numpy.abs(current - median)) * 1.4826, 1.0)
+        return abs(sample - median) > self.outlier_threshold * deviation
+
+    def add(self, sample):
+        """
+        Feeds a raw sample through the filter.
+
+        :return: The current filtered value
+        """
+        if self.is_outlier(sample):
+            self.rejected += 1
+            self.consecutive_rejections += 1
+            return self.value
+
+        if self.consecutive_rejections:
+            # The weight really changed, start over from the new level instead of smoothing towards it
+            if self.consecutive_rejections >= self.window // 2:
+                self.reset()
+            self.consecutive_rejections = 0
+
+        self.samples[self.count % self.window] = sample
+        self.count += 1
+        median = float(numpy.median(self.samples[:min(self.count, self.window)]))
+
+        if self.value is None or self.smoothing == 'none':
+            self.value = median
+        elif self.smoothing == 'ema':
+            self.value += self.alpha * (median - self.value)
+        else:
+            # predict, then correct with the new measurement
+            self.variance += self.process_noise
+            gain = self.variance / (self.variance + self.measurement_noise)
+            self.value += gain * (median - self.value)
+            self.variance *= 1 - gain
+
+        self.history[self.filtered % self.settle_window] = self.value
+        self.filtered += 1
+        return self.value
+
+    def extend(self, samples):
+        for sample in samples:
+            self.add(sample)
+        return self.value
+
+    @property
+    def settled(self):
+        """
+        True once the last `settle_window` filtered values are within `settle_tolerance` of each other.
+        """
+        # A run of rejected samples may be the start of a new weight
+        if self.filtered < self.settle_window or self.consecutive_rejections:
+            return False
+        return float(numpy.ptp(self.history)) <= self.settle_tolerance
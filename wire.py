@@ -0,0 +1,312 @@
+"""
+Compact binary encoding of the telemetry posted to the API, for metered uplinks:
+
+    payload = wire.encode_pours(pours)
+    client.post(url, data=payload, headers={'Content-Type': wire.MEDIA_TYPE})
+
+A payload is a batch of records of one kind:
+
+    magic       2 bytes, `KW`
+    version     1 byte, 1
+    kind        1 byte, 1 for pours, 2 for temperature readings
+    count       varint, number of records
+    body
+
+Integers are unsigned LEB128 varints, 7 bits per byte with the high bit set on every byte but the last. Signed
+values are zigzag encoded first (0, -1, 1, -2... as 0, 1, 2, 3...). Times are milliseconds since the epoch, UTC.
+
+Pours, one after the other, each field a delta from the same field of the previous pour (0 for the first):
+
+    keg id      signed
+    start       signed, milliseconds
+    end         unsigned, milliseconds after the start
+    duration    unsigned, milliseconds the flowmeter measured
+    volume      signed, hundredths of an ounce
+
+Temperature readings, as one series per probe in the order of their first reading:
+
+    name        varint length, then the UTF-8 name
+    readings    varint count
+    times       signed, milliseconds, each a delta from the previous reading of the series (0 for the first)
+    values      signed, hundredths of a degree, each a delta from the previous reading of the series
+
+In batches a pour takes ~10 bytes and a reading ~4 bytes, against ~150 and ~80 bytes as form fields or JSON
+(`benchmarks/bench_wire.py`).
+
+The API advertises the encoding with an `Accept-Post` response header listing `MEDIA_TYPE`. Until it does, or
+after it answered a compact payload with 415 Unsupported Media Type, the sensors keep posting what they always
+posted, see `Negotiation`.
+"""
+import re
+import time
+import calendar
+from datetime import datetime, timedelta
+
+import metrics
+
+BYTES = metrics.counter('keg_wire_bytes_total', 'Bytes of telemetry posted to the API by encoding',
+                        ['kind', 'format'])
+RECORDS = metrics.counter('keg_wire_records_total', 'Telemetry records posted to the API by encoding',
+                          ['kind', 'format'])
+
+MEDIA_TYPE = 'application/x-keg-wire'
+MAGIC = b'KW'
+VERSION = 1
+
+POURS = 1
+TEMPERATURES = 2
+
+EPOCH = datetime(1970, 1, 1)
+OFFSET = re.compile(r'([+-])(\d\d):?(\d\d)$')
+
+
+class WireError(ValueError):
+    """
+    Raised when a payload isn't a valid compact batch.
+    """
+    pass
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position):
+    """
+    :return: (value, position after it)
+    """
+    value = shift = 0
+    while True:
+        if position >= len(data):
+            raise WireError("Truncated varint at byte %d" % position)
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def to_millis(value):
+    """
+    Milliseconds since the epoch of a datetime (naive ones are local time), its `str()` as stored in the
+    journal, or seconds since the epoch.
+    """
+    if isinstance(value, (int, float)):
+        return int(round(value * 1000))
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return int(time.mktime(value.timetuple())) * 1000 + value.microsecond // 1000
+        return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+    text = value.strip().replace('T', ' ')
+    offset = None
+    match = OFFSET.search(text)
+    if match and len(text) > 19:
+        sign, hours, minutes = match.groups()
+        offset = (int(hours) * 60 + int(minutes)) * (1 if sign == '+' else -1)
+        text = text[:match.start()]
+    if text.endswith('Z'):
+        text, offset = text[:-1], 0
+    parsed = datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f' if '.' in text else '%Y-%m-%d %H:%M:%S')
+    if offset is None:
+        return to_millis(parsed)
+    parsed -= timedelta(minutes=offset)
+    return calendar.timegm(parsed.timetuple()) * 1000 + parsed.microsecond // 1000
+
+
+def from_millis(millis):
+    """
+    ISO 8601 UTC time of milliseconds since the epoch.
+    """
+    return (EPOCH + timedelta(milliseconds=millis)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def header(kind, count):
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(kind)
+    write_varint(out, count)
+    return out
+
+
+def read_header(data, kind):
+    data = bytearray(data)
+    if data[:2] != bytearray(MAGIC) or len(data) < 4:
+        raise WireError("Not a compact telemetry batch")
+    if data[2] != VERSION:
+        raise WireError("Unsupported version %d" % data[2])
+    if data[3] != kind:
+        raise WireError("Expected records of kind %d, got %d" % (kind, data[3]))
+    count, position = read_varint(data, 4)
+    return data, count, position
+
+
+def encode_pours(pours):
+    """
+    :param pours: Pour dictionaries, as made by `PourState.finish` or replayed from the journal
+    :return: The batch, as bytes
+    """
+    out = header(POURS, len(pours))
+    previous = [0, 0, 0, 0, 0]
+    for pour in pours:
+        start = to_millis(pour['pourstart'])
+        fields = [int(pour['kegid']), start, max(to_millis(pour['pourend']) - start, 0),
+                  int(round(pour['duration'] * 1000)), int(round(pour['volume'] * 100))]
+        for index in (0, 1, 4):
+            write_varint(out, zigzag(fields[index] - previous[index]))
+            if index == 1:
+                write_varint(out, fields[2])
+                write_varint(out, fields[3])
+        previous = fields
+    return bytes(out)
+
+
+def decode_pours(data):
+    """
+    :return: List of pour dictionaries with the keg id, volume in ounces, duration in seconds and the start
+        and end as ISO 8601 UTC times
+    """
+    data, count, position = read_header(data, POURS)
+    pours = []
+    keg = start = volume = 0
+    for _ in range(count):
+        value, position = read_varint(data, position)
+        keg += unzigzag(value)
+        value, position = read_varint(data, position)
+        start += unzigzag(value)
+        end, position = read_varint(data, position)
+        duration, position = read_varint(data, position)
+        value, position = read_varint(data, position)
+        volume += unzigzag(value)
+        pours.append({'kegid': keg, 'volume': volume / 100.0, 'duration': duration / 1000.0,
+                      'pourstart': from_millis(start), 'pourend': from_millis(start + end)})
+    return pours
+
+
+def encode_temperatures(readings):
+    """
+    :param readings: Reading dictionaries with the probe `name`, `temperature` and `created_on` time
+    :return: The batch, as bytes
+    """
+    series = {}
+    names = []
+    for reading in readings:
+        name = reading['name']
+        if name not in series:
+            series[name] = []
+            names.append(name)
+        series[name].append((to_millis(reading['created_on']), int(round(reading['temperature'] * 100))))
+
+    out = header(TEMPERATURES, len(readings))
+    write_varint(out, len(names))
+    for name in names:
+        encoded = name.encode('utf-8') if not isinstance(name, bytes) else name
+        write_varint(out, len(encoded))
+        out.extend(encoded)
+        points = series[name]
+        write_varint(out, len(points))
+        for column in (0, 1):
+            previous = 0
+            for point in points:
+                write_varint(out, zigzag(point[column] - previous))
+                previous = point[column]
+    return bytes(out)
+
+
+def decode_temperatures(data):
+    """
+    :return: List of reading dictionaries, grouped by probe, with `created_on` as an ISO 8601 UTC time
+    """
+    data, count, position = read_header(data, TEMPERATURES)
+    series, position = read_varint(data, position)
+    readings = []
+    for _ in range(series):
+        length, position = read_varint(data, position)
+        name = bytes(data[position:position + length]).decode('utf-8')
+        position += length
+        points, position = read_varint(data, position)
+        columns = []
+        for column in (0, 1):
+            values = []
+            current = 0
+            for _ in range(points):
+                value, position = read_varint(data, position)
+                current += unzigzag(value)
+                values.append(current)
+            columns.append(values)
+        for millis, value in zip(*columns):
+            readings.append({'name': name, 'temperature': value / 100.0, 'created_on': from_millis(millis)})
+    if len(readings) != count:
+        raise WireError("Expected %d readings, got %d" % (count, len(readings)))
+    return readings
+
+
+class Negotiation(object):
+    """
+    Whether an API endpoint takes the compact encoding, learnt from its responses.
+
+    Parameters
+    ----------
+    mode<optional>: String
+        `auto` posts compact payloads once the endpoint lists `MEDIA_TYPE` in an `Accept-Post` header,
+        `compact` always does, `json` never does.
+    retry_after<optional>: Float
+        Seconds an endpoint that rejected a compact payload is left alone before its headers are trusted again.
+    """
+    def __init__(self, mode='auto', retry_after=24 * 3600):
+        if mode not in ('auto', 'compact', 'json'):
+            raise ValueError("Unknown wire format `%s`" % mode)
+        self.mode = mode
+        self.retry_after = retry_after
+        self.accepted = mode == 'compact'
+        self.rejected_at = None
+
+    def compact(self):
+        """
+        Whether the next post should be compact.
+        """
+        if self.mode == 'json' or not self.accepted:
+            return False
+        return not self.backing_off()
+
+    def observe(self, response, kind, format, records):
+        """
+        Learns from a response whether compact payloads are welcome, and counts what was posted.
+
+        :return: False when the response rejected a compact payload, which should be posted again in the
+            fallback format
+        """
+        request = getattr(response, 'request', None)
+        body = getattr(request, 'body', None)
+        if body is not None:
+            BYTES.labels(kind, format).inc(len(body))
+        RECORDS.labels(kind, format).inc(records)
+
+        if format == 'compact' and response.status_code in (406, 415):
+            self.rejected_at = time.time()
+            self.accepted = self.mode == 'compact'
+            return False
+
+        advertised = response.headers.get('Accept-Post', '')
+        if MEDIA_TYPE in advertised and self.mode == 'auto' and not self.backing_off():
+            self.accepted = True
+            self.rejected_at = None
+        return True
+
+    def backing_off(self):
+        """
+        Whether a compact payload was rejected less than `retry_after` seconds ago.
+        """
+        return self.rejected_at is not None and time.time() - self.rejected_at <= self.retry_after